@@ -0,0 +1,194 @@
+"""
+Нагрузочный тест обработчиков FactsBot.
+
+Бот собирается без обращения к сети: запросы к Bot API перехватывает StubRequest.
+Синтетические обновления (команды, нажатия кнопок, текст) для N пользователей
+прогоняются через Application.process_update, после чего выводятся перцентили
+задержки по видам обновлений, пропускная способность и статистика аллокаций.
+
+Пример:
+    python benchmark.py --users 200 --updates 5000
+    python benchmark.py --record corpus.jsonl
+    python benchmark.py --replay corpus.jsonl --concurrency 16 --tracemalloc
+"""
+
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from bot import FactsBot, OutboundRateLimiter
+from tools import fake_api_result, make_synthetic_update
+
+DATA_FILES = ("russian_facts.json", "user_preferences.json")
+
+
+class StubRequest(BaseRequest):
+    """Заглушка сетевого слоя: отвечает на вызовы Bot API без обращения к сети"""
+
+    def __init__(self):
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        payload = {"ok": True, "result": fake_api_result(api_method, params)}
+        return 200, json.dumps(payload).encode('utf-8')
+
+
+def update_kind(data: Dict) -> str:
+    """Возвращает вид обновления для группировки результатов"""
+    if "inline_query" in data:
+        return "inline"
+    if "callback_query" in data:
+        return "callback:" + data["callback_query"]["data"].split('_', 1)[0]
+    text = data["message"]["text"]
+    return text.split(' ', 1)[0] if text.startswith('/') else "text"
+
+
+def generate_corpus(users: int, updates: int, seed: int) -> List[Dict]:
+    """Генерирует синтетические обновления для заданного числа пользователей"""
+    rng = random.Random(seed)
+    return [make_synthetic_update(i + 1, rng.randint(1, users), rng) for i in range(updates)]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Возвращает перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_benchmark(corpus: List[Dict], concurrency: int, trace: bool, rate_limit: bool = False) -> None:
+    """Прогоняет обновления через обработчики бота и печатает отчет"""
+    request = StubRequest()
+    # Без --rate-limit планировщик исходящих сообщений работает, но не заставляет ждать
+    limiter = None if rate_limit else OutboundRateLimiter(global_rate=1e9, chat_rate=1e9, group_per_minute=1e9)
+    bot = FactsBot("123456:BENCHMARK", request=request, rate_limiter=limiter)
+    application = bot.application
+    await application.initialize()
+    await bot._post_init(application)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    updates = [Update.de_json(data, application.bot) for data in corpus]
+    kinds = [update_kind(data) for data in corpus]
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in zip(updates, kinds):
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            update, kind = queue.get_nowait()
+            started = time.perf_counter()
+            await bot.update_processor.process_update(update, application.process_update(update))
+            latencies[kind].append(time.perf_counter() - started)
+
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    snapshot = tracemalloc.take_snapshot() if trace else None
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    await bot._post_shutdown(application)
+    await application.shutdown()
+
+    print(f"\nОбновлений: {len(updates)}, параллельность: {concurrency}")
+    print(f"Время: {elapsed:.3f} с, пропускная способность: {len(updates) / elapsed:.1f} обн/с")
+    print(f"Вызовы Bot API: {dict(request.calls)}\n")
+
+    print(f"{'вид обновления':<20}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    all_latencies = []
+    for kind in sorted(latencies):
+        values = sorted(latencies[kind])
+        all_latencies.extend(values)
+        print(f"{kind:<20}{len(values):>8}{percentile(values, 0.5) * 1000:>10.3f}"
+              f"{percentile(values, 0.95) * 1000:>10.3f}{percentile(values, 0.99) * 1000:>10.3f}")
+    all_latencies.sort()
+    print(f"{'всего':<20}{len(all_latencies):>8}{percentile(all_latencies, 0.5) * 1000:>10.3f}"
+          f"{percentile(all_latencies, 0.95) * 1000:>10.3f}{percentile(all_latencies, 0.99) * 1000:>10.3f}")
+
+    if snapshot is not None:
+        print(f"\nПамять (tracemalloc): текущая {current / 1024:.1f} КиБ, пиковая {peak / 1024:.1f} КиБ")
+        bot_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "bot.py"))
+        stats = snapshot.filter_traces([tracemalloc.Filter(True, bot_file)]).statistics('lineno')
+        print("Живые аллокации в bot.py (блоков / КиБ):")
+        for stat in sorted(stats, key=lambda item: item.count, reverse=True)[:10]:
+            frame = stat.traceback[0]
+            print(f"  строка {frame.lineno:<6}{stat.count:>8}{stat.size / 1024:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="число симулируемых пользователей")
+    parser.add_argument("--updates", type=int, default=2000, help="число обновлений")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=1, help="число одновременно обрабатываемых обновлений")
+    parser.add_argument("--record", help="сохранить сгенерированные обновления в JSONL-файл")
+    parser.add_argument("--replay", help="прогнать обновления из JSONL-файла вместо генерации")
+    parser.add_argument("--tracemalloc", action="store_true", help="учитывать аллокации (замедляет прогон)")
+    parser.add_argument("--rate-limit", action="store_true", help="соблюдать лимиты Telegram на исходящие сообщения")
+    parser.add_argument("--keep-data", action="store_true", help="не удалять временный каталог с данными")
+    args = parser.parse_args()
+
+    # Журнал обработчиков на уровне INFO исказил бы замеры
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.replay:
+        with open(args.replay, 'r', encoding='utf-8') as f:
+            corpus = [json.loads(line) for line in f if line.strip()]
+    else:
+        corpus = generate_corpus(args.users, args.updates, args.seed)
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            for data in corpus:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+    # Бот работает с файлами данных в текущем каталоге, поэтому прогон идет на их копиях
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix="factsbot-bench-")
+    for name in DATA_FILES:
+        if os.path.exists(os.path.join(source_dir, name)):
+            shutil.copy(os.path.join(source_dir, name), work_dir)
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        asyncio.run(run_benchmark(corpus, args.concurrency, args.tracemalloc, args.rate_limit))
+    finally:
+        os.chdir(previous_dir)
+        if args.keep_data:
+            print(f"\nДанные прогона: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,56 @@
 import os
+import re
+import hmac
+import http
 import json
+import math
+import mmap
 import random
+import shutil
+import signal
+import base64
+import gc
+import hashlib
+import inspect
+import sqlite3
+import struct
+import sys
+import asyncio
 import logging
-from typing import Dict, List, Optional
-from datetime import datetime
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+import marshal
+import tempfile
+import multiprocessing
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import MappingProxyType
+from typing import Awaitable, Callable, Container, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+from datetime import datetime, timedelta, timezone
+
+from telegram import (
+    Bot,
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    ReplyKeyboardMarkup,
+)
+from telegram.error import Forbidden, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
@@ -22,6 +63,1455 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Период (в секундах), с которым накопленные изменения сбрасываются на диск
+FLUSH_INTERVAL = float(os.environ.get("FACTS_FLUSH_INTERVAL", "5"))
+
+# Период (в секундах), с которым накопленные счетчики статистики переносятся в настройки
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", "30"))
+
+# Количество записей в журнале настроек, после которого он сжимается в снимок
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get("PREFERENCES_JOURNAL_LIMIT", "1000"))
+
+# Число потоков, в которых сериализуются и записываются файлы хранилищ
+STORAGE_IO_WORKERS = int(os.environ.get("STORAGE_IO_WORKERS", "2"))
+
+# Порог сходства (по Жаккару), начиная с которого новый факт считается дубликатом
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", "0.8"))
+
+# Выбор фактов: "deck" (колоды без повторов) или "weighted" (веса популярности, новизны и непоказанных фактов)
+FACT_SELECTOR = os.environ.get("FACT_SELECTOR", "deck")
+FACT_VIEWS_FILE = os.environ.get("FACT_VIEWS_FILE", "fact_views.json")
+SELECTION_POPULARITY_WEIGHT = float(os.environ.get("SELECTION_POPULARITY_WEIGHT", "0.5"))
+SELECTION_RECENCY_BOOST = float(os.environ.get("SELECTION_RECENCY_BOOST", "3"))
+SELECTION_RECENCY_WINDOW = float(os.environ.get("SELECTION_RECENCY_WINDOW", "86400"))
+SELECTION_UNSEEN_BOOST = float(os.environ.get("SELECTION_UNSEEN_BOOST", "20"))
+# Сколько последних показанных фактов помнить для каждого пользователя
+SELECTION_SEEN_LIMIT = int(os.environ.get("SELECTION_SEEN_LIMIT", "100"))
+
+# Инлайн-режим: максимум результатов, бюджет времени на поиск и кэш ответов
+INLINE_RESULTS_LIMIT = 50
+INLINE_BUDGET_MS = float(os.environ.get("INLINE_BUDGET_MS", "5"))
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", "2048"))
+INLINE_CACHE_TTL = int(os.environ.get("INLINE_CACHE_TTL", "60"))
+
+# Хранилище фактов и настроек: "json" (файлы) или "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_DB = os.environ.get("SQLITE_DB", "facts.db")
+
+# Скомпилированный корпус фактов (читается через mmap); пустое значение — читать JSON напрямую
+FACTS_CORPUS = os.environ.get("FACTS_CORPUS", "")
+
+# Снимок фактов и поисковых индексов для быстрого запуска (marshal); пустое значение — без снимка
+FACTS_SNAPSHOT = os.environ.get("FACTS_SNAPSHOT", "russian_facts.snapshot")
+
+# Число шардов настроек пользователей (0 — один файл user_preferences.json) и их каталог
+PREFERENCES_SHARDS = int(os.environ.get("PREFERENCES_SHARDS", "0"))
+PREFERENCES_DIR = os.environ.get("PREFERENCES_DIR", "user_preferences.d")
+# Сколько шардов держать в памяти одновременно (0 — без ограничения)
+PREFERENCES_LOADED_SHARDS = int(os.environ.get("PREFERENCES_LOADED_SHARDS", "4"))
+
+# Кэш записей активных пользователей: размер и время жизни записи без обращений (в секундах)
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "3600"))
+
+# Максимальное число обновлений, обрабатываемых одновременно (для разных чатов)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "16"))
+
+# Ограничения исходящих сообщений (лимиты Telegram): всего в секунду, в личный чат в секунду,
+# в группу в минуту; сколько вызовов может ждать отправки и сколько раз повторять после RetryAfter
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.environ.get("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_MAX_PENDING = int(os.environ.get("OUTBOUND_MAX_PENDING", "512"))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+
+# Ежедневная рассылка: время (UTC, ЧЧ:ММ), число параллельных отправок,
+# размер порции подписчиков между контрольными точками и файл контрольной точки
+BROADCAST_TIME = os.environ.get("BROADCAST_TIME", "07:00")
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", "500"))
+BROADCAST_CHECKPOINT = os.environ.get("BROADCAST_CHECKPOINT", "broadcast_checkpoint.json")
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+
+# Настройки вебхука
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Сколько секунд соединение может молчать (между запросами или посреди запроса), прежде чем его закроют
+WEBHOOK_IDLE_TIMEOUT = float(os.environ.get("WEBHOOK_IDLE_TIMEOUT", "30"))
+
+# Число рабочих процессов в режиме вебхука (пользователи делятся между ними по шардам настроек)
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+
+# Эндпоинт метрик в текстовом формате Prometheus (порт 0 — выключен)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Адрес Bot API (можно указать локальный тестовый сервер)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+
+def _atomic_write(path: str, write: Callable, binary: bool = False) -> None:
+    """Атомарно записывает файл: write(f) пишет во временный файл, который затем переименовывается"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _atomic_write_json(path: str, data) -> None:
+    """Атомарно записывает JSON: сначала во временный файл, затем переименовывает"""
+    _atomic_write(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=2))
+
+
+_storage_executor: Optional[ThreadPoolExecutor] = None
+
+
+async def run_blocking(function: Callable, *args):
+    """Выполняет блокирующую операцию хранилища в общем ограниченном пуле потоков"""
+    global _storage_executor
+    if _storage_executor is None:
+        _storage_executor = ThreadPoolExecutor(max_workers=STORAGE_IO_WORKERS, thread_name_prefix="storage-io")
+    return await asyncio.get_running_loop().run_in_executor(_storage_executor, function, *args)
+
+
+class CoalescingSaver:
+    """
+    Объединяет одновременные сохранения одного хранилища. Сохранения идут строго по одному;
+    все запросы, пришедшие во время записи, обслуживает одна следующая запись, снимок для
+    которой делается уже после них.
+    """
+
+    def __init__(self, store: str, save: Callable[[], Awaitable[None]]):
+        self.store = store
+        self.save = save
+        self._lock = asyncio.Lock()
+        self._requested = 0
+        self._completed = 0
+        self._current: Optional[asyncio.Future] = None
+
+    async def run(self) -> bool:
+        """Дожидается сохранения, учитывающего все изменения до вызова; False — запрос объединен с другим"""
+        self._requested += 1
+        ticket = self._requested
+        async with self._lock:
+            if self._current is not None and not self._current.done():
+                # Запись, начатая отмененным вызовом, еще идет: новая не должна ее обогнать
+                await asyncio.wait([self._current])
+            if self._completed >= ticket:
+                STORAGE_COALESCED_SAVES.inc(self.store)
+                return False
+            self._current = asyncio.ensure_future(self._save(self._requested))
+            # Отмена вызывающего (например, при остановке) не прерывает начатую запись
+            await asyncio.shield(self._current)
+            return True
+
+    @property
+    def busy(self) -> bool:
+        """Идет ли сейчас сохранение (или ждет своей очереди)"""
+        return self._lock.locked()
+
+    async def _save(self, target: int):
+        await self.save()
+        self._completed = target
+
+
+class WriteBehindFlusher:
+    """Фоновая задача, которая периодически сбрасывает накопленные изменения на диск"""
+
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self._targets: List[Callable] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, flush: Callable):
+        """Регистрирует функцию сброса изменений (обычную или асинхронную)"""
+        self._targets.append(flush)
+
+    async def flush_all(self):
+        """Сбрасывает изменения всех зарегистрированных хранилищ"""
+        for flush in self._targets:
+            try:
+                result = flush()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Ошибка при фоновом сохранении данных: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush_all()
+
+    def start(self):
+        """Запускает фоновую задачу в текущем цикле событий"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и выполняет финальный сброс"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_all()
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    """Форматирует метки в виде {name="value",...}"""
+    parts = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(name + '="' + escaped + '"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Счетчик, монотонно возрастающий для каждого набора меток"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {value}" for labels, value in values]
+
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами корзин (в секундах)"""
+
+    kind = "histogram"
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # метки -> [счетчики по корзинам (последняя — +Inf), сумма, количество]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Измеряет длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        lines = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels_text = _format_labels(self.label_names, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels_text} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик процесса. Кроме счетчиков и гистограмм поддерживает сборщики —
+    функции, которые в момент выдачи метрик возвращают текущие значения (name, type, help, value).
+    """
+
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: Dict[str, Callable[[], Iterable[Tuple[str, str, str, float]]]] = {}
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, key: str, collect: Callable[[], Iterable[Tuple[str, str, str, float]]]):
+        """Регистрирует (или заменяет) сборщик значений по ключу"""
+        self._collectors[key] = collect
+
+    def render(self) -> str:
+        """Возвращает все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for collect in list(self._collectors.values()):
+            try:
+                for name, kind, help_text, value in collect():
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.append(f"{name} {value}")
+            except Exception as e:
+                logger.error(f"Ошибка сборщика метрик: {e}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+HANDLER_LATENCY = METRICS.histogram(
+    "factsbot_handler_duration_seconds", "Время обработки команд, кнопок и запросов", ("kind", "name"))
+HANDLER_ERRORS = METRICS.counter(
+    "factsbot_handler_errors_total", "Исключения в обработчиках", ("kind", "name"))
+STORAGE_FLUSH_LATENCY = METRICS.histogram(
+    "factsbot_storage_flush_duration_seconds", "Время сохранения данных в хранилище", ("store", "operation"))
+STORAGE_COALESCED_SAVES = METRICS.counter(
+    "factsbot_storage_coalesced_saves_total", "Сохранения, объединенные с уже запланированной записью", ("store",))
+TELEGRAM_API_LATENCY = METRICS.histogram(
+    "factsbot_telegram_api_duration_seconds", "Время вызовов Bot API", ("method",))
+TELEGRAM_API_ERRORS = METRICS.counter(
+    "factsbot_telegram_api_errors_total", "Неуспешные вызовы Bot API", ("method",))
+OUTBOUND_WAIT = METRICS.histogram(
+    "factsbot_outbound_wait_seconds", "Ожидание отправки из-за ограничений частоты", ("scope",))
+OUTBOUND_RETRIES = METRICS.counter(
+    "factsbot_outbound_retries_total", "Повторы вызовов после RetryAfter", ("method",))
+OUTBOUND_MERGED_EDITS = METRICS.counter(
+    "factsbot_outbound_merged_edits_total", "Правки сообщения, замененные более новой правкой")
+BROADCAST_MESSAGES = METRICS.counter(
+    "factsbot_broadcast_messages_total", "Сообщения ежедневной рассылки", ("outcome",))
+STARTUP_PHASES = METRICS.histogram(
+    "factsbot_startup_phase_duration_seconds", "Длительность фаз запуска", ("phase",))
+EDIT_FALLBACKS = METRICS.counter(
+    "factsbot_edit_fallbacks_total", "Запасные пути при неудачном редактировании сообщения", ("outcome",))
+
+# Фазы запуска процесса: имя -> длительность в секундах (в порядке выполнения)
+STARTUP_TIMINGS: Dict[str, float] = {}
+
+
+@contextmanager
+def startup_phase(name: str):
+    """Замеряет фазу запуска: длительность попадает в сводку запуска и в метрику"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0.0) + elapsed
+        STARTUP_PHASES.observe(elapsed, name)
+
+
+def _format_startup_timings() -> str:
+    return ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in STARTUP_TIMINGS.items())
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка сетевого слоя PTB, которая учитывает длительность и ошибки вызовов Bot API"""
+
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.request.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        except Exception:
+            TELEGRAM_API_ERRORS.inc(api_method)
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.inc(api_method)
+        return code, payload
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics с метриками в текстовом формате Prometheus"""
+
+    def __init__(self, registry: MetricsRegistry, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info(f"Метрики доступны на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode('latin-1').split(' ')
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split('?', 1)[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Соединение с эндпоинтом метрик закрыто: {e}")
+        finally:
+            writer.close()
+
+
+def _connect_sqlite(db_file: str) -> sqlite3.Connection:
+    """Открывает базу SQLite в режиме WAL"""
+    connection = sqlite3.connect(db_file, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class FactsStorage(ABC):
+    """Базовый интерфейс хранилища фактов"""
+
+    @abstractmethod
+    def load(self) -> Optional[Dict[str, List[str]]]:
+        """Загружает все факты по темам; возвращает None, если хранилище еще пустое"""
+
+    @abstractmethod
+    def save(self, facts_data: Dict[str, List[str]], new_facts: List[Tuple[str, str]]):
+        """Сохраняет изменения: полный набор фактов и список добавленных с прошлого сохранения"""
+
+    def rewrite(self, facts_data: Dict[str, List[str]]):
+        """Полностью заменяет содержимое хранилища (например, после удаления фактов)"""
+        self.save(facts_data, [(topic, fact) for topic, facts in facts_data.items() for fact in facts])
+
+    def version(self):
+        """Признак версии данных для обнаружения изменений другим процессом (None — не отслеживается)"""
+        return None
+
+    def close(self):
+        """Освобождает ресурсы хранилища"""
+
+
+class JsonFactsStorage(FactsStorage):
+    """Хранилище фактов в одном JSON-файле, который перезаписывается целиком"""
+
+    def __init__(self, data_file: str = "russian_facts.json"):
+        self.data_file = data_file
+
+    def load(self) -> Optional[Dict[str, List[str]]]:
+        if not os.path.exists(self.data_file):
+            return None
+        with open(self.data_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def version(self):
+        try:
+            return os.stat(self.data_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def save(self, facts_data: Dict[str, List[str]], new_facts: List[Tuple[str, str]]):
+        _atomic_write_json(self.data_file, facts_data)
+
+
+class MappedCorpus:
+    """
+    Скомпилированный корпус фактов, читаемый через mmap. Формат (little-endian):
+    заголовок, таблица тем (первый факт, число фактов, смещение и длина имени),
+    имена тем, массив смещений фактов (u64, на один больше числа фактов) и тексты в UTF-8.
+    В памяти процесса держится только таблица тем; факты декодируются при обращении,
+    а страницы файла разделяются между процессами через кэш ОС.
+    """
+
+    MAGIC = b"FACTS\x00v1"
+    HEADER = struct.Struct("<8sIIIIQ")  # magic, тем, фактов, размер имен, резерв, версия источника
+    TOPIC = struct.Struct("<IIII")
+    OFFSET = struct.Struct("<Q")
+    SPAN = struct.Struct("<QQ")
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mmap
+        magic, topic_count, fact_count, names_size, _, self.source_version = self.HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC:
+            mm.close()
+            raise ValueError(f"{path} не является корпусом фактов")
+
+        names_start = self.HEADER.size + topic_count * self.TOPIC.size
+        self.topics: Dict[str, Tuple[int, int]] = {}
+        for i in range(topic_count):
+            first, count, name_offset, name_length = self.TOPIC.unpack_from(mm, self.HEADER.size + i * self.TOPIC.size)
+            name = mm[names_start + name_offset:names_start + name_offset + name_length].decode('utf-8')
+            self.topics[name] = (first, count)
+
+        self.fact_count = fact_count
+        self._offsets_start = self._align(names_start + names_size)
+        self._text_start = self._offsets_start + (fact_count + 1) * self.OFFSET.size
+
+    @staticmethod
+    def _align(position: int) -> int:
+        return (position + 7) & ~7
+
+    def _offset(self, index: int) -> int:
+        return self.OFFSET.unpack_from(self._mmap, self._offsets_start + index * self.OFFSET.size)[0]
+
+    def fact(self, index: int) -> str:
+        """Декодирует факт по его номеру в корпусе"""
+        start, end = self.SPAN.unpack_from(self._mmap, self._offsets_start + index * self.OFFSET.size)
+        return self._mmap[self._text_start + start:self._text_start + end].decode('utf-8')
+
+    def contains(self, fact: str, first: int, count: int) -> bool:
+        """Проверяет, есть ли факт среди фактов [first, first + count), не декодируя их"""
+        needle = fact.encode('utf-8')
+        low = self._text_start + self._offset(first)
+        high = self._text_start + self._offset(first + count)
+        position = self._mmap.find(needle, low, high)
+        while position != -1:
+            # Совпадение должно начинаться и заканчиваться на границах факта
+            start = position - self._text_start
+            lo, hi = first, first + count
+            while lo < hi:
+                middle = (lo + hi) // 2
+                if self._offset(middle) < start:
+                    lo = middle + 1
+                else:
+                    hi = middle
+            if lo < first + count and self._offset(lo) == start and self._offset(lo + 1) == start + len(needle):
+                return True
+            position = self._mmap.find(needle, position + 1, high)
+        return False
+
+    def close(self):
+        self._mmap.close()
+
+
+def build_corpus(path: str, facts_data: Mapping[str, List[str]], source_version: int = 0):
+    """Компилирует факты по темам в корпус для MappedCorpus"""
+    topic_entries = []
+    names = bytearray()
+    offsets = [0]
+    text = bytearray()
+    for topic, topic_facts in facts_data.items():
+        name = topic.encode('utf-8')
+        topic_entries.append((len(offsets) - 1, len(topic_facts), len(names), len(name)))
+        names += name
+        for fact in topic_facts:
+            text += fact.encode('utf-8')
+            offsets.append(len(text))
+
+    header_size = MappedCorpus.HEADER.size + len(topic_entries) * MappedCorpus.TOPIC.size
+    padding = MappedCorpus._align(header_size + len(names)) - header_size - len(names)
+
+    def write(f):
+        f.write(MappedCorpus.HEADER.pack(
+            MappedCorpus.MAGIC, len(topic_entries), len(offsets) - 1, len(names), 0, source_version
+        ))
+        for entry in topic_entries:
+            f.write(MappedCorpus.TOPIC.pack(*entry))
+        f.write(names)
+        f.write(b"\x00" * padding)
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.write(text)
+
+    _atomic_write(path, write, binary=True)
+
+
+class MappedTopicFacts:
+    """Факты одной темы: неизменяемая часть из корпуса и факты, добавленные после его сборки"""
+
+    __slots__ = ("corpus", "first", "count", "_added")
+
+    def __init__(self, corpus: MappedCorpus, first: int, count: int):
+        self.corpus = corpus
+        self.first = first
+        self.count = count
+        self._added: List[str] = []
+
+    def __len__(self) -> int:
+        return self.count + len(self._added)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if 0 <= index < self.count:
+            return self.corpus.fact(self.first + index)
+        if index < 0:
+            raise IndexError(index)
+        return self._added[index - self.count]
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.corpus.fact(self.first + index)
+        yield from self._added
+
+    def __contains__(self, fact) -> bool:
+        return fact in self._added or self.corpus.contains(fact, self.first, self.count)
+
+    def append(self, fact: str):
+        self._added.append(fact)
+
+    def copy(self) -> "MappedTopicFacts":
+        """Снимок темы: корпус общий, копируется только список добавленных фактов"""
+        snapshot = MappedTopicFacts(self.corpus, self.first, self.count)
+        snapshot._added = list(self._added)
+        return snapshot
+
+
+class MappedFactsStorage(FactsStorage):
+    """
+    Факты читаются из скомпилированного корпуса, а изменения пишутся в исходное хранилище (JSON).
+    Если источник изменился после сборки корпуса, корпус пересобирается при загрузке.
+    """
+
+    def __init__(self, corpus_file: str = FACTS_CORPUS, source: Optional[FactsStorage] = None):
+        self.corpus_file = corpus_file
+        self.source = source or JsonFactsStorage()
+        self.corpus: Optional[MappedCorpus] = None
+
+    def _open_corpus(self) -> Optional[MappedCorpus]:
+        try:
+            return MappedCorpus(self.corpus_file)
+        except (OSError, ValueError, struct.error) as e:
+            if os.path.exists(self.corpus_file):
+                logger.warning(f"Не удалось открыть корпус фактов: {e}")
+            return None
+
+    def load(self) -> Optional[Dict[str, MappedTopicFacts]]:
+        version = self.source.version()
+        corpus = self._open_corpus()
+        # Без исходного файла корпус используется как есть
+        if corpus is None or (version is not None and corpus.source_version != version):
+            data = self.source.load()
+            if data is None:
+                return None
+            build_corpus(self.corpus_file, data, version or 0)
+            logger.info(f"Корпус фактов {self.corpus_file} пересобран")
+            corpus = MappedCorpus(self.corpus_file)
+
+        # Прежний корпус не закрывается: на него могут ссылаться еще используемые темы
+        self.corpus = corpus
+        return {topic: MappedTopicFacts(corpus, first, count) for topic, (first, count) in corpus.topics.items()}
+
+    def save(self, facts_data: Dict[str, List[str]], new_facts: List[Tuple[str, str]]):
+        self.source.save({topic: list(topic_facts) for topic, topic_facts in facts_data.items()}, new_facts)
+
+    def rewrite(self, facts_data: Dict[str, List[str]]):
+        self.source.rewrite({topic: list(topic_facts) for topic, topic_facts in facts_data.items()})
+
+    def version(self):
+        return self.source.version()
+
+    def close(self):
+        self.source.close()
+
+
+def _file_facts_storage(data_file: str = "russian_facts.json") -> FactsStorage:
+    """Файловое хранилище фактов: JSON или, если задан FACTS_CORPUS, корпус поверх него"""
+    if FACTS_CORPUS:
+        return MappedFactsStorage(FACTS_CORPUS, JsonFactsStorage(data_file))
+    return JsonFactsStorage(data_file)
+
+
+def _marshal_load_section(f):
+    """
+    Читает раздел снимка: marshal.load из файла разбирает данные мелкими чтениями,
+    поэтому раздел хранится одним блоком байтов и разбирается целиком в памяти.
+    Сборщик циклического мусора на это время выключается, иначе он многократно
+    обходит миллионы только что созданных контейнеров.
+    """
+    data = marshal.load(f)
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(data)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class FactsSnapshot:
+    """
+    Снимок фактов и построенных по ним поисковых индексов в формате marshal.
+    В файле три раздела подряд: заголовок (формат и версия источника), факты с плоским
+    индексом и состояние поисковых индексов. Факты читаются при запуске, а индексы —
+    позже и отдельно. Снимок действителен, пока версия источника (mtime файла фактов)
+    не изменилась.
+    """
+
+    FORMAT = ("facts-snapshot", 3, marshal.version, tuple(sys.version_info[:2]))
+
+    def __init__(self, path: str = FACTS_SNAPSHOT):
+        self.path = path
+        # Версия источника, для которой открыт действительный снимок
+        self.version = None
+        self.facts_data: Optional[Dict[str, List[str]]] = None
+        self.fact_index: Optional[List[Tuple[str, int]]] = None
+        self._indexes_offset: Optional[int] = None
+
+    def _header(self, version) -> Tuple:
+        return self.FORMAT + (FactDeduplicator.BANDS, FactDeduplicator.ROWS), version
+
+    def open(self, version) -> bool:
+        """Читает факты из снимка, если он соответствует версии источника"""
+        if version is None:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                if marshal.load(f) != self._header(version):
+                    return False
+                self.facts_data, self.fact_index = _marshal_load_section(f)
+                self._indexes_offset = f.tell()
+        except FileNotFoundError:
+            return False
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logger.warning(f"Не удалось прочитать снимок фактов: {e}")
+            return False
+        self.version = version
+        return True
+
+    def load_indexes(self) -> Optional[Tuple]:
+        """Читает состояние поисковых индексов открытого снимка (None — его нет)"""
+        if self._indexes_offset is None:
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                # Файл могли заменить после открытия
+                if marshal.load(f) != self._header(self.version):
+                    return None
+                f.seek(self._indexes_offset)
+                return _marshal_load_section(f)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logger.warning(f"Не удалось прочитать индексы из снимка фактов: {e}")
+            return None
+
+    def save(self, version, facts_data: Optional[Dict[str, List[str]]], fact_index: List[Tuple[str, int]],
+             index_state: Optional[Tuple]):
+        """Записывает снимок; facts_data=None — факты читаются из хранилища (например, корпуса)"""
+        def write(f):
+            marshal.dump(self._header(version), f)
+            marshal.dump(marshal.dumps((facts_data, fact_index)), f)
+            marshal.dump(marshal.dumps(index_state), f)
+
+        _atomic_write(self.path, write, binary=True)
+        self.version = version
+
+
+class ForwardingFactsStorage(FactsStorage):
+    """
+    Хранилище фактов рабочего процесса, который не владеет файлом фактов:
+    читает общий файл, а новые факты передает процессу-владельцу через очередь.
+    """
+
+    def __init__(self, storage: FactsStorage, owner_queue):
+        self.storage = storage
+        self.owner_queue = owner_queue
+
+    def load(self) -> Optional[Dict[str, List[str]]]:
+        return self.storage.load()
+
+    def save(self, facts_data: Dict[str, List[str]], new_facts: List[Tuple[str, str]]):
+        for topic, fact in new_facts:
+            self.owner_queue.put((topic, fact))
+
+    def rewrite(self, facts_data: Dict[str, List[str]]):
+        logger.warning("Перезаписать факты может только процесс-владелец, изменения не сохранены")
+
+    def version(self):
+        return self.storage.version()
+
+
+class SQLiteFactsStorage(FactsStorage):
+    """Хранилище фактов в SQLite: таблицы тем и фактов, новые факты дописываются пакетом"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS topics (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS facts (
+            id INTEGER PRIMARY KEY,
+            topic_id INTEGER NOT NULL REFERENCES topics(id),
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS facts_by_topic ON facts(topic_id, id);
+    """
+
+    def __init__(self, db_file: str = SQLITE_DB):
+        self.db_file = db_file
+        self.connection = _connect_sqlite(db_file)
+        self.connection.executescript(self.SCHEMA)
+
+    def load(self) -> Optional[Dict[str, List[str]]]:
+        rows = self.connection.execute(
+            "SELECT topics.name, facts.text FROM facts JOIN topics ON topics.id = facts.topic_id "
+            "ORDER BY facts.id"
+        ).fetchall()
+        if not rows:
+            return None
+
+        data: Dict[str, List[str]] = {}
+        for topic, text in rows:
+            data.setdefault(topic, []).append(text)
+        return data
+
+    def save(self, facts_data: Dict[str, List[str]], new_facts: List[Tuple[str, str]]):
+        if not new_facts:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO topics (name) VALUES (?)",
+                [(topic,) for topic in {topic for topic, _ in new_facts}],
+            )
+            self.connection.executemany(
+                "INSERT INTO facts (topic_id, text) SELECT id, ? FROM topics WHERE name = ?",
+                [(text, topic) for topic, text in new_facts],
+            )
+
+    def rewrite(self, facts_data: Dict[str, List[str]]):
+        with self.connection:
+            self.connection.execute("DELETE FROM facts")
+            self.connection.execute("DELETE FROM topics")
+        self.save(facts_data, [(topic, fact) for topic, facts in facts_data.items() for fact in facts])
+
+    def close(self):
+        self.connection.close()
+
+
+class PreferencesStorage(ABC):
+    """Базовый интерфейс хранилища пользовательских настроек"""
+
+    # Сжатие по порогу выполняет не append, а фоновый сброс (UserPreferences.flush_async)
+    deferred_compaction = False
+    # Умеет ли хранилище читать одного пользователя, не загружая в память всех
+    per_user_reads = False
+
+    @abstractmethod
+    def load(self) -> Dict:
+        """Загружает настройки всех пользователей в виде {user_id: {key: value}}"""
+
+    @abstractmethod
+    def load_user(self, user_id_str: str) -> Optional[Dict]:
+        """Читает настройки одного пользователя или возвращает None"""
+
+    @abstractmethod
+    def iter_users(self) -> Iterator[Tuple[str, Dict]]:
+        """Перебирает (user_id, настройки); хранилища с per_user_reads не держат в памяти всех сразу"""
+
+    @abstractmethod
+    def append(self, user_id_str: str, key: str, value):
+        """Записывает изменение одной настройки пользователя"""
+
+    def flush(self):
+        """Делает накопленные изменения долговечными"""
+
+    def compact(self):
+        """Записывает полное состояние хранилища"""
+        self.flush()
+
+    def compaction_due(self) -> bool:
+        """Пора ли записать полное состояние (накопилось много изменений)"""
+        return False
+
+    def prepare_compaction(self) -> Optional[Callable[[], None]]:
+        """
+        Фиксирует снимок состояния для записи в другом потоке. Вызывается в потоке цикла
+        событий; возвращает функцию записи снимка или None, если записывать нечего.
+        """
+        self.compact()
+        return None
+
+    def release(self):
+        """Выгружает из памяти данные, к которым давно не обращались"""
+
+    def close(self):
+        """Сохраняет изменения и освобождает ресурсы"""
+        self.flush()
+
+
+class JournalPreferencesStorage(PreferencesStorage):
+    """
+    Хранилище настроек: снимок в JSON-файле и журнал изменений рядом с ним.
+    Каждое изменение дописывается в журнал одной строкой [user_id, key, value];
+    при загрузке журнал проигрывается поверх снимка и сжимается в новый снимок.
+    """
+
+    def __init__(self, snapshot_file: str, journal_file: Optional[str] = None,
+                 compact_threshold: int = JOURNAL_COMPACT_THRESHOLD):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file or snapshot_file + ".journal"
+        # Журнал, записи которого попадут в снимок при идущем (или прерванном) сжатии
+        self.compacting_file = self.journal_file + ".compacting"
+        self.compact_threshold = compact_threshold
+        self.data: Dict = {}
+        self._journal = None
+        self._journal_entries = 0
+
+    def load(self) -> Dict:
+        """Загружает снимок, проигрывает журнал и сжимает его"""
+        data = {}
+        try:
+            if os.path.exists(self.snapshot_file):
+                with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка при загрузке настроек: {e}")
+
+        self.data = data
+        # Записи незавершенного фонового сжатия старше записей текущего журнала
+        self._journal_entries = self._replay_journal(self.compacting_file) + self._replay_journal(self.journal_file)
+        # При отложенном сжатии журнал сожмет фоновый сброс, когда он дорастет до порога
+        if self._journal_entries and not self.deferred_compaction:
+            self.compact()
+        return self.data
+
+    def _replay_journal(self, journal_file: str) -> int:
+        """Применяет записи журнала к данным снимка, возвращает их количество"""
+        if not os.path.exists(journal_file):
+            return 0
+
+        applied = 0
+        try:
+            with open(journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        user_id_str, key, value = json.loads(line)
+                    except (ValueError, TypeError):
+                        # Последняя строка могла быть записана не до конца при сбое
+                        logger.warning("Пропущена поврежденная запись журнала настроек")
+                        continue
+                    self.data.setdefault(user_id_str, {})[key] = value
+                    applied += 1
+        except IOError as e:
+            logger.error(f"Ошибка при чтении журнала настроек: {e}")
+        return applied
+
+    def load_user(self, user_id_str: str) -> Optional[Dict]:
+        """Настройки одного пользователя из загруженных данных"""
+        return self.data.get(user_id_str)
+
+    def iter_users(self) -> Iterator[Tuple[str, Dict]]:
+        # Снимок ключей: между порциями обработчики могут добавлять пользователей
+        for user_id_str in list(self.data):
+            user_prefs = self.data.get(user_id_str)
+            if user_prefs is not None:
+                yield user_id_str, user_prefs
+
+    def append(self, user_id_str: str, key: str, value):
+        """Применяет изменение одной настройки к данным и дописывает его в журнал"""
+        self.data.setdefault(user_id_str, {})[key] = value
+        try:
+            if self._journal is None:
+                self._journal = open(self.journal_file, 'a', encoding='utf-8')
+            self._journal.write(json.dumps([user_id_str, key, value], ensure_ascii=False, separators=(',', ':')) + "\n")
+            self._journal.flush()
+            self._journal_entries += 1
+        except IOError as e:
+            logger.error(f"Ошибка при записи журнала настроек: {e}")
+            return
+
+        if self._journal_entries >= self.compact_threshold and not self.deferred_compaction:
+            self.compact()
+
+    def compact(self):
+        """Записывает полный снимок и очищает журнал"""
+        try:
+            _atomic_write_json(self.snapshot_file, self.data)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            # Снимок уже содержит все изменения, поэтому журнал можно обнулить
+            open(self.journal_file, 'w', encoding='utf-8').close()
+            if os.path.exists(self.compacting_file):
+                os.unlink(self.compacting_file)
+            self._journal_entries = 0
+        except (IOError, OSError) as e:
+            logger.error(f"Ошибка при сохранении настроек: {e}")
+
+    def compaction_due(self) -> bool:
+        return self._journal_entries >= self.compact_threshold
+
+    def prepare_compaction(self) -> Optional[Callable[[], None]]:
+        """Копирует данные и откладывает текущий журнал; новые изменения пишутся в новый журнал"""
+        if not self._journal_entries:
+            return None
+        try:
+            self._rotate_journal()
+        except (IOError, OSError) as e:
+            logger.error(f"Ошибка при подготовке сжатия журнала настроек: {e}")
+            return None
+        self._journal_entries = 0
+        # Словари пользователей изменяются на месте, поэтому копируются оба уровня
+        data = {user_id_str: dict(user_prefs) for user_id_str, user_prefs in self.data.items()}
+
+        def write():
+            _atomic_write_json(self.snapshot_file, data)
+            os.unlink(self.compacting_file)
+
+        return write
+
+    def _rotate_journal(self):
+        """Переносит записи журнала в файл сжатия"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not os.path.exists(self.journal_file):
+            return
+        if os.path.exists(self.compacting_file):
+            # Прошлое сжатие не удалось: его записи еще не в снимке, новые дописываются после них
+            with open(self.journal_file, 'rb') as source, open(self.compacting_file, 'ab') as target:
+                shutil.copyfileobj(source, target)
+            os.unlink(self.journal_file)
+        else:
+            os.replace(self.journal_file, self.compacting_file)
+
+    def close(self):
+        """Сжимает журнал и закрывает файлы"""
+        if self._journal_entries:
+            self.compact()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class ShardedPreferences(MutableMapping):
+    """
+    Настройки всех пользователей поверх шардов: обращение к пользователю
+    загружает только его шард, полный обход загружает все.
+    """
+
+    def __init__(self, storage: "ShardedPreferencesStorage"):
+        self.storage = storage
+
+    def __getitem__(self, user_id_str: str) -> Dict:
+        return self.storage.shard_for(user_id_str).data[user_id_str]
+
+    def __setitem__(self, user_id_str: str, value: Dict):
+        self.storage.shard_for(user_id_str).data[user_id_str] = value
+
+    def __delitem__(self, user_id_str: str):
+        del self.storage.shard_for(user_id_str).data[user_id_str]
+
+    def __contains__(self, user_id_str) -> bool:
+        return user_id_str in self.storage.shard_for(user_id_str).data
+
+    def __iter__(self):
+        for index in range(self.storage.shards):
+            yield from list(self.storage.shard(index).data)
+
+    def __len__(self) -> int:
+        return sum(len(self.storage.shard(index).data) for index in range(self.storage.shards))
+
+
+class ShardedPreferencesStorage(PreferencesStorage):
+    """
+    Хранилище настроек из N независимых шардов (снимок и журнал на каждый) в одном каталоге.
+    Шард пользователя выбирается по crc32 его id; шарды загружаются при первом обращении,
+    а сжимаются и записываются только затронутые. Давно не использованные шарды сверх
+    max_loaded выгружаются: их изменения уже в журнале и проиграются при следующей загрузке.
+    """
+
+    MANIFEST = "shards.json"
+    per_user_reads = True
+
+    def __init__(self, directory: str = PREFERENCES_DIR, shards: Optional[int] = None,
+                 compact_threshold: int = JOURNAL_COMPACT_THRESHOLD, max_loaded: int = PREFERENCES_LOADED_SHARDS):
+        self.directory = directory
+        self.compact_threshold = compact_threshold
+        self.max_loaded = max_loaded
+        os.makedirs(directory, exist_ok=True)
+
+        # Число шардов фиксируется в манифесте: при другом значении пользователи
+        # оказались бы не в своих шардах, поэтому менять его можно только через reshard
+        manifest_file = os.path.join(directory, self.MANIFEST)
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)["shards"]
+            if shards is not None and stored != shards:
+                logger.warning(f"В {directory} {stored} шардов настроек вместо {shards}, используется {stored}")
+            shards = stored
+        except FileNotFoundError:
+            shards = shards or PREFERENCES_SHARDS or 16
+            _atomic_write_json(manifest_file, {"shards": shards})
+        self.shards = shards
+        # Загруженные шарды в порядке последнего обращения
+        self._loaded: "OrderedDict[int, JournalPreferencesStorage]" = OrderedDict()
+
+    @staticmethod
+    def shard_index(user_id_str: str, shards: int) -> int:
+        """Номер шарда для пользователя"""
+        return zlib.crc32(user_id_str.encode('utf-8')) % shards
+
+    def shard(self, index: int) -> JournalPreferencesStorage:
+        """Возвращает шард, загружая его при первом обращении"""
+        storage = self._loaded.get(index)
+        if storage is None:
+            storage = JournalPreferencesStorage(
+                os.path.join(self.directory, f"shard-{index:03d}.json"),
+                compact_threshold=self.compact_threshold,
+            )
+            storage.deferred_compaction = self.deferred_compaction
+            storage.load()
+            self._loaded[index] = storage
+        else:
+            self._loaded.move_to_end(index)
+        return storage
+
+    def shard_for(self, user_id_str: str) -> JournalPreferencesStorage:
+        return self.shard(self.shard_index(user_id_str, self.shards))
+
+    def load(self) -> Dict:
+        return ShardedPreferences(self)
+
+    def load_user(self, user_id_str: str) -> Optional[Dict]:
+        return self.shard_for(user_id_str).data.get(user_id_str)
+
+    def iter_users(self, shard_indices: Optional[Iterable[int]] = None) -> Iterator[Tuple[str, Dict]]:
+        """Перебирает пользователей шардов shard_indices (по умолчанию всех), загружая шарды по одному"""
+        for index in range(self.shards) if shard_indices is None else shard_indices:
+            data = self.shard(index).data
+            for user_id_str in list(data):
+                user_prefs = data.get(user_id_str)
+                if user_prefs is not None:
+                    yield user_id_str, user_prefs
+
+    def append(self, user_id_str: str, key: str, value):
+        self.shard_for(user_id_str).append(user_id_str, key, value)
+
+    def import_data(self, preferences: Mapping):
+        """Раскладывает настройки всех пользователей по шардам и записывает их (для решардинга)"""
+        for user_id_str, user_prefs in preferences.items():
+            self.shard_for(user_id_str).data[user_id_str] = dict(user_prefs)
+        for storage in self._loaded.values():
+            storage.compact()
+
+    def compact(self):
+        for storage in self._loaded.values():
+            storage.compact()
+
+    def compaction_due(self) -> bool:
+        return any(storage.compaction_due() for storage in self._loaded.values())
+
+    def prepare_compaction(self) -> Optional[Callable[[], None]]:
+        writes = [write for write in (storage.prepare_compaction() for storage in self._loaded.values()) if write]
+        if not writes:
+            return None
+
+        def write():
+            for write_shard in writes:
+                write_shard()
+
+        return write
+
+    def release(self):
+        """Выгружает давно не использованные шарды сверх max_loaded, не дожидаясь их сжатия"""
+        while self.max_loaded and len(self._loaded) > self.max_loaded:
+            _, storage = self._loaded.popitem(last=False)
+            if storage._journal is not None:
+                storage._journal.close()
+                storage._journal = None
+
+    def close(self):
+        for storage in self._loaded.values():
+            storage.close()
+
+
+class SQLitePreferencesStorage(PreferencesStorage):
+    """Хранилище настроек в SQLite: одна строка на пару (пользователь, настройка), коммиты пакетами"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            user_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID;
+    """
+
+    per_user_reads = True
+
+    def __init__(self, db_file: str = SQLITE_DB, batch_size: int = JOURNAL_COMPACT_THRESHOLD):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.connection = _connect_sqlite(db_file)
+        self.connection.executescript(self.SCHEMA)
+        self._uncommitted = 0
+
+    def load(self) -> Dict:
+        data: Dict = {}
+        for user_id_str, key, value in self.connection.execute("SELECT user_id, key, value FROM user_preferences"):
+            data.setdefault(user_id_str, {})[key] = json.loads(value)
+        return data
+
+    def load_user(self, user_id_str: str) -> Optional[Dict]:
+        rows = self.connection.execute(
+            "SELECT key, value FROM user_preferences WHERE user_id = ?", (user_id_str,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows} if rows else None
+
+    def iter_users(self, batch_size: int = 1000, after: str = "") -> Iterator[Tuple[str, Dict]]:
+        # Постранично по первичному ключу: курсор не остается открытым между порциями,
+        # во время которых обработчики пишут в ту же базу
+        last = after
+        while True:
+            rows = self.connection.execute(
+                "SELECT user_id, key, value FROM user_preferences WHERE user_id IN ("
+                "SELECT DISTINCT user_id FROM user_preferences WHERE user_id > ? ORDER BY user_id LIMIT ?"
+                ") ORDER BY user_id",
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            user_id_str, user_prefs = rows[0][0], {}
+            for row_user_id, key, value in rows:
+                if row_user_id != user_id_str:
+                    yield user_id_str, user_prefs
+                    user_id_str, user_prefs = row_user_id, {}
+                user_prefs[key] = json.loads(value)
+            yield user_id_str, user_prefs
+            last = user_id_str
+
+    def append(self, user_id_str: str, key: str, value):
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO user_preferences (user_id, key, value) VALUES (?, ?, ?)",
+                (user_id_str, key, json.dumps(value, ensure_ascii=False)),
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.batch_size:
+                self.flush()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при записи настроек: {e}")
+
+    def import_data(self, preferences: Dict):
+        """Загружает в базу настройки всех пользователей (для миграции)"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO user_preferences (user_id, key, value) VALUES (?, ?, ?)",
+                [
+                    (user_id_str, key, json.dumps(value, ensure_ascii=False))
+                    for user_id_str, user_prefs in preferences.items()
+                    for key, value in user_prefs.items()
+                ],
+            )
+
+    def flush(self):
+        if self._uncommitted:
+            try:
+                self.connection.commit()
+                self._uncommitted = 0
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при сохранении настроек: {e}")
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+# Встроенные наборы фактов. Таблицы неизменяемые и создаются один раз при импорте модуля,
+# поэтому выбор факта не пересоздает весь каталог.
+RANDOM_FACTS: Tuple[str, ...] = (
+    "Мозг человека на 60% состоит из жира.",
+    "В Японии есть специальные звукопоглощающие столбы, чтобы заглушить шум от поездов.",
+    "Сердце креветки находится в ее голове.",
+    "Кошки могут издавать более 100 различных звуков, а собаки только около 10.",
+    "В Швейцарии запрещено мыть машину по воскресеньям.",
+    "Мед никогда не портится. Археологи находили съедобный мед в гробницах фараонов.",
+    "У осьминога три сердца.",
+    "В Исландии нет комаров.",
+    "Человек моргает примерно 15-20 раз в минуту, то есть около 12 миллионов раз в год.",
+    "Язык жирафа может достигать длины 45 см.",
+    "Свет от Солнца до Земли доходит за 8 минут 20 секунд.",
+    "В Древнем Риме моча использовалась как чистящее средство для одежды.",
+    "Пингвины могут прыгать в высоту до 2 метров.",
+    "В России находится самое глубокое озеро в мире - Байкал.",
+    "Ленивцы спускаются с деревьев только раз в неделю, чтобы сходить в туалет.",
+    "У улитки около 25 000 зубов.",
+    "Финляндия - самая счастливая страна в мире (по данным World Happiness Report).",
+    "Человеческое тело содержит достаточно железа, чтобы сделать гвоздь длиной 7,5 см.",
+    "В Японии больше всего в мире торговых автоматов - около 5 миллионов.",
+    "Земля - единственная планета, не названная в честь бога."
+)
+
+TOPIC_FACTS: Mapping[str, Tuple[str, ...]] = MappingProxyType({
+    "животные": (
+        "У осьминога три сердца.",
+        "Сердце креветки находится в ее голове.",
+        "Кошки проводят около 70% своей жизни во сне.",
+        "Улитки могут спать до 3 лет.",
+        "Язык жирафа может достигать длины 45 см.",
+        "Пингвины могут прыгать в высоту до 2 метров.",
+        "Ленивцы спускаются с деревьев только раз в неделю.",
+        "У улитки около 25 000 зубов.",
+        "Колибри - единственная птица, которая умеет летать назад.",
+        "Слоны могут учуять воду на расстоянии до 5 км."
+    ),
+    "наука": (
+        "Мозг человека на 60% состоит из жира.",
+        "Свет от Солнца до Земли доходит за 8 минут 20 секунд.",
+        "Человек моргает примерно 15-20 раз в минуту.",
+        "В человеческом теле около 37 триллионов клеток.",
+        "Кости человека в 4 раза прочнее бетона.",
+        "Земля вращается со скоростью около 1670 км/ч на экваторе.",
+        "Атомы на 99,9999999999999% состоят из пустого пространства.",
+        "У человека и банана около 50% общих генов.",
+        "Венера - единственная планета, вращающаяся против часовой стрелки.",
+        "Один год на Венере длится 225 земных дней."
+    ),
+    "география": (
+        "В России находится самое глубокое озеро в мире - Байкал.",
+        "В Исландии нет комаров.",
+        "Финляндия - самая счастливая страна в мире.",
+        "В Японии больше всего в мире торговых автоматов.",
+        "Канада имеет самую длинную береговую линию в мире.",
+        "В Сибири находится 25% мировых лесов.",
+        "Россия - самая большая страна в мире по площади.",
+        "В Чили находится самая сухая пустыня в мире - Атакама.",
+        "В Австралии больше кенгуру, чем людей.",
+        "В Гренландии самое большое количество айсбергов."
+    ),
+    "история": (
+        "В Древнем Риме моча использовалась как чистящее средство.",
+        "Наполеон был атакован кроликами во время охоты.",
+        "Викинги использовали птиц для навигации в море.",
+        "В Древнем Египте фараоны носили накладные бороды.",
+        "Первые ножницы были изобретены в Древнем Риме.",
+        "В Средневековье пиво было безопаснее воды.",
+        "Древние греки использовали камни вместо туалетной бумаги.",
+        "В XIX веке кетчуп продавался как лекарство.",
+        "Клеопатра жила ближе к изобретению iPhone, чем к строительству пирамид.",
+        "В Древнем Китае использовали бумажные деньги уже в VII веке."
+    ),
+    "технологии": (
+        "Первый компьютерный вирус был создан в 1983 году.",
+        "Пароль '123456' до сих пор один из самых популярных.",
+        "Первая компьютерная мышь была сделана из дерева.",
+        "Самый первый сайт в интернете до сих пор работает.",
+        "Первая камера на телефоне появилась в 2000 году.",
+        "Wi-Fi был изобретен в 1991 году.",
+        "Первое SMS было отправлено в 1992 году.",
+        "YouTube был основан тремя бывшими сотрудниками PayPal.",
+        "Первая игра в истории - 'Tennis for Two' (1958).",
+        "Самый первый домен в интернете - symbolics.com."
+    ),
+    "культура": (
+        "В Швейцарии запрещено мыть машину по воскресеньям.",
+        "В Японии есть специальные звукопоглощающие столбы.",
+        "В Саудовской Аравии нет кинотеатров до 2018 года.",
+        "Во Франции запрещено называть свинью Наполеоном.",
+        "В Сингапуре запрещено жевать жвачку.",
+        "В Италии больше объектов Всемирного наследия ЮНЕСКО, чем в любой другой стране.",
+        "В Индии больше всего в мире вегетарианцев.",
+        "В Бразилии говорят на португальском, а не на испанском.",
+        "В Канаде самый высокий уровень образования в мире.",
+        "В Японии самая высокая продолжительность жизни."
+    ),
+    "спорт": (
+        "Футбол - самый популярный вид спорта в мире.",
+        "Баскетбол был изобретен в 1891 году в США.",
+        "Волейбол был изобретен в 1895 году.",
+        "Хоккей с шайбой появился в Канаде в XIX веке.",
+        "Теннис зародился во Франции в XII веке.",
+        "Плавание было включено в Олимпийские игры в 1896 году.",
+        "Бег на 100 метров - самая короткая дистанция в легкой атлетике.",
+        "Шахматы - один из старейших видов спорта.",
+        "Серфинг был изобретен в Полинезии 4000 лет назад.",
+        "Скалолазание стало олимпийским видом спорта в 2020 году."
+    ),
+    "кухня": (
+        "Мед никогда не портится.",
+        "Помидор - это фрукт, а не овощ.",
+        "Морковь изначально была фиолетовой.",
+        "Кетчуп изначально был рыбным соусом.",
+        "Шоколад был валютой у древних майя.",
+        "Сыр был изобретен более 7000 лет назад.",
+        "Чай - второй по популярности напиток после воды.",
+        "Кофе был открыт в Эфиопии в IX веке.",
+        "Соль когда-то ценилась на вес золота.",
+        "Яблоки плавают, потому что на 25% состоят из воздуха."
+    ),
+    "здоровье": (
+        "Смех укрепляет иммунную систему.",
+        "Ходьба пешком продлевает жизнь.",
+        "Сон укрепляет память.",
+        "Вода составляет около 60% веса тела взрослого человека.",
+        "Человек делает около 20 000 вдохов в день.",
+        "Улыбка задействует 17 мышц лица.",
+        "Человек теряет около 50-100 волос в день.",
+        "Ногти на руках растут в 4 раза быстрее, чем на ногах.",
+        "Сердце перекачивает около 7500 литров крови в день.",
+        "Человек может прожить без воды около 3 дней."
+    ),
+})
+
+TOPICS: Tuple[str, ...] = tuple(TOPIC_FACTS)
+
 
 class RussianFactsAPI:
     """Класс для получения русскоязычных фактов из различных источников"""
@@ -29,187 +1519,926 @@ class RussianFactsAPI:
     @staticmethod
     def get_random_fact() -> str:
         """Возвращает случайный интересный факт на русском"""
-        facts = [
-            "Мозг человека на 60% состоит из жира.",
-            "В Японии есть специальные звукопоглощающие столбы, чтобы заглушить шум от поездов.",
-            "Сердце креветки находится в ее голове.",
-            "Кошки могут издавать более 100 различных звуков, а собаки только около 10.",
-            "В Швейцарии запрещено мыть машину по воскресеньям.",
-            "Мед никогда не портится. Археологи находили съедобный мед в гробницах фараонов.",
-            "У осьминога три сердца.",
-            "В Исландии нет комаров.",
-            "Человек моргает примерно 15-20 раз в минуту, то есть около 12 миллионов раз в год.",
-            "Язык жирафа может достигать длины 45 см.",
-            "Свет от Солнца до Земли доходит за 8 минут 20 секунд.",
-            "В Древнем Риме моча использовалась как чистящее средство для одежды.",
-            "Пингвины могут прыгать в высоту до 2 метров.",
-            "В России находится самое глубокое озеро в мире - Байкал.",
-            "Ленивцы спускаются с деревьев только раз в неделю, чтобы сходить в туалет.",
-            "У улитки около 25 000 зубов.",
-            "Финляндия - самая счастливая страна в мире (по данным World Happiness Report).",
-            "Человеческое тело содержит достаточно железа, чтобы сделать гвоздь длиной 7,5 см.",
-            "В Японии больше всего в мире торговых автоматов - около 5 миллионов.",
-            "Земля - единственная планета, не названная в честь бога."
-        ]
-        return random.choice(facts)
+        return random.choice(RANDOM_FACTS)
 
     @staticmethod
     def get_topics() -> List[str]:
         """Возвращает список доступных тем"""
-        return ["животные", "наука", "география", "история", "технологии", "культура", "спорт", "кухня", "здоровье"]
+        return list(TOPICS)
 
     @staticmethod
     def get_fact_by_topic(topic: str) -> Optional[str]:
         """Возвращает случайный факт по заданной теме"""
-        topic_facts = {
-            "животные": [
-                "У осьминога три сердца.",
-                "Сердце креветки находится в ее голове.",
-                "Кошки проводят около 70% своей жизни во сне.",
-                "Улитки могут спать до 3 лет.",
-                "Язык жирафа может достигать длины 45 см.",
-                "Пингвины могут прыгать в высоту до 2 метров.",
-                "Ленивцы спускаются с деревьев только раз в неделю.",
-                "У улитки около 25 000 зубов.",
-                "Колибри - единственная птица, которая умеет летать назад.",
-                "Слоны могут учуять воду на расстоянии до 5 км."
-            ],
-            "наука": [
-                "Мозг человека на 60% состоит из жира.",
-                "Свет от Солнца до Земли доходит за 8 минут 20 секунд.",
-                "Человек моргает примерно 15-20 раз в минуту.",
-                "В человеческом теле около 37 триллионов клеток.",
-                "Кости человека в 4 раза прочнее бетона.",
-                "Земля вращается со скоростью около 1670 км/ч на экваторе.",
-                "Атомы на 99,9999999999999% состоят из пустого пространства.",
-                "У человека и банана около 50% общих генов.",
-                "Венера - единственная планета, вращающаяся против часовой стрелки.",
-                "Один год на Венере длится 225 земных дней."
-            ],
-            "география": [
-                "В России находится самое глубокое озеро в мире - Байкал.",
-                "В Исландии нет комаров.",
-                "Финляндия - самая счастливая страна в мире.",
-                "В Японии больше всего в мире торговых автоматов.",
-                "Канада имеет самую длинную береговую линию в мире.",
-                "В Сибири находится 25% мировых лесов.",
-                "Россия - самая большая страна в мире по площади.",
-                "В Чили находится самая сухая пустыня в мире - Атакама.",
-                "В Австралии больше кенгуру, чем людей.",
-                "В Гренландии самое большое количество айсбергов."
-            ],
-            "история": [
-                "В Древнем Риме моча использовалась как чистящее средство.",
-                "Наполеон был атакован кроликами во время охоты.",
-                "Викинги использовали птиц для навигации в море.",
-                "В Древнем Египте фараоны носили накладные бороды.",
-                "Первые ножницы были изобретены в Древнем Риме.",
-                "В Средневековье пиво было безопаснее воды.",
-                "Древние греки использовали камни вместо туалетной бумаги.",
-                "В XIX веке кетчуп продавался как лекарство.",
-                "Клеопатра жила ближе к изобретению iPhone, чем к строительству пирамид.",
-                "В Древнем Китае использовали бумажные деньги уже в VII веке."
-            ],
-            "технологии": [
-                "Первый компьютерный вирус был создан в 1983 году.",
-                "Пароль '123456' до сих пор один из самых популярных.",
-                "Первая компьютерная мышь была сделана из дерева.",
-                "Самый первый сайт в интернете до сих пор работает.",
-                "Первая камера на телефоне появилась в 2000 году.",
-                "Wi-Fi был изобретен в 1991 году.",
-                "Первое SMS было отправлено в 1992 году.",
-                "YouTube был основан тремя бывшими сотрудниками PayPal.",
-                "Первая игра в истории - 'Tennis for Two' (1958).",
-                "Самый первый домен в интернете - symbolics.com."
-            ],
-            "культура": [
-                "В Швейцарии запрещено мыть машину по воскресеньям.",
-                "В Японии есть специальные звукопоглощающие столбы.",
-                "В Саудовской Аравии нет кинотеатров до 2018 года.",
-                "Во Франции запрещено называть свинью Наполеоном.",
-                "В Сингапуре запрещено жевать жвачку.",
-                "В Италии больше объектов Всемирного наследия ЮНЕСКО, чем в любой другой стране.",
-                "В Индии больше всего в мире вегетарианцев.",
-                "В Бразилии говорят на португальском, а не на испанском.",
-                "В Канаде самый высокий уровень образования в мире.",
-                "В Японии самая высокая продолжительность жизни."
-            ],
-            "спорт": [
-                "Футбол - самый популярный вид спорта в мире.",
-                "Баскетбол был изобретен в 1891 году в США.",
-                "Волейбол был изобретен в 1895 году.",
-                "Хоккей с шайбой появился в Канаде в XIX веке.",
-                "Теннис зародился во Франции в XII веке.",
-                "Плавание было включено в Олимпийские игры в 1896 году.",
-                "Бег на 100 метров - самая короткая дистанция в легкой атлетике.",
-                "Шахматы - один из старейших видов спорта.",
-                "Серфинг был изобретен в Полинезии 4000 лет назад.",
-                "Скалолазание стало олимпийским видом спорта в 2020 году."
-            ],
-            "кухня": [
-                "Мед никогда не портится.",
-                "Помидор - это фрукт, а не овощ.",
-                "Морковь изначально была фиолетовой.",
-                "Кетчуп изначально был рыбным соусом.",
-                "Шоколад был валютой у древних майя.",
-                "Сыр был изобретен более 7000 лет назад.",
-                "Чай - второй по популярности напиток после воды.",
-                "Кофе был открыт в Эфиопии в IX веке.",
-                "Соль когда-то ценилась на вес золота.",
-                "Яблоки плавают, потому что на 25% состоят из воздуха."
-            ],
-            "здоровье": [
-                "Смех укрепляет иммунную систему.",
-                "Ходьба пешком продлевает жизнь.",
-                "Сон укрепляет память.",
-                "Вода составляет около 60% веса тела взрослого человека.",
-                "Человек делает около 20 000 вдохов в день.",
-                "Улыбка задействует 17 мышц лица.",
-                "Человек теряет около 50-100 волос в день.",
-                "Ногти на руках растут в 4 раза быстрее, чем на ногах.",
-                "Сердце перекачивает около 7500 литров крови в день.",
-                "Человек может прожить без воды около 3 дней."
-            ]
-        }
-
-        if topic.lower() in topic_facts:
-            return random.choice(topic_facts[topic.lower()])
+        topic_facts = TOPIC_FACTS.get(topic.lower())
+        if topic_facts:
+            return random.choice(topic_facts)
         return None
 
 
+class FactDeck:
+    """
+    Колода для выдачи фактов без повторов.
+
+    Перестановка индексов не хранится: состояние колоды — это список [low, high, seed, cursor],
+    колода раздает индексы из [low, high). Очередная карта вычисляется псевдослучайной
+    перестановкой (сеть Фейстеля с «обходом цикла»), поэтому каждая выдача стоит O(1),
+    а за high - low выдач каждый индекс встречается ровно один раз.
+    """
+
+    ROUNDS = 4
+
+    @staticmethod
+    def _mix(value: int, key: int) -> int:
+        """Перемешивает 32-битное значение с ключом"""
+        value = ((value ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+        value ^= value >> 15
+        value = (value * 0x85EBCA77) & 0xFFFFFFFF
+        value ^= value >> 13
+        return value
+
+    @classmethod
+    def _permute(cls, position: int, size: int, seed: int) -> int:
+        """Возвращает индекс карты на заданной позиции колоды"""
+        half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        mask = (1 << half_bits) - 1
+        value = position
+        while True:
+            left, right = value >> half_bits, value & mask
+            for round_no in range(cls.ROUNDS):
+                left, right = right, left ^ (cls._mix(right, seed + round_no) & mask)
+            value = (left << half_bits) | right
+            # Область перестановки не больше 4 * size, поэтому в среднем хватает пары итераций
+            if value < size:
+                return value
+
+    @classmethod
+    def draw(cls, deck: Optional[List[int]], size: int) -> Tuple[int, List[int]]:
+        """
+        Вытягивает следующую карту из набора индексов [0, size). Если набор вырос, уже
+        розданные карты не сбрасываются: после текущей колоды раздаются добавленные
+        индексы [high, size), и только затем колода перетасовывается целиком.
+        Уменьшившийся набор (или поврежденное состояние) начинает новую колоду.
+        """
+        if deck and len(deck) == 3:
+            # Прежний формат [size, seed, cursor]
+            deck = [0, *deck]
+        if not deck or len(deck) != 4 or not 0 <= deck[0] < deck[1] <= size or deck[3] > deck[1] - deck[0]:
+            deck = [0, size, random.getrandbits(32), 0]
+        low, high, seed, cursor = deck
+        if cursor >= high - low:
+            low, high = (high, size) if high < size else (0, size)
+            seed, cursor = random.getrandbits(32), 0
+        return low + cls._permute(cursor, high - low, seed), [low, high, seed, cursor + 1]
+
+
+class FenwickTree:
+    """Дерево Фенвика над весами: изменение веса и выбор индекса пропорционально весу за O(log n)"""
+
+    __slots__ = ("_tree", "_weights", "_top", "total")
+
+    def __init__(self, weights: Iterable[float] = ()):
+        self._weights = list(weights)
+        tree = [0.0] * (len(self._weights) + 1)
+        # Построение за O(n): каждый узел передает свою сумму родителю
+        for i, weight in enumerate(self._weights, 1):
+            tree[i] += weight
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._top = 1 << (len(self._weights).bit_length() - 1) if self._weights else 0
+        self.total = sum(self._weights)
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    def weight(self, index: int) -> float:
+        return self._weights[index]
+
+    def append(self, weight: float):
+        self._weights.append(weight)
+        i = len(self._weights)
+        # Узел i покрывает (i - lowbit(i), i]: его вес плюс узлы i-1, i-2, i-4, ...
+        node = weight
+        step = 1
+        while step < (i & -i):
+            node += self._tree[i - step]
+            step <<= 1
+        self._tree.append(node)
+        if i >= 2 * self._top:
+            self._top = max(1, 2 * self._top)
+        self.total += weight
+
+    def update(self, index: int, weight: float):
+        delta = weight - self._weights[index]
+        self._weights[index] = weight
+        self.total += delta
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def find(self, value: float) -> int:
+        """Индекс, на который приходится value в накопленных суммах весов"""
+        tree = self._tree
+        size = len(tree)
+        position = 0
+        step = self._top
+        while step:
+            following = position + step
+            if following < size and tree[following] <= value:
+                position = following
+                value -= tree[following]
+            step >>= 1
+        # Из-за накопленной погрешности value может оказаться чуть за последним весом
+        return min(position, len(self._weights) - 1)
+
+    def sample(self) -> int:
+        return self.find(random.random() * self.total)
+
+
+class WeightedFactSelector:
+    """
+    Взвешенный выбор фактов: вес = (1 + popularity_weight * ln(1 + просмотры)), а недавно
+    добавленные факты в течение recency_window еще умножаются на recency_boost.
+    На каждую тему — дерево Фенвика по позициям фактов, над ними — дерево по суммам тем,
+    так что выбор и изменение веса стоят O(log n) без пересчета всей базы.
+    Уже показанный пользователю факт принимается с вероятностью 1/unseen_boost (выборка
+    с отклонением), что равносильно увеличению веса непоказанных фактов в unseen_boost раз.
+    """
+
+    def __init__(self, views_file: Optional[str] = FACT_VIEWS_FILE,
+                 popularity_weight: float = SELECTION_POPULARITY_WEIGHT,
+                 recency_boost: float = SELECTION_RECENCY_BOOST,
+                 recency_window: float = SELECTION_RECENCY_WINDOW,
+                 unseen_boost: float = SELECTION_UNSEEN_BOOST):
+        self.views_file = views_file
+        self.popularity_weight = popularity_weight
+        self.recency_boost = recency_boost
+        self.recency_window = recency_window
+        self.unseen_boost = max(1.0, unseen_boost)
+        # Просмотры по позициям фактов: тема -> {позиция: число просмотров}
+        self.views: Dict[str, Dict[int, int]] = self._load_views()
+        self.views_dirty = False
+        self._topics: List[str] = []
+        self._topic_numbers: Dict[str, int] = {}
+        self._trees: List[FenwickTree] = []
+        self._topic_tree = FenwickTree()
+        # Факты с бустом новизны: (тема, позиция) -> момент окончания; очередь окончаний по времени
+        self._recent: Dict[Tuple[str, int], float] = {}
+        self._recent_queue: deque = deque()
+
+    def _load_views(self) -> Dict[str, Dict[int, int]]:
+        if not self.views_file or not os.path.exists(self.views_file):
+            return {}
+        try:
+            with open(self.views_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return {topic: {int(offset): count for offset, count in counts.items()} for topic, counts in data.items()}
+        except (IOError, ValueError, AttributeError) as e:
+            logger.error(f"Ошибка при загрузке просмотров фактов: {e}")
+            return {}
+
+    def views_snapshot(self) -> Optional[Dict]:
+        """Снимок просмотров для записи (None — изменений нет)"""
+        if not self.views_dirty or not self.views_file:
+            return None
+        self.views_dirty = False
+        return {topic: {str(offset): count for offset, count in counts.items()} for topic, counts in self.views.items()}
+
+    def write_views(self, snapshot: Dict):
+        _atomic_write_json(self.views_file, snapshot)
+
+    def reset_views(self):
+        """Забывает просмотры (после перестановки фактов их позиции больше не верны)"""
+        self.views = {}
+        self.views_dirty = True
+
+    def build(self, facts_data: Mapping[str, List[str]]) -> "WeightedFactSelector":
+        """Возвращает селектор с деревьями весов для данных (настройки и просмотры общие)"""
+        selector = WeightedFactSelector.__new__(WeightedFactSelector)
+        selector.__dict__.update(self.__dict__)
+        selector._topics = list(facts_data)
+        selector._topic_numbers = {topic: number for number, topic in enumerate(selector._topics)}
+        selector._trees = [
+            FenwickTree(selector._weight(topic, offset) for offset in range(len(facts_data[topic])))
+            for topic in selector._topics
+        ]
+        selector._topic_tree = FenwickTree(tree.total for tree in selector._trees)
+        selector._recent = {}
+        selector._recent_queue = deque()
+        return selector
+
+    def _weight(self, topic: str, offset: int) -> float:
+        weight = 1.0
+        views = self.views.get(topic, {}).get(offset)
+        if views:
+            weight += self.popularity_weight * math.log1p(views)
+        if (topic, offset) in self._recent:
+            weight *= self.recency_boost
+        return weight
+
+    def _refresh(self, topic: str, offset: int):
+        number = self._topic_numbers[topic]
+        tree = self._trees[number]
+        tree.update(offset, self._weight(topic, offset))
+        self._topic_tree.update(number, tree.total)
+
+    def add(self, topic: str, offset: int, recent: bool = False):
+        """Добавляет факт в конец темы; recent — включить буст новизны"""
+        number = self._topic_numbers.get(topic)
+        if number is None:
+            number = self._topic_numbers[topic] = len(self._topics)
+            self._topics.append(topic)
+            self._trees.append(FenwickTree())
+            self._topic_tree.append(0.0)
+        if recent:
+            expires = time.time() + self.recency_window
+            self._recent[(topic, offset)] = expires
+            self._recent_queue.append((expires, topic, offset))
+        tree = self._trees[number]
+        tree.append(self._weight(topic, offset))
+        self._topic_tree.update(number, tree.total)
+
+    def record_view(self, topic: str, offset: int):
+        """Учитывает просмотр факта: его вес (популярность) растет"""
+        counts = self.views.setdefault(topic, {})
+        counts[offset] = counts.get(offset, 0) + 1
+        self.views_dirty = True
+        if topic in self._topic_numbers:
+            self._refresh(topic, offset)
+
+    def total(self, topic: Optional[str] = None) -> float:
+        """Сумма весов всех фактов или фактов темы"""
+        if topic is None:
+            return self._topic_tree.total
+        number = self._topic_numbers.get(topic)
+        return self._trees[number].total if number is not None else 0.0
+
+    def _expire_recent(self, now: float):
+        while self._recent_queue and self._recent_queue[0][0] <= now:
+            expires, topic, offset = self._recent_queue.popleft()
+            if self._recent.get((topic, offset)) == expires:
+                del self._recent[(topic, offset)]
+                self._refresh(topic, offset)
+
+    def draw(self, topic: Optional[str] = None,
+             is_seen: Optional[Callable[[str, int], bool]] = None) -> Optional[Tuple[str, int]]:
+        """Выбирает (тема, позиция) по весам среди всех фактов или фактов темы"""
+        if self._recent_queue:
+            self._expire_recent(time.time())
+        if topic is None:
+            if self._topic_tree.total <= 0:
+                return None
+        else:
+            number = self._topic_numbers.get(topic)
+            if number is None or self._trees[number].total <= 0:
+                return None
+
+        candidate = None
+        # Если пользователь видел почти все, после нескольких отклонений берем последний вариант
+        for _ in range(int(self.unseen_boost * 4) + 1):
+            chosen = number if topic is not None else self._topic_tree.sample()
+            tree = self._trees[chosen]
+            if not len(tree):
+                continue
+            candidate = (self._topics[chosen], tree.sample())
+            if is_seen is None or not is_seen(*candidate) or random.random() * self.unseen_boost < 1:
+                break
+        return candidate
+
+
+class FactSearchIndex:
+    """
+    Инвертированный индекс для полнотекстового поиска по фактам с ранжированием BM25.
+    Слова нормализуются: нижний регистр, ё -> е и отсечение типичных окончаний.
+    Документы нумеруются так же, как плоский индекс фактов FactsDataManager.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    TOKEN_RE = re.compile(r"[а-яa-z0-9]+")
+    # Окончания отсортированы по убыванию длины, чтобы отсекать самое длинное
+    ENDINGS = tuple(sorted((
+        "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "иях", "ях", "ах",
+        "ов", "ев", "ей", "ой", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ом",
+        "ем", "ам", "ям", "ия", "ью", "ть", "ся", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+    ), key=len, reverse=True))
+    MIN_STEM = 3
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_lengths: List[int] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def state(self) -> Tuple:
+        return self._postings, self._doc_lengths, self._total_length
+
+    def restore(self, state: Tuple):
+        self._postings, self._doc_lengths, self._total_length = state
+
+    @classmethod
+    def stem(cls, word: str) -> str:
+        """Отсекает окончание, оставляя основу не короче MIN_STEM букв"""
+        for ending in cls.ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= cls.MIN_STEM:
+                return word[:-len(ending)]
+        return word
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """Разбивает текст на нормализованные термы"""
+        return [cls.stem(word) for word in cls.TOKEN_RE.findall(text.lower().replace('ё', 'е'))]
+
+    def add(self, text: str) -> int:
+        """Добавляет документ в индекс и возвращает его номер"""
+        doc_id = len(self._doc_lengths)
+        terms = self.tokenize(text)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+        self._doc_lengths.append(len(terms))
+        self._total_length += len(terms)
+        return doc_id
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """Возвращает номера документов с наибольшей релевантностью запросу"""
+        doc_count = len(self._doc_lengths)
+        if not doc_count:
+            return []
+
+        average_length = self._total_length / doc_count or 1
+        scores: Dict[int, float] = {}
+        for term in set(self.tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                norm = self.K1 * (1 - self.B + self.B * self._doc_lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+class FactDeduplicator:
+    """
+    Индекс для поиска дубликатов фактов.
+
+    Точные дубликаты (с точностью до регистра, ё и пунктуации) находятся по хэшу
+    нормализованного текста. Близкие дубликаты — через MinHash по основам значимых
+    слов и парам соседних основ и LSH-корзины: кандидаты из общих корзин проверяются
+    точным коэффициентом Жаккара. Сами тексты индекс не хранит и получает их по номеру
+    через text_of.
+    """
+
+    # 24 полосы по 4 строки: пара со сходством 0.8 попадает в общую корзину почти
+    # наверняка, а со сходством 0.3 — лишь в ~18% случаев
+    BANDS = 24
+    ROWS = 4
+    PRIME = (1 << 61) - 1
+
+    # Служебные слова: общие предлоги и связки сильно завышают сходство разных фактов
+    STOPWORDS = frozenset((
+        "а", "без", "бы", "был", "была", "были", "было", "быть", "в", "вот", "во", "все", "всего", "где",
+        "да", "для", "до", "его", "ее", "если", "есть", "еще", "же", "за", "и", "из", "или", "им", "их",
+        "к", "как", "когда", "ко", "который", "которая", "которое", "которые", "ли", "между", "на", "над",
+        "не", "нет", "ни", "но", "о", "об", "около", "он", "она", "они", "оно", "от", "по", "под", "при",
+        "про", "с", "свой", "своей", "своих", "со", "так", "также", "то", "только", "у", "уже", "чем",
+        "что", "чтобы", "это", "эта", "этот", "эти", "является",
+    ))
+
+    def __init__(self, text_of: Callable[[int], str], threshold: float = DUPLICATE_THRESHOLD):
+        self.text_of = text_of
+        self.threshold = threshold
+        rng = random.Random(0x5EED)
+        self._hash_params = [
+            (rng.randrange(1, self.PRIME), rng.randrange(self.PRIME))
+            for _ in range(self.BANDS * self.ROWS)
+        ]
+        self._exact: Dict[bytes, int] = {}
+        self._buckets: Dict[Tuple[int, int], List[int]] = {}
+        self._count = 0
+
+    def state(self) -> Tuple:
+        return self._exact, self._buckets, self._count
+
+    def restore(self, state: Tuple):
+        self._exact, self._buckets, self._count = state
+
+    @staticmethod
+    def _exact_key(text: str) -> bytes:
+        normalized = ' '.join(FactSearchIndex.TOKEN_RE.findall(text.lower().replace('ё', 'е')))
+        return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+    @classmethod
+    def _shingles(cls, text: str) -> set:
+        """Основы значимых слов и пары соседних основ"""
+        stems = [
+            FactSearchIndex.stem(word)
+            for word in FactSearchIndex.TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+            if word not in cls.STOPWORDS
+        ]
+        return set(stems).union(f"{first} {second}" for first, second in zip(stems, stems[1:]))
+
+    def _band_keys(self, shingles: set) -> List[Tuple[int, int]]:
+        """Считает MinHash-подпись и возвращает ключи LSH-корзин"""
+        values = [
+            int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+            for shingle in shingles
+        ]
+        signature = [min((a * value + b) % self.PRIME for value in values) for a, b in self._hash_params]
+        return [
+            (band, hash(tuple(signature[band * self.ROWS:(band + 1) * self.ROWS])))
+            for band in range(self.BANDS)
+        ]
+
+    def find(self, text: str) -> Optional[Tuple[int, float]]:
+        """Возвращает (номер, сходство) самого похожего известного факта или None"""
+        exact = self._exact.get(self._exact_key(text))
+        if exact is not None:
+            return exact, 1.0
+
+        shingles = self._shingles(text)
+        if not shingles:
+            return None
+
+        candidates = set()
+        for key in self._band_keys(shingles):
+            candidates.update(self._buckets.get(key, ()))
+
+        best = None
+        for doc_id in candidates:
+            other = self._shingles(self.text_of(doc_id))
+            similarity = len(shingles & other) / len(shingles | other)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (doc_id, similarity)
+        return best
+
+    def add(self, text: str) -> int:
+        """Добавляет факт в индекс и возвращает его номер"""
+        doc_id = self._count
+        self._count += 1
+        self._exact.setdefault(self._exact_key(text), doc_id)
+        shingles = self._shingles(text)
+        if shingles:
+            for key in self._band_keys(shingles):
+                self._buckets.setdefault(key, []).append(doc_id)
+        return doc_id
+
+
+class FactPrefixIndex:
+    """
+    Префиксный индекс для инлайн-поиска: отсортированный список пар (слово, номер факта)
+    по словам фактов и названиям их тем. Поиск по префиксу — бинарный поиск и
+    проход по непрерывному диапазону, без обращения к диску. Тексты и темы фактов
+    индекс получает по номеру через text_of и topic_of.
+    """
+
+    def __init__(self, text_of: Callable[[int], str], topic_of: Callable[[int], str]):
+        self.text_of = text_of
+        self.topic_of = topic_of
+        self._entries: List[Tuple[str, int]] = []
+
+    def state(self) -> List[Tuple[str, int]]:
+        return self._entries
+
+    def restore(self, state: List[Tuple[str, int]]):
+        self._entries = state
+
+    @staticmethod
+    def normalize(text: str) -> List[str]:
+        """Разбивает текст на слова в нижнем регистре с заменой ё на е"""
+        return FactSearchIndex.TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+    def build(self, facts: List[Tuple[int, str, str]]):
+        """Строит индекс по списку (номер, тема, факт)"""
+        self._entries = sorted(
+            (word, doc_id)
+            for doc_id, topic, fact in facts
+            for word in set(self.normalize(fact)) | set(self.normalize(topic))
+        )
+
+    def add(self, doc_id: int, topic: str, fact: str):
+        """Добавляет факт в индекс"""
+        for word in set(self.normalize(fact)) | set(self.normalize(topic)):
+            entry = (word, doc_id)
+            self._entries.insert(bisect_left(self._entries, entry), entry)
+
+    def search(self, query: str, limit: int, deadline: float) -> List[int]:
+        """
+        Возвращает номера фактов, где каждое слово запроса является префиксом какого-либо слова.
+        Поиск прекращается по достижении limit результатов или момента deadline (time.perf_counter).
+        """
+        words = self.normalize(query)
+        if not words:
+            return []
+
+        # Самое длинное слово дает самый узкий диапазон в индексе
+        anchor = max(words, key=len)
+        others = [word for word in words if word != anchor]
+        entries = self._entries
+        results: List[int] = []
+        seen = set()
+
+        position = bisect_left(entries, (anchor,))
+        while position < len(entries):
+            word, doc_id = entries[position]
+            position += 1
+            if not word.startswith(anchor):
+                break
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+
+            if others:
+                # Как и в индексе, слова запроса могут совпадать и со словами темы
+                doc_words = self.normalize(self.text_of(doc_id)) + self.normalize(self.topic_of(doc_id))
+                if not all(any(doc_word.startswith(other) for doc_word in doc_words) for other in others):
+                    continue
+
+            results.append(doc_id)
+            if len(results) >= limit or time.perf_counter() > deadline:
+                break
+        return results
+
+
+class TTLCache:
+    """LRU-кэш с ограниченным размером и временем жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Возвращает значение или None, если записи нет или она устарела"""
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        """Сохраняет значение, вытесняя самые давно использованные записи"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class UserRecord:
+    """
+    Настройки одного пользователя в кэше. Известные ключи хранятся в слотах,
+    редкие — в словаре extra, который создается только при необходимости.
+    """
+
+    FIELDS = frozenset(("favorite_topic", "subscribed", "decks", "seen", "stats"))
+    __slots__ = ("favorite_topic", "subscribed", "decks", "seen", "stats", "extra", "expires")
+
+    def __init__(self, user_prefs: Optional[Mapping] = None):
+        self.extra: Optional[Dict] = None
+        self.expires = 0.0
+        if user_prefs:
+            for key, value in user_prefs.items():
+                self.set(key, value)
+
+    def get(self, key: str, default=None):
+        if key in self.FIELDS:
+            # Незаполненный слот — настройка не задана
+            return getattr(self, key, default)
+        return self.extra.get(key, default) if self.extra else default
+
+    def set(self, key: str, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+
+class LoadedUserRecord:
+    """
+    Запись пользователя поверх настроек, целиком загруженных в память: читает и меняет
+    их на месте, поэтому настройки не дублируются в кэше записей.
+    """
+
+    __slots__ = ("preferences", "user_id_str")
+
+    def __init__(self, preferences: Dict, user_id_str: str):
+        self.preferences = preferences
+        self.user_id_str = user_id_str
+
+    def get(self, key: str, default=None):
+        user_prefs = self.preferences.get(self.user_id_str)
+        return user_prefs.get(key, default) if user_prefs else default
+
+    def set(self, key: str, value):
+        self.preferences.setdefault(self.user_id_str, {})[key] = value
+
+
+class UserRecordCache:
+    """
+    LRU-кэш записей пользователей с ограниченным размером. Время жизни отсчитывается
+    от последнего обращения, поэтому порядок LRU совпадает с порядком устаревания и
+    expire снимает устаревшие записи с начала. Вытесненная запись передается в on_evict.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, on_evict: Optional[Callable[[str, UserRecord], None]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._records: "OrderedDict[str, UserRecord]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id_str: str) -> Optional[UserRecord]:
+        """Возвращает запись, продлевая ее жизнь, или None, если ее нет или она устарела"""
+        record = self._records.get(user_id_str)
+        now = time.monotonic()
+        if record is None or record.expires < now:
+            if record is not None:
+                self._evict(user_id_str)
+            self.misses += 1
+            return None
+        record.expires = now + self.ttl
+        self._records.move_to_end(user_id_str)
+        self.hits += 1
+        return record
+
+    def put(self, user_id_str: str, record: UserRecord):
+        """Добавляет запись, вытесняя самые давно использованные сверх maxsize"""
+        record.expires = time.monotonic() + self.ttl
+        self._records[user_id_str] = record
+        self._records.move_to_end(user_id_str)
+        while len(self._records) > self.maxsize:
+            self._evict(next(iter(self._records)))
+
+    def expire(self) -> int:
+        """Вытесняет устаревшие записи, возвращает их число"""
+        now = time.monotonic()
+        expired = 0
+        while self._records:
+            user_id_str, record = next(iter(self._records.items()))
+            if record.expires >= now:
+                break
+            self._evict(user_id_str)
+            expired += 1
+        return expired
+
+    def _evict(self, user_id_str: str):
+        record = self._records.pop(user_id_str)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(user_id_str, record)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
 class FactsDataManager:
     """Класс для управления данными фактов"""
 
-    def __init__(self, data_file: str = "russian_facts.json"):
+    def __init__(self, data_file: str = "russian_facts.json", storage: Optional[FactsStorage] = None,
+                 selector: Optional[WeightedFactSelector] = None, snapshot_file: Optional[str] = FACTS_SNAPSHOT):
         self.data_file = data_file
+        self.storage = storage or _file_facts_storage(data_file)
         self.api = RussianFactsAPI()
-        self.facts_data = self._load_facts_data()
+        # Снимок для быстрого запуска; записывает его только процесс-владелец файла фактов
+        self.snapshot = FactsSnapshot(snapshot_file) if snapshot_file else None
+        self.write_snapshot = True
+        # Взвешенный выбор фактов (None — равновероятный выбор и колоды без повторов)
+        self.selector = selector
+        # Защищает facts_data и индекс от одновременного изменения и сохранения
+        self._lock = threading.RLock()
+        self._dirty = False
+        # Факты, добавленные с момента последнего сохранения
+        self._pending: List[Tuple[str, str]] = []
+        # Версия набора тем: увеличивается при появлении новой темы
+        self.topics_version = 0
+        with startup_phase("facts_load"):
+            self.facts_data = self._load_facts_data()
+        self._storage_version = self.storage.version()
+        # Плоский индекс (тема, позиция) по всем фактам для равномерного выбора за O(1)
+        self._fact_index: List[Tuple[str, int]] = []
+        # Поисковые индексы (полнотекстовый, дубликатов, префиксный) строятся лениво или в фоне
+        self._text_indexes: Optional[Tuple] = None
+        self._index_generation = 0
+        # Факты встроенного каталога, которых еще нет в базе: тема -> факты (считаются лениво)
+        self._catalog_missing: Optional[Dict[str, List[str]]] = None
+        with startup_phase("facts_index"):
+            self._set_indexes(self._build_indexes(self.facts_data, self._snapshot_fact_index()))
+        # Индексы из снимка подходят только к данным, с которыми он был открыт
+        self._snapshot_generation = self._index_generation
+        if self.snapshot is not None:
+            self.snapshot.facts_data = self.snapshot.fact_index = None
+        # Асинхронные сохранения: одновременные запросы объединяются в одну запись
+        self._saves = CoalescingSaver("facts", self._save_snapshot)
+        self._view_saves = CoalescingSaver("fact_views", self._save_views_snapshot)
 
     def _load_facts_data(self) -> Dict:
-        """Загружает факты из файла или создает новый"""
+        """Загружает факты из снимка или хранилища, либо создает начальный набор"""
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            else:
-                # Создаем начальную структуру данных
-                data = {}
-                for topic in self.api.get_topics():
-                    fact = self.api.get_fact_by_topic(topic)
-                    if fact:
-                        data[topic] = [fact]
-
-                # Добавляем случайные факты
-                data["случайные"] = [self.api.get_random_fact() for _ in range(10)]
-
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
+            if self.snapshot is not None and self.snapshot.open(self.storage.version()) \
+                    and self.snapshot.facts_data is not None:
+                return self.snapshot.facts_data
+
+            data = self.storage.load()
+            if data is not None:
                 return data
 
-        except (IOError, json.JSONDecodeError) as e:
+            # Создаем начальную структуру данных
+            data = {}
+            for topic in self.api.get_topics():
+                fact = self.api.get_fact_by_topic(topic)
+                if fact:
+                    data[topic] = [fact]
+
+            # Добавляем случайные факты
+            data["случайные"] = [self.api.get_random_fact() for _ in range(10)]
+
+            self.storage.save(data, [(topic, fact) for topic, facts in data.items() for fact in facts])
+            return data
+
+        except (IOError, json.JSONDecodeError, sqlite3.Error) as e:
             logger.error(f"Ошибка при загрузке данных: {e}")
             return {"случайные": [self.api.get_random_fact()]}
 
+    def _snapshot_fact_index(self) -> Optional[List[Tuple[str, int]]]:
+        """Плоский индекс из снимка, если он подходит к загруженным данным"""
+        if self.snapshot is None or self.snapshot.fact_index is None:
+            return None
+        fact_index = self.snapshot.fact_index
+        if len(fact_index) != sum(len(topic_facts) for topic_facts in self.facts_data.values()):
+            return None
+        return fact_index
+
+    def _rebuild_index(self):
+        """Строит плоский индекс фактов по загруженным данным; поисковые индексы построятся лениво"""
+        self._set_indexes(self._build_indexes(self.facts_data))
+
+    def _build_indexes(self, facts_data: Dict, fact_index: Optional[List[Tuple[str, int]]] = None) -> Tuple:
+        """Строит плоский индекс и селектор по данным, не трогая текущие (можно вызывать из другого потока)"""
+        if fact_index is None:
+            fact_index = [
+                (topic, offset)
+                for topic, topic_facts in facts_data.items()
+                for offset in range(len(topic_facts))
+            ]
+        selector = self.selector.build(facts_data) if self.selector is not None else None
+        return fact_index, selector
+
+    def _set_indexes(self, indexes: Tuple, text_indexes: Optional[Tuple] = None):
+        self._fact_index, self.selector = indexes
+        self._text_indexes = text_indexes
+        self._catalog_missing = None
+        self._index_generation += 1
+
+    def _build_text_indexes(self, facts_data: Dict, fact_index: List[Tuple[str, int]], count: int) -> Tuple:
+        """Строит поисковые индексы по первым count фактам плоского индекса"""
+        search_index = FactSearchIndex()
+        dedup_index = FactDeduplicator(self._fact_text)
+        prefix_index = FactPrefixIndex(self._fact_text, self._fact_topic)
+        for topic, offset in fact_index[:count]:
+            fact = facts_data[topic][offset]
+            search_index.add(fact)
+            dedup_index.add(fact)
+        prefix_index.build([
+            (doc_id, topic, facts_data[topic][offset])
+            for doc_id, (topic, offset) in enumerate(fact_index[:count])
+        ])
+        return search_index, dedup_index, prefix_index
+
+    def _restore_text_indexes(self, state: Tuple) -> Tuple:
+        """Восстанавливает поисковые индексы из состояния, сохраненного в снимке"""
+        search_index = FactSearchIndex()
+        dedup_index = FactDeduplicator(self._fact_text)
+        prefix_index = FactPrefixIndex(self._fact_text, self._fact_topic)
+        for index, index_state in zip((search_index, dedup_index, prefix_index), state):
+            index.restore(index_state)
+        return search_index, dedup_index, prefix_index
+
+    def _load_text_indexes(self, from_snapshot: bool, facts_data: Dict, fact_index: List[Tuple[str, int]],
+                           count: int) -> Tuple:
+        """Читает поисковые индексы из снимка или строит их (можно вызывать из другого потока)"""
+        with startup_phase("facts_text_indexes"):
+            state = self.snapshot.load_indexes() if from_snapshot and self.snapshot is not None else None
+            if state is not None:
+                return self._restore_text_indexes(state)
+            return self._build_text_indexes(facts_data, fact_index, count)
+
+    def _install_text_indexes(self, indexes: Tuple):
+        """Досчитывает в индексы факты, добавленные во время их построения, и включает их"""
+        search_index, dedup_index, prefix_index = indexes
+        for doc_id in range(len(search_index), len(self._fact_index)):
+            topic, offset = self._fact_index[doc_id]
+            fact = self.facts_data[topic][offset]
+            search_index.add(fact)
+            dedup_index.add(fact)
+            prefix_index.add(doc_id, topic, fact)
+        self._text_indexes = indexes
+
+    def _get_text_indexes(self) -> Tuple:
+        indexes = self._text_indexes
+        if indexes is None:
+            with self._lock:
+                if self._text_indexes is None:
+                    # Индекс понадобился раньше, чем закончилась фоновая подготовка
+                    self._install_text_indexes(self._load_text_indexes(
+                        self._index_generation == self._snapshot_generation,
+                        self.facts_data, self._fact_index, len(self._fact_index)))
+                indexes = self._text_indexes
+        return indexes
+
+    @property
+    def search_index(self) -> FactSearchIndex:
+        return self._get_text_indexes()[0]
+
+    @property
+    def dedup_index(self) -> FactDeduplicator:
+        return self._get_text_indexes()[1]
+
+    @property
+    def prefix_index(self) -> FactPrefixIndex:
+        return self._get_text_indexes()[2]
+
+    async def warm_up(self):
+        """Читает из снимка или строит поисковые индексы в пуле потоков, не задерживая запуск"""
+        if self._text_indexes is not None:
+            return
+        generation = self._index_generation
+        indexes = await run_blocking(self._load_text_indexes, generation == self._snapshot_generation,
+                                     self.facts_data, self._fact_index, len(self._fact_index))
+        with self._lock:
+            # За это время индексы могли построиться по требованию или данные — перечитаться
+            if self._text_indexes is None and generation == self._index_generation:
+                self._install_text_indexes(indexes)
+
+    def save_snapshot(self):
+        """Записывает снимок фактов и индексов, если данные сохранены, а снимок устарел"""
+        if self.snapshot is None or not self.write_snapshot or self._dirty:
+            return
+        version = self._storage_version
+        if version is None or version == self.snapshot.version:
+            return
+        with self._lock:
+            # Корпус (MappedTopicFacts) сам быстро открывается, в снимок идут только обычные списки
+            plain = all(isinstance(topic_facts, list) for topic_facts in self.facts_data.values())
+            index_state = None
+            if self._text_indexes is not None:
+                index_state = tuple(index.state() for index in self._text_indexes)
+            try:
+                with STORAGE_FLUSH_LATENCY.time("facts", "snapshot"):
+                    self.snapshot.save(version, self.facts_data if plain else None, self._fact_index, index_state)
+            except (IOError, OSError, ValueError) as e:
+                logger.error(f"Ошибка при сохранении снимка фактов: {e}")
+
+    def _fact_text(self, index: int) -> str:
+        """Возвращает текст факта по его номеру в плоском индексе"""
+        topic, offset = self._fact_index[index]
+        return self.facts_data[topic][offset]
+
+    def _fact_topic(self, index: int) -> str:
+        """Возвращает тему факта по его номеру в плоском индексе"""
+        return self._fact_index[index][0]
+
+    def _append_fact(self, topic: str, fact: str, recent: bool = False):
+        """Добавляет факт в тему и в индекс, помечая данные как измененные"""
+        with self._lock:
+            if topic not in self.facts_data:
+                self.topics_version += 1
+            topic_facts = self.facts_data.setdefault(topic, [])
+            self._fact_index.append((topic, len(topic_facts)))
+            if self.selector is not None:
+                self.selector.add(topic, len(topic_facts), recent)
+            topic_facts.append(fact)
+            missing = self._catalog_missing.get(topic) if self._catalog_missing is not None else None
+            if missing and fact in missing:
+                missing.remove(fact)
+            if self._text_indexes is not None:
+                search_index, dedup_index, prefix_index = self._text_indexes
+                search_index.add(fact)
+                dedup_index.add(fact)
+                prefix_index.add(len(self._fact_index) - 1, topic, fact)
+            self._pending.append((topic, fact))
+            self._dirty = True
+
     def get_topics(self) -> List[str]:
         """Возвращает список доступных тем"""
         topics = list(self.facts_data.keys())
@@ -217,52 +2446,340 @@ class FactsDataManager:
             topics.remove("случайные")
         return topics
 
+    def _missing_catalog(self) -> Dict[str, List[str]]:
+        """Факты встроенного каталога, которых еще нет в базе, по темам"""
+        missing = self._catalog_missing
+        if missing is None:
+            with self._lock:
+                missing = {}
+                for topic, topic_facts in TOPIC_FACTS.items():
+                    stored = set(self.facts_data.get(topic, ()))
+                    missing[topic] = [fact for fact in topic_facts if fact not in stored]
+                self._catalog_missing = missing
+        return missing
+
+    def _draw_weighted(self, topic: Optional[str] = None,
+                       is_seen: Optional[Callable[[str, int], bool]] = None) -> Optional[Tuple[str, int]]:
+        """
+        Взвешенный выбор среди фактов базы и фактов каталога, которых в базе еще нет (как
+        и колода по теме, выбор видит весь каталог). У факта каталога нет просмотров, его
+        вес — единица; выбранный факт сохраняется в базу, как при выдаче из колоды.
+        """
+        missing = self._missing_catalog()
+        if topic is None:
+            extra = sum(len(facts) for facts in missing.values())
+        else:
+            extra = len(missing.get(topic, ()))
+        if extra and random.random() * (self.selector.total(topic) + extra) < extra:
+            choice = random.randrange(extra)
+            candidates = missing.items() if topic is None else [(topic, missing[topic])]
+            for missing_topic, facts in candidates:
+                if choice < len(facts):
+                    fact = facts[choice]
+                    self._remember_fact(missing_topic, fact)
+                    return missing_topic, len(self.facts_data[missing_topic]) - 1
+                choice -= len(facts)
+        return self.selector.draw(topic, is_seen)
+
     def get_random_fact(self) -> str:
         """Возвращает случайный факт"""
-        all_facts = []
-        for topic_facts in self.facts_data.values():
-            all_facts.extend(topic_facts)
-
-        if all_facts:
-            return random.choice(all_facts)
+        if self.selector is not None:
+            picked = self._draw_weighted()
+            if picked is not None:
+                topic, offset = picked
+                return self.facts_data[topic][offset]
+        if self._fact_index:
+            topic, offset = random.choice(self._fact_index)
+            return self.facts_data[topic][offset]
         return self.api.get_random_fact()
 
+    def draw_random_fact(self, deck: Optional[List[int]]) -> Tuple[str, Optional[List[int]]]:
+        """Возвращает следующий случайный факт из колоды пользователя и новое состояние колоды"""
+        if not self._fact_index:
+            return self.api.get_random_fact(), deck
+
+        # Плоский индекс только дополняется в конец, поэтому номера уже розданных фактов
+        # не меняются, а новые факты колода раздаст после текущих
+        index, deck = FactDeck.draw(deck, len(self._fact_index))
+        topic, offset = self._fact_index[index]
+        return self.facts_data[topic][offset], deck
+
+    def search_facts(self, query: str, limit: int = 5) -> List[Tuple[str, str]]:
+        """Ищет факты по словам запроса, возвращает пары (тема, факт) по убыванию релевантности"""
+        results = []
+        seen = set()
+        # Запрашиваем с запасом: в базе встречаются повторяющиеся факты
+        for doc_id, _ in self.search_index.search(query, limit * 2):
+            topic, offset = self._fact_index[doc_id]
+            fact = self.facts_data[topic][offset]
+            if fact not in seen:
+                seen.add(fact)
+                results.append((topic, fact))
+                if len(results) == limit:
+                    break
+        return results
+
+    def prefix_search(self, query: str, limit: int = INLINE_RESULTS_LIMIT,
+                      budget_ms: float = INLINE_BUDGET_MS) -> List[Tuple[int, str, str]]:
+        """Ищет факты по префиксам слов запроса, возвращает (номер, тема, факт)"""
+        deadline = time.perf_counter() + budget_ms / 1000
+        results = []
+        seen = set()
+        for doc_id in self.prefix_index.search(query, limit * 2, deadline):
+            topic, _ = self._fact_index[doc_id]
+            fact = self._fact_text(doc_id)
+            if fact not in seen:
+                seen.add(fact)
+                results.append((doc_id, topic, fact))
+                if len(results) == limit:
+                    break
+        return results
+
     def get_fact_by_topic(self, topic: str) -> Optional[str]:
 
         topic_lower = topic.lower()
 
+        if self.selector is not None:
+            picked = self._draw_weighted(topic_lower)
+            if picked is not None:
+                return self.facts_data[topic_lower][picked[1]]
+
         # Получаем факт напрямую из API (где большой список)
         fact = self.api.get_fact_by_topic(topic_lower)
 
         if fact:
-            # Сохраняем факт в локальный файл, чтобы расширять базу (но не читаем её обратно)
-            if topic_lower not in self.facts_data:
-                self.facts_data[topic_lower] = []
-            if fact not in self.facts_data[topic_lower]:
-                self.facts_data[topic_lower].append(fact)
-            self._save_data()
+            self._remember_fact(topic_lower, fact)
             return fact
 
         return None
 
+    @staticmethod
+    def fact_key(fact: str) -> int:
+        """Короткий ключ факта для списка показанных пользователю"""
+        return zlib.crc32(fact.encode('utf-8'))
+
+    def pick_fact(self, topic: Optional[str], seen: Container[int]) -> Optional[str]:
+        """
+        Выбирает факт по весам (из всей базы или темы), предпочитая факты, ключей которых нет
+        в seen, и учитывает просмотр. Без взвешенного выбора возвращает None.
+        """
+        if self.selector is None:
+            return None
+        picked = self._draw_weighted(topic, lambda t, offset: self.fact_key(self.facts_data[t][offset]) in seen)
+        if picked is None:
+            return None
+        self.selector.record_view(*picked)
+        topic, offset = picked
+        return self.facts_data[topic][offset]
+
+    def draw_fact_by_topic(self, topic: str, deck: Optional[List[int]]) -> Tuple[Optional[str], Optional[List[int]]]:
+        """Возвращает следующий факт по теме из колоды пользователя и новое состояние колоды"""
+        topic_lower = topic.lower()
+        topic_facts = TOPIC_FACTS.get(topic_lower)
+        if not topic_facts:
+            return None, deck
+
+        index, deck = FactDeck.draw(deck, len(topic_facts))
+        fact = topic_facts[index]
+        self._remember_fact(topic_lower, fact)
+        return fact, deck
+
+    def _remember_fact(self, topic: str, fact: str):
+        """Сохраняет выданный факт в локальную базу, чтобы расширять её (но не читаем её обратно)"""
+        # На диск изменения попадут при следующем фоновом сбросе
+        with self._lock:
+            if fact not in self.facts_data.get(topic, ()):
+                self._append_fact(topic, fact)
+
     def _save_data(self):
-        """Сохраняет данные в файл"""
+        """Сохраняет данные в хранилище"""
+        with self._lock:
+            try:
+                with STORAGE_FLUSH_LATENCY.time("facts", "save"):
+                    self.storage.save(self.facts_data, self._pending)
+                self._pending = []
+                self._dirty = False
+                self._storage_version = self.storage.version()
+            except (IOError, OSError, sqlite3.Error) as e:
+                logger.error(f"Ошибка при сохранении данных: {e}")
+
+    async def save_async(self) -> bool:
+        """
+        Асинхронный вариант _save_data: снимок данных делается сразу, а сериализация и запись
+        идут в пуле потоков. Вызовы во время записи объединяются в одну следующую запись.
+        """
+        return await self._saves.run()
+
+    async def _save_snapshot(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # Копируются только списки: сами строки неизменяемы
+            facts_data = {topic: topic_facts.copy() for topic, topic_facts in self.facts_data.items()}
+            pending, self._pending = self._pending, []
+            self._dirty = False
+
+        def write():
+            with STORAGE_FLUSH_LATENCY.time("facts", "save"):
+                self.storage.save(facts_data, pending)
+            return self.storage.version()
+
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.facts_data, f, ensure_ascii=False, indent=2)
-        except IOError as e:
+            self._storage_version = await run_blocking(write)
+        except (IOError, OSError, sqlite3.Error) as e:
             logger.error(f"Ошибка при сохранении данных: {e}")
+            with self._lock:
+                # Несохраненные факты вернутся в следующую запись
+                self._pending = pending + self._pending
+                self._dirty = True
+
+    def close(self):
+        """Сохраняет изменения, обновляет снимок для следующего запуска и закрывает хранилище"""
+        self.flush()
+        self.save_snapshot()
+        self.storage.close()
+
+    def flush(self):
+        """Сохраняет данные, только если они изменились с последнего сохранения"""
+        if self._dirty:
+            self._save_data()
+        self._save_views()
+
+    async def flush_async(self):
+        """Асинхронный вариант flush для фонового сброса"""
+        if self._dirty:
+            await self.save_async()
+        if self.selector is not None and self.selector.views_dirty:
+            await self._view_saves.run()
+
+    async def _save_views_snapshot(self):
+        selector = self.selector
+        snapshot = selector.views_snapshot() if selector is not None else None
+        if snapshot is None:
+            return
+        try:
+            await run_blocking(selector.write_views, snapshot)
+        except (IOError, OSError) as e:
+            logger.error(f"Ошибка при сохранении просмотров фактов: {e}")
+            selector.views_dirty = True
+
+    def _save_views(self):
+        snapshot = self.selector.views_snapshot() if self.selector is not None else None
+        if snapshot is not None:
+            try:
+                self.selector.write_views(snapshot)
+            except (IOError, OSError) as e:
+                logger.error(f"Ошибка при сохранении просмотров фактов: {e}")
+
+    def reload_if_changed(self) -> bool:
+        """Перечитывает факты, если хранилище изменил другой процесс"""
+        version = self.storage.version()
+        if version is None or version == self._storage_version:
+            return False
+
+        with self._lock:
+            # Свои несохраненные факты сначала должны уйти в хранилище
+            if self._pending:
+                return False
+            try:
+                data = self.storage.load()
+            except (IOError, json.JSONDecodeError, sqlite3.Error) as e:
+                logger.error(f"Ошибка при перечитывании фактов: {e}")
+                return False
+            if data is None:
+                return False
+            self.facts_data = data
+            self._rebuild_index()
+            self.topics_version += 1
+            self._storage_version = version
+
+        logger.info(f"Факты перечитаны из хранилища: {len(self._fact_index)}")
+        return True
+
+    async def reload_if_changed_async(self) -> bool:
+        """Асинхронный вариант reload_if_changed: чтение и построение индексов идут в пуле потоков"""
+        version = self.storage.version()
+        if version is None or version == self._storage_version or self._pending:
+            return False
+
+        def load():
+            data = self.storage.load()
+            if data is None:
+                return None, None, None
+            indexes = self._build_indexes(data)
+            return data, indexes, self._build_text_indexes(data, indexes[0], len(indexes[0]))
 
-    def add_fact(self, topic: str, fact: str) -> bool:
-        """Добавляет новый факт в указанную тему"""
+        try:
+            data, indexes, text_indexes = await run_blocking(load)
+        except (IOError, json.JSONDecodeError, sqlite3.Error) as e:
+            logger.error(f"Ошибка при перечитывании фактов: {e}")
+            return False
+        with self._lock:
+            # Пока шло чтение, могли появиться свои факты: они потерялись бы при замене
+            if data is None or self._pending:
+                return False
+            self.facts_data = data
+            self._set_indexes(indexes, text_indexes)
+            self.topics_version += 1
+            self._storage_version = version
+
+        logger.info(f"Факты перечитаны из хранилища: {len(self._fact_index)}")
+        return True
+
+    def find_duplicate(self, fact: str) -> Optional[Tuple[str, str, float]]:
+        """Ищет такой же или очень похожий факт, возвращает (тема, факт, сходство)"""
+        found = self.dedup_index.find(fact)
+        if found is None:
+            return None
+        index, similarity = found
+        topic, _ = self._fact_index[index]
+        return topic, self._fact_text(index), similarity
+
+    def deduplicate(self, persist: bool = True) -> List[Tuple[str, str]]:
+        """
+        Удаляет из базы дубликаты (оставляя первое вхождение), возвращает удаленные факты.
+        При persist=False хранилище не изменяется — только данные в памяти.
+        """
+        with self._lock:
+            kept: Dict[str, List[str]] = {}
+            kept_texts: List[str] = []
+            removed = []
+            index = FactDeduplicator(kept_texts.__getitem__)
+            for topic, topic_facts in self.facts_data.items():
+                for fact in topic_facts:
+                    if index.find(fact) is not None:
+                        removed.append((topic, fact))
+                        continue
+                    kept.setdefault(topic, []).append(fact)
+                    kept_texts.append(fact)
+                    index.add(fact)
+
+            if removed:
+                self.facts_data = kept
+                if self.selector is not None:
+                    self.selector.reset_views()
+                self._rebuild_index()
+                self.topics_version += 1
+                if persist:
+                    self.storage.rewrite(self.facts_data)
+                    self._pending = []
+                    self._dirty = False
+                    self._storage_version = self.storage.version()
+            return removed
+
+    def add_fact(self, topic: str, fact: str, check_duplicates: bool = True) -> bool:
+        """
+        Добавляет новый факт в указанную тему. check_duplicates=False — вызывающий
+        уже проверил факт через find_duplicate.
+        """
         try:
             topic_lower = topic.lower()
+            duplicate = self.find_duplicate(fact) if check_duplicates else None
+            if duplicate:
+                logger.info(f"Отклонен дубликат факта в теме '{topic}' (сходство {duplicate[2]:.2f})")
+                return False
 
-            if topic_lower not in self.facts_data:
-                self.facts_data[topic_lower] = []
-
-            self.facts_data[topic_lower].append(fact)
-            self._save_data()
+            self._append_fact(topic_lower, fact, recent=True)
             logger.info(f"Добавлен новый факт в тему '{topic}'")
             return True
 
@@ -274,44 +2791,141 @@ class FactsDataManager:
 class UserPreferences:
     """Класс для управления пользовательскими настройками"""
 
-    def __init__(self, preferences_file: str = "user_preferences.json"):
+    def __init__(self, preferences_file: str = "user_preferences.json", storage: Optional[PreferencesStorage] = None,
+                 cache_size: int = USER_CACHE_SIZE, cache_ttl: float = USER_CACHE_TTL):
         self.preferences_file = preferences_file
-        self.preferences = self._load_preferences()
+        # Защищает настройки от одновременного изменения и сохранения
+        self._lock = threading.RLock()
+        self.storage = storage or JournalPreferencesStorage(preferences_file)
+        # Настройки всех пользователей загружаются при первом обращении (или в фоне после запуска бота);
+        # хранилищам, которые читают пользователей по одному, они не нужны
+        self._preferences: Optional[Dict] = None
+        # Записи активных пользователей. Кэш сквозной: изменения сразу уходят в хранилище,
+        # поэтому при вытеснении туда переносятся только буферизованные статистика и колоды.
+        # Используется только с хранилищами, которые читают пользователей по одному: остальные
+        # и так держат в памяти всех пользователей, и записи лишь дублировали бы их настройки
+        self.records = UserRecordCache(cache_size, cache_ttl, self._evict_record)
+        # Несохраненные приращения статистики: user_id -> [просмотрено фактов, последняя активность (epoch)]
+        self._stats_buffer: Dict[str, List[int]] = {}
+        # Несохраненные состояния колод: user_id -> {ключ колоды: состояние}. Колода сдвигается
+        # при каждом просмотре, поэтому пишется в хранилище вместе со статистикой, а не сразу
+        self._deck_buffer: Dict[str, Dict[str, List[int]]] = {}
+        # Ключи фактов, показанных с последнего сброса: user_id -> deque(maxlen=limit)
+        self._seen_buffer: Dict[str, deque] = {}
+        self._saves = CoalescingSaver("preferences", self._save_snapshot)
 
     def _load_preferences(self) -> Dict:
         """Загружает настройки пользователей из файла"""
-        try:
-            if os.path.exists(self.preferences_file):
-                with open(self.preferences_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
-        except (IOError, json.JSONDecodeError) as e:
-            logger.error(f"Ошибка при загрузке настроек: {e}")
-            return {}
+        return self.storage.load()
+
+    @property
+    def preferences(self) -> Dict:
+        """Настройки всех пользователей; загружаются при первом обращении"""
+        preferences = self._preferences
+        if preferences is None:
+            with self._lock:
+                if self._preferences is None:
+                    with startup_phase("preferences_load"):
+                        self._preferences = self._load_preferences()
+                preferences = self._preferences
+        return preferences
+
+    async def warm_up(self):
+        """Загружает настройки в пуле потоков, чтобы их не ждал первый запрос"""
+        if self._preferences is None and not self.storage.per_user_reads:
+            await run_blocking(lambda: self.preferences)
+
+    def _record(self, user_id_str: str) -> Union[UserRecord, LoadedUserRecord]:
+        """
+        Возвращает запись пользователя: из кэша (при промахе читая ее из хранилища)
+        или, если хранилище загружено в память целиком, прямо поверх загруженных настроек
+        """
+        if not self.storage.per_user_reads:
+            return LoadedUserRecord(self.preferences, user_id_str)
+        record = self.records.get(user_id_str)
+        if record is None:
+            with self._lock:
+                # Пользователь без настроек тоже кэшируется, чтобы не искать его в хранилище повторно
+                record = UserRecord(self.storage.load_user(user_id_str))
+                self.records.put(user_id_str, record)
+        return record
+
+    def _evict_record(self, user_id_str: str, record: UserRecord):
+        """Переносит в хранилище буферизованные статистику и колоды вытесняемого пользователя"""
+        with self._lock:
+            buffered = self._stats_buffer.pop(user_id_str, None)
+            if buffered is not None:
+                self._apply_stats(user_id_str, record, buffered)
+            decks = self._deck_buffer.pop(user_id_str, None)
+            if decks is not None:
+                self._apply_decks(user_id_str, record, decks)
+            seen = self._seen_buffer.pop(user_id_str, None)
+            if seen is not None:
+                self._apply_seen(user_id_str, record, seen)
 
     def _save_preferences(self):
         """Сохраняет настройки пользователей в файл"""
+        with self._lock, STORAGE_FLUSH_LATENCY.time("preferences", "compact"):
+            self.storage.compact()
+
+    async def save_async(self) -> bool:
+        """
+        Асинхронный вариант _save_preferences: снимок настроек делается сразу, а запись идет
+        в пуле потоков. Вызовы во время записи объединяются в одну следующую запись.
+        """
+        return await self._saves.run()
+
+    async def _save_snapshot(self):
+        with self._lock:
+            write = self.storage.prepare_compaction()
+        if write is None:
+            return
+
+        def timed_write():
+            with STORAGE_FLUSH_LATENCY.time("preferences", "compact"):
+                write()
+
         try:
-            with open(self.preferences_file, 'w', encoding='utf-8') as f:
-                json.dump(self.preferences, f, ensure_ascii=False, indent=2)
-        except IOError as e:
+            await run_blocking(timed_write)
+        except (IOError, OSError) as e:
+            # Записи остались в отложенном журнале и будут учтены при следующем сжатии или загрузке
             logger.error(f"Ошибка при сохранении настроек: {e}")
 
+    def flush(self):
+        """Делает накопленные изменения долговечными"""
+        with self._lock, STORAGE_FLUSH_LATENCY.time("preferences", "flush"):
+            self.storage.flush()
+
+    async def flush_async(self):
+        """
+        Асинхронный вариант flush: журнал, выросший до порога, сжимается в пуле потоков.
+        Заодно из памяти уходят устаревшие записи кэша и давно не использованные данные хранилища.
+        """
+        if self.storage.compaction_due():
+            await self.save_async()
+        self.flush()
+        with self._lock:
+            self.records.expire()
+            # Выгруженный во время сжатия шард мог бы загрузиться и сжаться поверх идущей записи
+            if not self._saves.busy:
+                self.storage.release()
+
+    def close(self):
+        """Сохраняет накопленные изменения при завершении работы"""
+        with self._lock:
+            self.flush_stats()
+            self.storage.close()
+
     def get_user_preference(self, user_id: int, key: str, default=None):
         """Получает значение настройки пользователя"""
-        user_id_str = str(user_id)
-        if user_id_str in self.preferences:
-            return self.preferences[user_id_str].get(key, default)
-        return default
+        return self._record(str(user_id)).get(key, default)
 
     def set_user_preference(self, user_id: int, key: str, value):
         """Устанавливает значение настройки пользователя"""
         user_id_str = str(user_id)
-        if user_id_str not in self.preferences:
-            self.preferences[user_id_str] = {}
-
-        self.preferences[user_id_str][key] = value
-        self._save_preferences()
+        with self._lock:
+            self._record(user_id_str).set(key, value)
+            self.storage.append(user_id_str, key, value)
 
     def get_favorite_topic(self, user_id: int) -> Optional[str]:
         """Получает любимую тему пользователя"""
@@ -321,66 +2935,1042 @@ class UserPreferences:
         """Устанавливает любимую тему пользователя"""
         self.set_user_preference(user_id, "favorite_topic", topic)
 
+    def is_subscribed(self, user_id: int) -> bool:
+        """Подписан ли пользователь на ежедневный факт"""
+        return bool(self.get_user_preference(user_id, "subscribed", False))
+
+    def set_subscribed(self, user_id: int, subscribed: bool):
+        """Включает или выключает ежедневный факт"""
+        self.set_user_preference(user_id, "subscribed", subscribed)
+
+    def iter_users(self, shard_indices: Optional[Iterable[int]] = None) -> Iterator[Tuple[str, Dict]]:
+        """
+        Лениво перебирает (user_id, настройки) в порядке хранения. Для шардированного
+        хранилища можно ограничиться шардами shard_indices; шарды загружаются по одному.
+        """
+        if isinstance(self.storage, ShardedPreferencesStorage):
+            yield from self.storage.iter_users(shard_indices)
+            return
+        if self.storage.per_user_reads:
+            yield from self.storage.iter_users()
+            return
+
+        data = self.preferences
+        # Снимок ключей: между порциями обработчики могут добавлять пользователей
+        for user_id_str in list(data):
+            user_prefs = data.get(user_id_str)
+            if user_prefs is not None:
+                yield user_id_str, user_prefs
+
+    def shards(self, shard_indices: Optional[Iterable[int]] = None) -> List[int]:
+        """Номера шардов настроек (у нешардированного хранилища один шард 0)"""
+        if isinstance(self.storage, ShardedPreferencesStorage):
+            return list(range(self.storage.shards) if shard_indices is None else shard_indices)
+        return [0]
+
+    def iter_shard_users(self, shard: int, after: str = "") -> Iterator[Tuple[str, Dict]]:
+        """
+        Перебирает пользователей шарда по возрастанию user_id, начиная с первого после after.
+        Порядок не зависит от добавления пользователей, поэтому по последнему
+        обработанному user_id перебор можно продолжить после сбоя.
+        """
+        if isinstance(self.storage, ShardedPreferencesStorage):
+            data = self.storage.shard(shard).data
+        elif self.storage.per_user_reads:
+            yield from self.storage.iter_users(after=after)
+            return
+        else:
+            data = self.preferences
+
+        for user_id_str in sorted(user_id_str for user_id_str in data if user_id_str > after):
+            user_prefs = data.get(user_id_str)
+            if user_prefs is not None:
+                yield user_id_str, user_prefs
+
+    def get_fact_deck(self, user_id: int, deck_key: str) -> Optional[List[int]]:
+        """Получает состояние колоды фактов пользователя с учетом еще не сохраненного"""
+        buffered = self._deck_buffer.get(str(user_id))
+        if buffered is not None and deck_key in buffered:
+            return buffered[deck_key]
+        return self.get_user_preference(user_id, "decks", {}).get(deck_key)
+
+    def set_fact_deck(self, user_id: int, deck_key: str, deck: Optional[List[int]]):
+        """Запоминает состояние колоды в буфере (без записи в хранилище, см. flush_stats)"""
+        with self._lock:
+            self._deck_buffer.setdefault(str(user_id), {})[deck_key] = deck
+
+    @staticmethod
+    def _decode_seen(encoded: Optional[str]) -> Tuple[int, ...]:
+        # Ключи хранятся одной строкой base64 (uint32 little-endian): так запись в журнал
+        # и снимок не разворачивают список из сотни чисел
+        if not encoded:
+            return ()
+        raw = base64.b64decode(encoded)
+        return struct.unpack(f"<{len(raw) // 4}I", raw)
+
+    def get_seen_facts(self, user_id: int) -> set:
+        """Ключи последних показанных пользователю фактов с учетом еще не сохраненных"""
+        seen = set(self._decode_seen(self.get_user_preference(user_id, "seen")))
+        buffered = self._seen_buffer.get(str(user_id))
+        if buffered:
+            seen.update(buffered)
+        return seen
+
+    def add_seen_fact(self, user_id: int, fact_key: int, limit: int = SELECTION_SEEN_LIMIT):
+        """Запоминает показанный факт в буфере (без записи в хранилище, см. flush_stats)"""
+        with self._lock:
+            buffered = self._seen_buffer.get(str(user_id))
+            if buffered is None:
+                buffered = self._seen_buffer[str(user_id)] = deque(maxlen=limit)
+            buffered.append(fact_key)
+
     def get_user_stats(self, user_id: int) -> Dict:
-        """Получает статистику пользователя"""
+        """Получает статистику пользователя с учетом еще не сохраненных приращений"""
         stats = self.get_user_preference(user_id, "stats", {})
+        total_facts = stats.get("total_facts", 0)
+        last_active = stats.get("last_active", "")
+        buffered = self._stats_buffer.get(str(user_id))
+        if buffered:
+            total_facts += buffered[0]
+            last_active = buffered[1]
         return {
-            "total_facts": stats.get("total_facts", 0),
-            "last_active": stats.get("last_active", ""),
+            "total_facts": total_facts,
+            "last_active": last_active,
             "favorite_topic": self.get_favorite_topic(user_id)
         }
 
     def update_stats(self, user_id: int):
-        """Обновляет статистику пользователя"""
-        stats = self.get_user_preference(user_id, "stats", {})
-        stats["total_facts"] = stats.get("total_facts", 0) + 1
-        stats["last_active"] = datetime.now().isoformat()
-        self.set_user_preference(user_id, "stats", stats)
+        """Учитывает просмотр факта в буфере статистики (без записи в хранилище)"""
+        now = int(time.time())
+        with self._lock:
+            buffered = self._stats_buffer.get(str(user_id))
+            if buffered is None:
+                self._stats_buffer[str(user_id)] = [1, now]
+            else:
+                buffered[0] += 1
+                buffered[1] = now
+
+    def flush_stats(self) -> int:
+        """
+        Переносит накопленные приращения статистики, состояния колод и показанные факты
+        в настройки (по одной записи каждого вида на пользователя), возвращает число пользователей
+        """
+        with self._lock, STORAGE_FLUSH_LATENCY.time("preferences", "stats"):
+            buffer, self._stats_buffer = self._stats_buffer, {}
+            deck_buffer, self._deck_buffer = self._deck_buffer, {}
+            seen_buffer, self._seen_buffer = self._seen_buffer, {}
+            for user_id_str, buffered in buffer.items():
+                self._apply_stats(user_id_str, self._record(user_id_str), buffered)
+            for user_id_str, decks in deck_buffer.items():
+                self._apply_decks(user_id_str, self._record(user_id_str), decks)
+            for user_id_str, seen in seen_buffer.items():
+                self._apply_seen(user_id_str, self._record(user_id_str), seen)
+            return len(buffer.keys() | deck_buffer.keys() | seen_buffer.keys())
+
+    def _apply_stats(self, user_id_str: str, record: Union[UserRecord, LoadedUserRecord], buffered: List[int]):
+        views, last_active = buffered
+        stats = dict(record.get("stats", {}))
+        stats["total_facts"] = stats.get("total_facts", 0) + views
+        stats["last_active"] = last_active
+        record.set("stats", stats)
+        self.storage.append(user_id_str, "stats", stats)
+
+    def _apply_decks(self, user_id_str: str, record: Union[UserRecord, LoadedUserRecord], buffered: Dict[str, List[int]]):
+        decks = dict(record.get("decks", {}))
+        decks.update(buffered)
+        record.set("decks", decks)
+        self.storage.append(user_id_str, "decks", decks)
+
+    def _apply_seen(self, user_id_str: str, record: Union[UserRecord, LoadedUserRecord], buffered: deque):
+        seen = (self._decode_seen(record.get("seen")) + tuple(buffered))[-buffered.maxlen:]
+        encoded = base64.b64encode(struct.pack(f"<{len(seen)}I", *seen)).decode('ascii')
+        record.set("seen", encoded)
+        self.storage.append(user_id_str, "seen", encoded)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления из разных чатов параллельно, а обновления
+    одного чата (или пользователя, если чата нет) — строго по очереди.
+    """
+
+    # Сколько обновлений может ожидать своей очереди на каждое активно обрабатываемое
+    PENDING_FACTOR = 64
+
+    def __init__(self, max_concurrent_updates: int = CONCURRENT_UPDATES):
+        # Семафор базового класса лишь ограничивает число ожидающих задач,
+        # реальный предел параллельности задает self._running
+        super().__init__(max_concurrent_updates * self.PENDING_FACTOR)
+        self.concurrency = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks: Dict[object, List] = {}
+        self.queued = 0
+        self.in_progress = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def _ordering_key(update: object):
+        """Возвращает ключ, в пределах которого обновления обрабатываются по порядку"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return "chat", update.effective_chat.id
+            if update.effective_user:
+                return "user", update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        queued_at = time.perf_counter()
+        key = self._ordering_key(update)
+        if key is None:
+            await self._run(coroutine, queued_at)
+            return
+
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine, queued_at)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def _run(self, coroutine, queued_at: float):
+        """Дожидается свободного слота и выполняет обработку, учитывая время ожидания"""
+        self.queued += 1
+        try:
+            await self._running.acquire()
+        finally:
+            self.queued -= 1
+        try:
+            wait = time.perf_counter() - queued_at
+            self.in_progress += 1
+            self.processed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            await coroutine
+        finally:
+            self.in_progress -= 1
+            self._running.release()
+
+    def stats(self) -> Dict:
+        """Возвращает метрики очереди обработки обновлений"""
+        return {
+            "concurrency": self.concurrency,
+            "in_progress": self.in_progress,
+            # Ожидают своей очереди в чате или свободного слота
+            "queue_depth": self.current_concurrent_updates - self.in_progress,
+            "waiting_for_slot": self.queued,
+            "active_chats": len(self._chat_locks),
+            "processed": self.processed,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class TokenBucket:
+    """
+    Корзина токенов. Токен резервируется сразу, даже если его еще нет: тогда вызывающий
+    получает время ожидания, а следующие встают за ним в очередь.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "clock")
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд нужно подождать"""
+        self._refill(self.clock())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Запрещает отправку на заданное время (после RetryAfter от сервера)"""
+        self._refill(self.clock())
+        # Следующий резерв получит ожидание ровно seconds
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def idle(self) -> bool:
+        """Корзина полна — её можно удалить без потери состояния"""
+        self._refill(self.clock())
+        return self.tokens >= self.capacity
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Планировщик исходящих вызовов Bot API с учетом лимитов Telegram.
+    Сообщения и правки проходят через корзину чата (1 в секунду в личном чате,
+    20 в минуту в группе) и общую корзину; после RetryAfter вызов повторяется,
+    а корзина ставится на паузу на указанное сервером время. Правка сообщения,
+    ожидающая отправки, заменяется более новой правкой того же сообщения.
+    Число ожидающих вызовов ограничено, поэтому при перегрузке обработчики ждут.
+    """
+
+    LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+    UNLIMITED_METHODS = frozenset({"sendChatAction"})
+    MERGEABLE_METHODS = frozenset({"editMessageText", "editMessageReplyMarkup", "editMessageCaption"})
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 group_per_minute: float = OUTBOUND_GROUP_PER_MINUTE, max_pending: int = OUTBOUND_MAX_PENDING,
+                 max_retries: int = OUTBOUND_MAX_RETRIES, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Awaitable[None]] = asyncio.sleep):
+        # Часы и ожидание подменяются в тестах
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock)
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.group_capacity = group_per_minute
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[object, TokenBucket] = {}
+        self._pending = asyncio.Semaphore(max_pending)
+        # (метод, чат, сообщение) -> [последние данные правки, future результата, число присоединившихся]
+        self._pending_edits: Dict[Tuple, list] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_IDLE_BUCKETS:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle()}
+            # У групп и каналов отрицательные id
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            if is_group:
+                bucket = TokenBucket(self.group_rate, self.group_capacity, self.clock)
+            else:
+                bucket = TokenBucket(self.chat_rate, 1, self.clock)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_for_slot(self, chat_id):
+        """Ждет токены корзины чата, а затем общей корзины"""
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay:
+                OUTBOUND_WAIT.observe(delay, "chat")
+                await self.sleep(delay)
+        delay = self.global_bucket.reserve()
+        if delay:
+            OUTBOUND_WAIT.observe(delay, "global")
+            await self.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(self.LIMITED_PREFIXES) and endpoint not in self.UNLIMITED_METHODS
+        if not limited:
+            return await self._call_with_retries(callback, endpoint, data, kwargs, None)
+
+        chat_id = data.get("chat_id")
+        key = None
+        if endpoint in self.MERGEABLE_METHODS and data.get("message_id") is not None:
+            key = (endpoint, chat_id, data.get("message_id"))
+            entry = self._pending_edits.get(key)
+            if entry is not None:
+                # Правка еще ждет отправки: отправлена будет только новая версия
+                entry[0] = data
+                entry[2] += 1
+                OUTBOUND_MERGED_EDITS.inc()
+                return await entry[1]
+
+        async with self._pending:
+            entry = None
+            if key is not None:
+                entry = self._pending_edits[key] = [data, asyncio.get_running_loop().create_future(), 0]
+            try:
+                await self._wait_for_slot(chat_id)
+                if entry is not None:
+                    del self._pending_edits[key]
+                    data = entry[0]
+                result = await self._call_with_retries(callback, endpoint, data, kwargs, chat_id)
+            except BaseException as e:
+                if entry is not None:
+                    if self._pending_edits.get(key) is entry:
+                        del self._pending_edits[key]
+                    # Исключение передается только тем, кто ждет этот future
+                    if entry[2] and not entry[1].done():
+                        entry[1].set_exception(e)
+                raise
+            if entry is not None:
+                entry[1].set_result(result)
+            return result
+
+    async def _call_with_retries(self, callback, endpoint, data, kwargs, chat_id):
+        """Выполняет вызов, повторяя его после RetryAfter"""
+        attempt = 0
+        while True:
+            try:
+                return await callback(endpoint, data, **kwargs)
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Ограничение частоты для {endpoint}: повтор через {seconds:.0f} с")
+                OUTBOUND_RETRIES.inc(endpoint)
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.pause(seconds)
+                await self._wait_for_slot(chat_id)
+
+
+class WebhookServer:
+    """
+    Встроенный HTTP-сервер для приема обновлений Telegram через вебхук.
+    Проверяет секретный токен и передает обновления в очередь приложения.
+    """
+
+    SECRET_HEADER = "x-telegram-bot-api-secret-token"
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self, application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 url_path: str = WEBHOOK_PATH, secret_token: Optional[str] = WEBHOOK_SECRET,
+                 max_connections: int = WEBHOOK_MAX_CONNECTIONS, idle_timeout: float = WEBHOOK_IDLE_TIMEOUT):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._connections = asyncio.Semaphore(max_connections)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        """Начинает прием входящих соединений"""
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info(f"Вебхук слушает {self.listen}:{self.port}{self.url_path}")
+
+    async def stop(self):
+        """Останавливает прием соединений"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обрабатывает запросы одного соединения (с поддержкой keep-alive)"""
+        async with self._connections:
+            try:
+                while True:
+                    # Молчащее соединение закрывается: иначе max_connections простаивающих
+                    # клиентов заняли бы все места и остановили прием обновлений
+                    request = await asyncio.wait_for(self._read_head(reader), self.idle_timeout)
+                    if request is None:
+                        break
+                    method, path, headers = request
+
+                    length = int(headers.get("content-length", "0"))
+                    if length > self.MAX_BODY_SIZE:
+                        await self._respond(writer, 413, keep_alive=False)
+                        break
+                    body = await asyncio.wait_for(reader.readexactly(length), self.idle_timeout) if length else b""
+
+                    status = await self._handle_request(method, path.split('?', 1)[0], headers, body)
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    await self._respond(writer, status, keep_alive)
+                    if not keep_alive:
+                        break
+            except asyncio.TimeoutError:
+                logger.debug("Соединение вебхука закрыто по таймауту простоя")
+            except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+                logger.debug(f"Соединение вебхука закрыто: {e}")
+            finally:
+                writer.close()
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        """Читает строку запроса и заголовки; None — клиент закрыл соединение"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return method, path, headers
+
+    async def _handle_request(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> int:
+        """Проверяет запрос и ставит обновление в очередь, возвращает HTTP-статус"""
+        if path != self.url_path:
+            return 404
+        if method != "POST":
+            return 405
+        # Сравниваются байты: compare_digest не принимает строки с символами вне ASCII,
+        # а заголовки декодированы как latin-1 и могут их содержать
+        if self.secret_token and not hmac.compare_digest(
+                headers.get(self.SECRET_HEADER, "").encode('latin-1'), self.secret_token.encode('utf-8')):
+            logger.warning("Запрос к вебхуку с неверным секретным токеном")
+            return 403
+
+        try:
+            await self._deliver(json.loads(body))
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Некорректное обновление в вебхуке: {e}")
+            return 400
+        return 200
+
+    async def _deliver(self, data: Dict):
+        """Передает обновление на обработку"""
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, keep_alive: bool = True):
+        """Отправляет пустой HTTP-ответ с заданным статусом"""
+        connection = "keep-alive" if keep_alive else "close"
+        reason = http.HTTPStatus(status).phrase
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode('latin-1')
+        )
+        await writer.drain()
+
+
+def _update_user_id(data: Dict) -> Optional[int]:
+    """Возвращает id пользователя (или чата) из необработанного обновления"""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+
+class PartitionedWebhookServer(WebhookServer):
+    """
+    Фронтенд вебхука для многопроцессного режима: раздает обновления рабочим процессам.
+    Пользователь закреплен за процессом, которому принадлежит его шард настроек,
+    поэтому его настройки и context.user_data живут в одном процессе.
+    """
+
+    def __init__(self, queues: List, shards: int, **kwargs):
+        super().__init__(None, **kwargs)
+        self.queues = queues
+        self.shards = shards
+        self.delivered = [0] * len(queues)
+
+    def partition_for(self, data: Dict) -> int:
+        """Номер рабочего процесса для обновления"""
+        user_id = _update_user_id(data)
+        if user_id is None:
+            return 0
+        return ShardedPreferencesStorage.shard_index(str(user_id), self.shards) % len(self.queues)
+
+    async def _deliver(self, data: Dict):
+        partition = self.partition_for(data)
+        self.queues[partition].put(data)
+        self.delivered[partition] += 1
+
+
+class ProcessQueueReader:
+    """Читает элементы из очереди multiprocessing в отдельном потоке и передает их обработчику в цикле событий"""
+
+    def __init__(self, queue, handle: Callable):
+        self.queue = queue
+        self.handle = handle
+        self.finished = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # None в очереди — сигнал остановки от фронтенда
+            item = await loop.run_in_executor(None, self.queue.get)
+            if item is None:
+                break
+            try:
+                await self.handle(item)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке элемента очереди: {e}")
+        self.finished.set()
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+class UpdateRouter:
+    """
+    Таблица маршрутизации для данных кнопок и текста.
+    Данные разбираются один раз: сначала ищется точное совпадение, затем префикс
+    до первого "_" (например, "topic_наука" -> действие "topic" с аргументом "наука").
+    Для каждого маршрута ведется счетчик вызовов и суммарное время обработки.
+    """
+
+    FALLBACK = "<fallback>"
+
+    def __init__(self, kind: str = "callback"):
+        # Вид маршрутов для метки kind в метриках
+        self.kind = kind
+        self._exact: Dict[str, Callable] = {}
+        self._prefixed: Dict[str, Callable] = {}
+        self._fallback: Optional[Callable] = None
+        self.timings: Dict[str, List[float]] = {}
+
+    def add(self, action: str, handler: Callable, with_argument: bool = False):
+        """Регистрирует действие; with_argument означает данные вида '<action>_<аргумент>'"""
+        (self._prefixed if with_argument else self._exact)[action] = handler
+
+    def set_fallback(self, handler: Callable):
+        """Задает обработчик для данных без подходящего маршрута"""
+        self._fallback = handler
+
+    def resolve(self, data: str) -> Tuple[str, Optional[Callable], str]:
+        """Возвращает (маршрут, обработчик, аргумент) для данных"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, handler, ""
+
+        action, separator, argument = data.partition('_')
+        if separator:
+            handler = self._prefixed.get(action)
+            if handler is not None:
+                return action, handler, argument
+
+        return self.FALLBACK, self._fallback, data
+
+    async def dispatch(self, data: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Вызывает обработчик маршрута и учитывает время его работы"""
+        route, handler, argument = self.resolve(data)
+        if handler is None:
+            return None
+
+        started = time.perf_counter()
+        try:
+            return await handler(update, context, argument)
+        except Exception:
+            HANDLER_ERRORS.inc(self.kind, route)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, self.kind, route)
+            timing = self.timings.get(route)
+            if timing is None:
+                timing = self.timings[route] = [0, 0.0]
+            timing[0] += 1
+            timing[1] += elapsed
+
+    def stats(self) -> Dict[str, Dict]:
+        """Возвращает число вызовов и время обработки по маршрутам"""
+        return {
+            route: {"calls": calls, "total": total, "avg": total / calls}
+            for route, (calls, total) in self.timings.items()
+        }
+
+
+class DailyBroadcast:
+    """
+    Ежедневная рассылка факта подписчикам по их любимой теме.
+    Подписчики перебираются порциями, и внутри прогона факт для каждой темы выбирается
+    один раз. Отправку выполняет пул задач через планировщик исходящих сообщений.
+    Шарды перебираются по возрастанию user_id, и после каждой порции в контрольной точке
+    сохраняется последний обработанный user_id шарда: после сбоя прогон продолжится
+    со следующего, даже если тем временем появились новые пользователи
+    (сообщения незавершенной порции могут уйти повторно).
+    """
+
+    def __init__(self, bot: "FactsBot", checkpoint_file: str = BROADCAST_CHECKPOINT,
+                 workers: int = BROADCAST_WORKERS, chunk_size: int = BROADCAST_CHUNK):
+        self.bot = bot
+        self.checkpoint_file = checkpoint_file
+        self.workers = workers
+        self.chunk_size = chunk_size
+        # Шарды настроек, подписчиков которых обслуживает этот процесс (None — все)
+        self.shard_indices: Optional[List[int]] = None
+        self._running = False
+
+    def _load_checkpoint(self) -> Dict:
+        try:
+            with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (IOError, ValueError) as e:
+            logger.error(f"Ошибка при чтении контрольной точки рассылки: {e}")
+            return {}
+
+    async def _save_checkpoint(self, checkpoint: Dict):
+        snapshot = dict(checkpoint, facts=dict(checkpoint["facts"]), last=dict(checkpoint["last"]))
+        try:
+            await run_blocking(_atomic_write_json, self.checkpoint_file, snapshot)
+        except (IOError, OSError) as e:
+            logger.error(f"Ошибка при сохранении контрольной точки рассылки: {e}")
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(timezone.utc).date().isoformat()
+
+    def schedule(self, job_queue):
+        """Планирует ежедневный запуск и продолжение прерванного сегодняшнего прогона"""
+        send_time = datetime.strptime(BROADCAST_TIME, "%H:%M").time().replace(tzinfo=timezone.utc)
+        job_queue.run_daily(self.run_job, time=send_time, name="daily_broadcast")
+
+        checkpoint = self._load_checkpoint()
+        if checkpoint.get("run") == self._today() and not checkpoint.get("finished"):
+            logger.info(f"Продолжение прерванной рассылки: обработано шардов {len(checkpoint.get('last', {}))}")
+            job_queue.run_once(self.run_job, when=5, name="daily_broadcast_resume")
+
+    async def run_job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.run()
+
+    async def run(self) -> Dict:
+        """Выполняет (или продолжает) сегодняшнюю рассылку, возвращает контрольную точку"""
+        if self._running:
+            return {}
+        self._running = True
+        try:
+            return await self._run()
+        finally:
+            self._running = False
+
+    async def _run(self) -> Dict:
+        today = self._today()
+        checkpoint = self._load_checkpoint()
+        if checkpoint.get("run") != today or "last" not in checkpoint:
+            # Шард -> последний обработанный user_id
+            checkpoint = {"run": today, "last": {}, "sent": 0, "failed": 0, "facts": {}, "finished": False}
+        elif checkpoint.get("finished"):
+            return checkpoint
+
+        started = time.perf_counter()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue, checkpoint)) for _ in range(self.workers)]
+        try:
+            last = checkpoint["last"]
+            for shard in self.bot.user_prefs.shards(self.shard_indices):
+                key = str(shard)
+                scanned = 0
+                user_id_str = None
+                chunk: List[Tuple[str, Optional[str]]] = []
+                for user_id_str, user_prefs in self.bot.user_prefs.iter_shard_users(shard, last.get(key, "")):
+                    scanned += 1
+                    if user_prefs.get("subscribed"):
+                        chunk.append((user_id_str, user_prefs.get("favorite_topic")))
+                    if scanned >= self.chunk_size:
+                        await self._deliver(chunk, checkpoint, queue)
+                        last[key] = user_id_str
+                        await self._save_checkpoint(checkpoint)
+                        scanned = 0
+                        chunk = []
+
+                if scanned:
+                    await self._deliver(chunk, checkpoint, queue)
+                    last[key] = user_id_str
+                    await self._save_checkpoint(checkpoint)
+
+            checkpoint["finished"] = True
+            await self._save_checkpoint(checkpoint)
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        logger.info(f"Рассылка за {today}: отправлено {checkpoint['sent']}, ошибок {checkpoint['failed']}, "
+                    f"{time.perf_counter() - started:.1f} с")
+        return checkpoint
+
+    def _fact_for(self, topic: Optional[str], checkpoint: Dict) -> Tuple[str, str]:
+        """Возвращает (заголовок, факт) темы; факт выбирается один раз за прогон"""
+        key = topic or ""
+        fact = checkpoint["facts"].get(key)
+        if fact is None:
+            fact = (self.bot.data_manager.get_fact_by_topic(topic) if topic else None) \
+                or self.bot.data_manager.get_random_fact()
+            checkpoint["facts"][key] = fact
+        return (topic.capitalize() if topic else "Случайный факт"), fact
+
+    async def _deliver(self, chunk: List[Tuple[str, Optional[str]]], checkpoint: Dict, queue: asyncio.Queue):
+        """Ставит порцию в очередь отправки, сгруппировав по темам, и ждет её доставки"""
+        groups: Dict[Optional[str], List[str]] = {}
+        for user_id_str, topic in chunk:
+            groups.setdefault(topic, []).append(user_id_str)
+
+        for topic, user_ids in groups.items():
+            title, fact = self._fact_for(topic, checkpoint)
+            text = f"🌅 Факт дня — {title}:\n\n{fact}"
+            for user_id_str in user_ids:
+                await queue.put((user_id_str, text))
+        await queue.join()
+
+    async def _worker(self, queue: asyncio.Queue, checkpoint: Dict):
+        """Отправляет сообщения из очереди, пока не получит None"""
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                user_id_str, text = item
+                try:
+                    await self.bot.application.bot.send_message(chat_id=int(user_id_str), text=text)
+                    checkpoint["sent"] += 1
+                    BROADCAST_MESSAGES.inc("sent")
+                except Forbidden:
+                    # Пользователь заблокировал бота — больше не пишем ему
+                    self.bot.user_prefs.set_subscribed(int(user_id_str), False)
+                    checkpoint["failed"] += 1
+                    BROADCAST_MESSAGES.inc("blocked")
+                except Exception as e:
+                    # Любая ошибка отправки не должна останавливать пул: иначе queue.join() не дождется порции
+                    logger.debug(f"Не удалось отправить факт дня пользователю {user_id_str}: {e}")
+                    checkpoint["failed"] += 1
+                    BROADCAST_MESSAGES.inc("failed")
+            finally:
+                queue.task_done()
 
 
 class FactsBot:
     """Основной класс бота для интересных фактов"""
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, request: Optional[BaseRequest] = None,
+                 data_manager: Optional[FactsDataManager] = None, user_prefs: Optional[UserPreferences] = None,
+                 rate_limiter: Optional[BaseRateLimiter] = None):
         self.token = token
-        self.data_manager = FactsDataManager()
-        self.user_prefs = UserPreferences()
-
-        # Инициализация приложения
-        self.application = Application.builder().token(token).build()
+        # Взвешенный выбор включается только явно (FACT_SELECTOR=weighted)
+        selector = WeightedFactSelector() if data_manager is None and FACT_SELECTOR == "weighted" else None
+        if data_manager is not None and user_prefs is not None:
+            self.data_manager = data_manager
+            self.user_prefs = user_prefs
+        elif STORAGE_BACKEND == "sqlite":
+            self.data_manager = FactsDataManager(storage=SQLiteFactsStorage(SQLITE_DB), selector=selector)
+            self.user_prefs = UserPreferences(storage=SQLitePreferencesStorage(SQLITE_DB))
+        elif PREFERENCES_SHARDS:
+            self.data_manager = FactsDataManager(selector=selector)
+            self.user_prefs = UserPreferences(storage=ShardedPreferencesStorage(PREFERENCES_DIR, PREFERENCES_SHARDS))
+        else:
+            self.data_manager = FactsDataManager(selector=selector)
+            self.user_prefs = UserPreferences()
+
+        # Отложенная запись изменений на диск: сериализация и запись идут в пуле потоков,
+        # а журнал настроек сжимается фоновым сбросом, а не внутри обработчика
+        self.flusher = WriteBehindFlusher()
+        self.flusher.register(self.data_manager.flush_async)
+        self.flusher.register(self.user_prefs.flush_async)
+        self.user_prefs.storage.deferred_compaction = True
+
+        # Инициализация приложения: обновления разных чатов обрабатываются параллельно
+        with startup_phase("application"):
+            self.update_processor = PerChatUpdateProcessor(CONCURRENT_UPDATES)
+            builder = (
+                Application.builder()
+                .token(token)
+                .concurrent_updates(self.update_processor)
+                .post_init(self._post_init)
+                .post_shutdown(self._post_shutdown)
+            )
+            if TELEGRAM_API_URL:
+                builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+            # Все вызовы Bot API (кроме длинного опроса getUpdates) проходят через учет длительности
+            builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256)))
+            # Исходящие сообщения планируются с учетом лимитов Telegram
+            self.rate_limiter = rate_limiter or OutboundRateLimiter()
+            builder = builder.rate_limiter(self.rate_limiter)
+            self.application = builder.build()
+
+        # Кэш готовых клавиатур: почти все ответы используют одни и те же
+        self._keyboards: Dict[Tuple, object] = {}
+        self._keyboards_version = self.data_manager.topics_version
+
+        # Кэш ответов на инлайн-запросы по нормализованному тексту запроса
+        self.inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+        # Маршрутизаторы для данных инлайн-кнопок и текста кнопок клавиатуры
+        self.callback_router = UpdateRouter("callback")
+        self.keyboard_router = UpdateRouter("keyboard")
+        self._setup_routes()
+
+        # Ежедневная рассылка подписчикам
+        self.broadcast = DailyBroadcast(self)
+
+        # Метрики: эндпоинт (если задан порт) и текущие значения очередей и кэшей
+        self.metrics_port = METRICS_PORT
+        self.metrics_server: Optional[MetricsServer] = None
+        METRICS.register_collector("bot", self._collect_metrics)
 
         # Регистрация обработчиков
-        self._setup_handlers()
+        with startup_phase("handlers"):
+            self._setup_handlers()
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+    async def _post_init(self, application: Application):
+        """Запускает фоновые задачи после инициализации приложения"""
+        if application.job_queue is not None:
+            application.job_queue.run_repeating(
+                self._flush_stats_job, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL, name="flush_stats"
+            )
+            self.broadcast.schedule(application.job_queue)
+        else:
+            # Без job_queue (не установлен APScheduler) статистику сбрасывает фоновый сброс на диск
+            self.flusher.register(self.user_prefs.flush_stats)
+            logger.warning("job_queue недоступен: ежедневная рассылка отключена")
+        self.flusher.start()
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(METRICS, METRICS_LISTEN, self.metrics_port)
+            await self.metrics_server.start()
+        # Поисковые индексы читаются из снимка (или строятся) в пуле потоков до приема обновлений,
+        # иначе первый инлайн-запрос или /add загрузил бы их прямо в цикле событий
+        try:
+            await self.data_manager.warm_up()
+        except Exception as e:
+            logger.error(f"Ошибка подготовки поисковых индексов: {e}")
+        logger.info(f"Бот готов к работе. Фазы запуска: {_format_startup_timings()}")
+        # Настройки пользователей готовятся в фоне, уже во время работы
+        self._warm_up_task = asyncio.get_running_loop().create_task(self._warm_up())
+
+    async def _warm_up(self):
+        """Фоновая подготовка данных, которые не нужны для ответа на первые обновления"""
+        try:
+            await self.user_prefs.warm_up()
+            logger.info(f"Фоновая подготовка данных завершена. Фазы запуска: {_format_startup_timings()}")
+        except Exception as e:
+            logger.error(f"Ошибка фоновой подготовки данных: {e}")
+
+    async def _flush_stats_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Периодическая задача: переносит буфер статистики в настройки пользователей"""
+        flushed = self.user_prefs.flush_stats()
+        if flushed:
+            logger.debug(f"Статистика сохранена для пользователей: {flushed}")
+
+    async def _post_shutdown(self, application: Application):
+        """Останавливает фоновые задачи и сохраняет несохраненные данные"""
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            try:
+                await self._warm_up_task
+            except asyncio.CancelledError:
+                pass
+        await self.flusher.stop()
+        # Дожидаемся записей, начатых в пуле потоков, и сохраняем все оставшееся
+        await self.data_manager.save_async()
+        self.user_prefs.flush_stats()
+        await self.user_prefs.save_async()
+        self.data_manager.close()
+        self.user_prefs.close()
+        logger.info(f"Статистика обработки обновлений: {self.update_processor.stats()}")
+        logger.info(f"Статистика действий кнопок: {self.callback_router.stats()}")
 
     def _setup_handlers(self):
         """Настройка всех обработчиков команд и сообщений"""
 
         # Обработчики команд
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(CommandHandler("random", self.random_fact_command))
-        self.application.add_handler(CommandHandler("fact", self.fact_command))
-        self.application.add_handler(CommandHandler("topics", self.topics_command))
-        self.application.add_handler(CommandHandler("myfact", self.myfact_command))
-        self.application.add_handler(CommandHandler("settings", self.settings_command))
-        self.application.add_handler(CommandHandler("add", self.add_fact_command))
-        self.application.add_handler(CommandHandler("stats", self.stats_command))
+        commands = (
+            ("start", self.start_command),
+            ("help", self.help_command),
+            ("random", self.random_fact_command),
+            ("fact", self.fact_command),
+            ("topics", self.topics_command),
+            ("myfact", self.myfact_command),
+            ("settings", self.settings_command),
+            ("add", self.add_fact_command),
+            ("stats", self.stats_command),
+            ("search", self.search_command),
+            ("subscribe", self.subscribe_command),
+            ("unsubscribe", self.unsubscribe_command),
+        )
+        for command, callback in commands:
+            self.application.add_handler(CommandHandler(command, self._instrument("command", command, callback)))
 
         # Обработчики callback-запросов (кнопки)
         self.application.add_handler(CallbackQueryHandler(self.button_handler))
 
+        # Инлайн-режим (@bot запрос)
+        self.application.add_handler(InlineQueryHandler(self._instrument("inline", "query", self.inline_query_handler)))
+
         # Обработчик для кнопок клавиатуры
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_keyboard_input))
 
         # Обработчик ошибок
         self.application.add_error_handler(self.error_handler)
 
-    def _create_topic_keyboard(self) -> InlineKeyboardMarkup:
-        """Создает клавиатуру с темами"""
+    @staticmethod
+    def _instrument(kind: str, name: str, callback: Callable) -> Callable:
+        """Оборачивает обработчик учетом длительности и исключений в метриках"""
+        async def instrumented(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(kind, name)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, kind, name)
+        return instrumented
+
+    def _collect_metrics(self) -> List[Tuple[str, str, str, float]]:
+        """Текущие значения очереди обновлений, кэшей и буферов для эндпоинта метрик"""
+        stats = self.update_processor.stats()
+        return [
+            ("factsbot_updates_in_progress", "gauge", "Обновления в обработке", stats["in_progress"]),
+            ("factsbot_updates_queue_depth", "gauge", "Обновления, ожидающие своей очереди", stats["queue_depth"]),
+            ("factsbot_updates_active_chats", "gauge", "Чаты с обновлениями в работе", stats["active_chats"]),
+            ("factsbot_updates_processed_total", "counter", "Обработанные обновления", stats["processed"]),
+            ("factsbot_inline_cache_hits_total", "counter", "Попадания в кэш инлайн-запросов", self.inline_cache.hits),
+            ("factsbot_inline_cache_misses_total", "counter", "Промахи кэша инлайн-запросов", self.inline_cache.misses),
+            ("factsbot_stats_buffer_users", "gauge", "Пользователи с несохраненной статистикой",
+             len(self.user_prefs._stats_buffer)),
+            ("factsbot_user_cache_records", "gauge", "Записи пользователей в кэше", len(self.user_prefs.records)),
+            ("factsbot_user_cache_hits_total", "counter", "Попадания в кэш пользователей", self.user_prefs.records.hits),
+            ("factsbot_user_cache_misses_total", "counter", "Промахи кэша пользователей",
+             self.user_prefs.records.misses),
+            ("factsbot_user_cache_evictions_total", "counter", "Вытеснения из кэша пользователей",
+             self.user_prefs.records.evictions),
+            ("factsbot_facts", "gauge", "Число фактов в базе", len(self.data_manager._fact_index)),
+        ]
+
+    def _cached_keyboard(self, key: Tuple, build: Callable[[], object]):
+        """Возвращает клавиатуру из кэша, создавая её при первом обращении"""
+        # Клавиатуры, зависящие от списка тем, сбрасываются при появлении новой темы
+        if self._keyboards_version != self.data_manager.topics_version:
+            self._keyboards = {k: v for k, v in self._keyboards.items() if k[0] not in ("topics", "setfav")}
+            self._keyboards_version = self.data_manager.topics_version
+
+        markup = self._keyboards.get(key)
+        if markup is None:
+            markup = self._keyboards[key] = build()
+        return markup
+
+    def _build_topic_rows(self, callback_prefix: str) -> List[List[InlineKeyboardButton]]:
+        """Создает ряды кнопок с темами (по 2 в ряд)"""
         topics = self.data_manager.get_topics()
         keyboard = []
 
-        # Создаем кнопки по 2 в ряд
         for i in range(0, len(topics), 2):
             row = []
             for j in range(2):
@@ -388,21 +3978,48 @@ class FactsBot:
                     topic = topics[i + j]
                     row.append(InlineKeyboardButton(
                         topic.capitalize(),
-                        callback_data=f"topic_{topic}"
+                        callback_data=f"{callback_prefix}{topic}"
                     ))
             if row:
                 keyboard.append(row)
 
+        return keyboard
+
+    def _create_topic_keyboard(self) -> InlineKeyboardMarkup:
+        """Создает клавиатуру с темами"""
+        return self._cached_keyboard(("topics",), self._build_topic_keyboard)
+
+    def _build_topic_keyboard(self) -> InlineKeyboardMarkup:
+        keyboard = self._build_topic_rows("topic_")
+
         # Добавляем кнопку для случайного факта
         keyboard.append([InlineKeyboardButton("🎲 Случайный факт", callback_data="random")])
 
         return InlineKeyboardMarkup(keyboard)
 
+    def _create_favorite_keyboard(self) -> InlineKeyboardMarkup:
+        """Создает клавиатуру выбора любимой темы"""
+        return self._cached_keyboard(("setfav",), self._build_favorite_keyboard)
+
+    def _build_favorite_keyboard(self) -> InlineKeyboardMarkup:
+        keyboard = self._build_topic_rows("setfav_")
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="settings")])
+        return InlineKeyboardMarkup(keyboard)
+
     def _create_fact_keyboard(self, topic: str = None) -> InlineKeyboardMarkup:
         """Создает клавиатуру под фактом"""
+        # Тема может прийти из текста пользователя: ключ кэша приводим к одному виду,
+        # чтобы «Космос», «космос » и «КОСМОС» не плодили отдельные клавиатуры
+        if topic:
+            topic = topic.strip().casefold()
+        if not topic or topic == "random":
+            topic = None
+        return self._cached_keyboard(("fact", topic), lambda: self._build_fact_keyboard(topic))
+
+    def _build_fact_keyboard(self, topic: Optional[str]) -> InlineKeyboardMarkup:
         keyboard = []
 
-        if topic and topic != "random":
+        if topic:
             keyboard.append([
                 InlineKeyboardButton("📚 Еще по этой теме", callback_data=f"topic_{topic}"),
                 InlineKeyboardButton("⭐ В избранное", callback_data=f"fav_{topic}")
@@ -427,6 +4044,9 @@ class FactsBot:
 
     def _create_main_keyboard(self) -> ReplyKeyboardMarkup:
         """Создает основную клавиатуру"""
+        return self._cached_keyboard(("main",), self._build_main_keyboard)
+
+    def _build_main_keyboard(self) -> ReplyKeyboardMarkup:
         keyboard = [
             ["🎲 Случайный факт", "📚 Выбрать тему"],
             ["⭐ Мой факт", "📖 Все темы"],
@@ -435,6 +4055,46 @@ class FactsBot:
         ]
         return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+    def _next_random_fact(self, user_id: Optional[int]) -> str:
+        """Выдает случайный факт без повторов, пока колода пользователя не закончится"""
+        if not user_id:
+            return self.data_manager.get_random_fact()
+
+        fact = self._pick_fact(user_id, None)
+        if fact:
+            return fact
+
+        deck = self.user_prefs.get_fact_deck(user_id, "random")
+        fact, deck = self.data_manager.draw_random_fact(deck)
+        if deck:
+            self.user_prefs.set_fact_deck(user_id, "random", deck)
+        return fact
+
+    def _next_topic_fact(self, user_id: Optional[int], topic: str) -> Optional[str]:
+        """Выдает факт по теме без повторов, пока колода пользователя не закончится"""
+        if not user_id:
+            return self.data_manager.get_fact_by_topic(topic)
+
+        fact = self._pick_fact(user_id, topic.lower())
+        if fact:
+            return fact
+
+        deck_key = f"topic_{topic.lower()}"
+        deck = self.user_prefs.get_fact_deck(user_id, deck_key)
+        fact, deck = self.data_manager.draw_fact_by_topic(topic, deck)
+        if fact:
+            self.user_prefs.set_fact_deck(user_id, deck_key, deck)
+        return fact
+
+    def _pick_fact(self, user_id: int, topic: Optional[str]) -> Optional[str]:
+        """Взвешенный выбор с предпочтением непоказанных пользователю фактов (None — выбор отключен)"""
+        if self.data_manager.selector is None:
+            return None
+        fact = self.data_manager.pick_fact(topic, self.user_prefs.get_seen_facts(user_id))
+        if fact:
+            self.user_prefs.add_seen_fact(user_id, FactsDataManager.fact_key(fact))
+        return fact
+
     async def _safe_edit_message(self, query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, parse_mode: Optional[str] = None):
         """
         Безопасно редактирует сообщение из callback_query.
@@ -449,10 +4109,13 @@ class FactsBot:
                 # Если редактирование не удалось — отправляем новое сообщение в тот же чат
                 if query.message and query.message.chat_id:
                     await query.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+                    EDIT_FALLBACKS.inc("reply")
                 else:
                     # как запасной вариант — отвечаем на callback
                     await query.answer(text, show_alert=False)
+                    EDIT_FALLBACKS.inc("answer")
             except Exception as e2:
+                EDIT_FALLBACKS.inc("failed")
                 logger.error(f"Не удалось отправить запасное сообщение: {e2}")
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -492,9 +4155,14 @@ class FactsBot:
             "⚙️ /settings - Настройки бота\n"
             "📝 /add - Добавить свой факт\n"
             "📊 /stats - Ваша статистика\n"
-            "❓ /help - Эта справка\n\n"
+            "🔎 /search [слова] - Поиск по фактам\n"
+            "🌅 /subscribe - Факт дня по любимой теме каждый день\n"
+            "🔕 /unsubscribe - Отписаться от факта дня\n"
+            "❓ /help - Эта справка\n"
+            "💬 @имя_бота [слова] - Факты в любом чате (инлайн-режим)\n\n"
             "Примеры:\n"
             "`/fact животные` - факт о животных\n"
+            "`/search кит` - факты, где упоминается кит\n"
             "`/add наука \"Новый факт\"` - добавить факт\n\n"
         )
         await update.message.reply_text(help_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]]))
@@ -503,21 +4171,8 @@ class FactsBot:
         """Обработчик команды /random - случайный факт"""
         user_id = update.effective_user.id if update.effective_user else None
 
-        # Добавляем хранение последнего факта для пользователя
-        if 'last_fact' not in context.user_data:
-            context.user_data['last_fact'] = None
-
-        # Получаем случайный факт
-        fact = self.data_manager.get_random_fact()
-
-        # Если факт совпадает с предыдущим, пробуем еще раз (максимум 3 попытки)
-        attempts = 0
-        while fact == context.user_data.get('last_fact') and attempts < 3:
-            fact = self.data_manager.get_random_fact()
-            attempts += 1
-
-        # Сохраняем текущий факт
-        context.user_data['last_fact'] = fact
+        # Получаем случайный факт из колоды пользователя (без повторов до конца колоды)
+        fact = self._next_random_fact(user_id)
 
         # Обновляем статистику
         if user_id:
@@ -548,7 +4203,7 @@ class FactsBot:
 
         if context.args:
             topic = ' '.join(context.args)
-            fact = self.data_manager.get_fact_by_topic(topic)
+            fact = self._next_topic_fact(user_id, topic)
 
             if fact:
                 # Обновляем статистику
@@ -603,7 +4258,7 @@ class FactsBot:
         favorite_topic = self.user_prefs.get_favorite_topic(user_id)
 
         if favorite_topic:
-            fact = self.data_manager.get_fact_by_topic(favorite_topic)
+            fact = self._next_topic_fact(user_id, favorite_topic)
 
             if fact:
                 # Обновляем статистику
@@ -658,6 +4313,27 @@ class FactsBot:
             parse_mode='Markdown'
         )
 
+    async def subscribe_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /subscribe - подписка на факт дня"""
+        user_id = update.effective_user.id
+        self.user_prefs.set_subscribed(user_id, True)
+        favorite_topic = self.user_prefs.get_favorite_topic(user_id)
+        topic_text = f"по теме «{favorite_topic.capitalize()}»" if favorite_topic else "на случайную тему"
+
+        await update.message.reply_text(
+            f"🌅 Вы подписаны на факт дня! Каждый день в {BROADCAST_TIME} (UTC) я пришлю факт {topic_text}.\n\n"
+            "Любимую тему можно выбрать в /settings, отписаться — /unsubscribe.",
+            reply_markup=self._create_main_keyboard()
+        )
+
+    async def unsubscribe_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /unsubscribe - отписка от факта дня"""
+        self.user_prefs.set_subscribed(update.effective_user.id, False)
+        await update.message.reply_text(
+            "🔕 Вы отписались от факта дня. Вернуться можно командой /subscribe.",
+            reply_markup=self._create_main_keyboard()
+        )
+
     async def add_fact_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /add - добавление факта"""
         if context.args and len(context.args) >= 2:
@@ -674,10 +4350,24 @@ class FactsBot:
                     await update.message.reply_text("⚠️ Текст факта слишком длинный (максимум 500 символов).")
                     return
 
-                # Добавляем факт
-                success = self.data_manager.add_fact(topic, fact_text)
+                # Проверяем, нет ли уже такого или очень похожего факта
+                duplicate = self.data_manager.find_duplicate(fact_text)
+                if duplicate:
+                    duplicate_topic, duplicate_fact, _ = duplicate
+                    await update.message.reply_text(
+                        f"⚠️ Похожий факт уже есть в теме '{duplicate_topic.capitalize()}':\n\n"
+                        f"{duplicate_fact}\n\n"
+                        "Попробуйте добавить что-нибудь новое!",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]])
+                    )
+                    return
+
+                # Добавляем факт (дубликаты уже проверены выше)
+                success = self.data_manager.add_fact(topic, fact_text, check_duplicates=False)
 
                 if success:
+                    # Факт пользователя сохраняется сразу, не дожидаясь фонового сброса
+                    await self.data_manager.save_async()
                     await update.message.reply_text(
                         f"✅ Факт успешно добавлен в тему '{topic.capitalize()}'!\n\n"
                         f"📝 Ваш факт:\n{fact_text}\n\n"
@@ -704,6 +4394,16 @@ class FactsBot:
                         [[InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]])
             )
 
+    @staticmethod
+    def _format_last_active(last_active) -> str:
+        """Форматирует время активности: epoch-секунды или ISO-строка из старых настроек"""
+        try:
+            if isinstance(last_active, (int, float)):
+                return datetime.fromtimestamp(last_active).strftime("%d.%m.%Y %H:%M")
+            return datetime.fromisoformat(last_active).strftime("%d.%m.%Y %H:%M")
+        except Exception:
+            return str(last_active)
+
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /stats - статистика"""
         user_id = update.effective_user.id
@@ -722,181 +4422,120 @@ class FactsBot:
             message += "⭐ Любимая тема: не установлена\n"
 
         if stats.get("last_active"):
-            try:
-                last_active = datetime.fromisoformat(stats["last_active"]).strftime("%d.%m.%Y %H:%M")
-                message += f"🕐 Последняя активность: {last_active}\n"
-            except Exception:
-                message += f"🕐 Последняя активность: {stats.get('last_active')}\n"
+            message += f"🕐 Последняя активность: {self._format_last_active(stats['last_active'])}\n"
 
         keyboard = [[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]]
 
         await update.message.reply_text(message, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
-    async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик нажатий на инлайн-кнопки"""
-        if not update.callback_query:
-            return
-
-        query = update.callback_query
-        await query.answer()
-
-        user_id = update.effective_user.id
-        data = query.data
-
-        try:
-            if data == "random":
-                # Случайный факт
-                fact = self.data_manager.get_random_fact()
-                self.user_prefs.update_stats(user_id)
-                message = f"🎲 Случайный факт:\n\n{fact}"
-                reply_markup = self._create_fact_keyboard()
+    def _setup_routes(self):
+        """Регистрирует действия инлайн-кнопок и кнопок основной клавиатуры"""
+        callbacks = self.callback_router
+        callbacks.add("random", self._on_random)
+        callbacks.add("topics", self._on_topics)
+        callbacks.add("topic", self._on_topic, with_argument=True)
+        callbacks.add("fav", self._on_fav, with_argument=True)
+        callbacks.add("set_favorite", self._on_set_favorite)
+        callbacks.add("setfav", self._on_setfav, with_argument=True)
+        callbacks.add("clear_favorite", self._on_clear_favorite)
+        callbacks.add("settings", self._on_settings)
+        callbacks.add("add_fact", self._on_add_fact)
+        callbacks.add("stats", self._on_stats)
+        callbacks.add("main_menu", self._on_main_menu)
+        callbacks.set_fallback(self._on_unknown_callback)
+
+        keyboard = self.keyboard_router
+        keyboard.add("🎲 Случайный факт", self._keyboard_action(self.random_fact_command))
+        keyboard.add("📚 Выбрать тему", self._keyboard_action(self.topics_command))
+        keyboard.add("📖 Все темы", self._keyboard_action(self.topics_command))
+        keyboard.add("⭐ Мой факт", self._keyboard_action(self.myfact_command))
+        keyboard.add("⚙️ Настройки", self._keyboard_action(self.settings_command))
+        keyboard.add("📊 Статистика", self._keyboard_action(self.stats_command))
+        keyboard.add("📝 Добавить факт", self._keyboard_action(self.add_fact_command))
+        keyboard.add("❓ Помощь", self._keyboard_action(self.help_command))
+        keyboard.set_fallback(self._on_free_text)
 
-            elif data == "topics":
-                # Показать все темы
-                topics = self.data_manager.get_topics()
-                topics_list = "\n".join([f"• {topic.capitalize()}" for topic in topics])
-                message = f"📚 Доступные темы:\n\n{topics_list}\n\nВыберите тему:"
-                reply_markup = self._create_topic_keyboard()
+    @staticmethod
+    def _keyboard_action(command):
+        """Оборачивает обработчик команды в действие маршрутизатора клавиатуры"""
+        async def action(update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+            await command(update, context)
+        return action
+
+    def _format_search_results(self, query: str, results: List[Tuple[str, str]]) -> str:
+        """Формирует текст с результатами поиска"""
+        lines = [f"• {fact} ({topic.capitalize()})" for topic, fact in results]
+        return f"🔎 Результаты поиска «{query}»:\n\n" + "\n\n".join(lines)
+
+    async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /search [слова] - поиск по фактам"""
+        if not context.args:
+            await update.message.reply_text(
+                "🔎 Использование:\n"
+                "`/search [слова]`\n\n"
+                "Пример:\n"
+                "`/search кит`",
+                parse_mode='Markdown'
+            )
+            return
 
-            elif data.startswith("topic_"):
-                # Факт по теме
-                topic = data[6:]  # Убираем "topic_"
-                fact = self.data_manager.get_fact_by_topic(topic)
+        query = ' '.join(context.args)
+        results = self.data_manager.search_facts(query)
+        back = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]])
 
-                if fact:
-                    self.user_prefs.update_stats(user_id)
-                    message = f"📖 Факт о {topic.capitalize()}:\n\n{fact}"
-                    reply_markup = self._create_fact_keyboard(topic)
-                else:
-                    message = f"⚠️ Не удалось найти факты по теме '{topic}'."
-                    reply_markup = self._create_topic_keyboard()
+        if results:
+            if update.effective_user:
+                self.user_prefs.update_stats(update.effective_user.id)
+            # Запрос пользователя может содержать символы разметки, поэтому без parse_mode
+            await update.message.reply_text(self._format_search_results(query, results), reply_markup=back)
+        else:
+            await update.message.reply_text(f"🔎 По запросу «{query}» ничего не найдено.", reply_markup=back)
 
-            elif data.startswith("fav_"):
-                # Добавить в избранное
-                topic = data[4:]  # Убираем "fav_"
-                self.user_prefs.set_favorite_topic(user_id, topic)
+    async def inline_query_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик инлайн-запросов: факты, подходящие по началу слов или названию темы"""
+        inline_query = update.inline_query
+        if not inline_query:
+            return
 
-                fact = self.data_manager.get_fact_by_topic(topic)
-                if fact:
-                    message = f"⭐ Тема '{topic.capitalize()}' добавлена в избранное!"
-                    reply_markup = self._create_fact_keyboard()
-
-            elif data == "set_favorite":
-                # Установить любимую тему
-                topics = self.data_manager.get_topics()
-                keyboard = []
-
-                for i in range(0, len(topics), 2):
-                    row = []
-                    for j in range(2):
-                        if i + j < len(topics):
-                            topic = topics[i + j]
-                            row.append(InlineKeyboardButton(
-                                topic.capitalize(),
-                                callback_data=f"setfav_{topic}"
-                            ))
-                    if row:
-                        keyboard.append(row)
-
-                keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="settings")])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                message = "⭐ Выберите любимую тему:"
-
-            elif data.startswith("setfav_"):
-                # Установить выбранную тему как любимую
-                topic = data[7:]  # Убираем "setfav_"
-                self.user_prefs.set_favorite_topic(user_id, topic)
-                message = f"✅ Любимая тема установлена: {topic.capitalize()}"
-                reply_markup = InlineKeyboardMarkup([[
-                    InlineKeyboardButton("📖 Факт по теме", callback_data=f"topic_{topic}"),
-                    InlineKeyboardButton("⚙️ Настройки", callback_data="settings")
-                ]])
-
-            elif data == "clear_favorite":
-                # Очистить избранное
-                self.user_prefs.set_favorite_topic(user_id, None)
-                message = "✅ Любимая тема удалена."
-                reply_markup = InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⚙️ Настройки", callback_data="settings"),
-                    InlineKeyboardButton("🔙 Главная", callback_data="main_menu")
-                ]])
-
-            elif data == "settings":
-                # Настройки
-                favorite_topic = self.user_prefs.get_favorite_topic(user_id)
-
-                keyboard = [
-                    [InlineKeyboardButton("📚 Выбрать любимую тему", callback_data="set_favorite")],
-                    [InlineKeyboardButton("🗑️ Очистить избранное", callback_data="clear_favorite")],
-                    [InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]
-                ]
-
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                if favorite_topic:
-                    message = f"⚙️ Настройки:\n\n⭐ Любимая тема: {favorite_topic.capitalize()}"
-                else:
-                    message = "⚙️ Настройки:\n\n⭐ Любимая тема: не установлена"
-
-            elif data == "add_fact":
-                # Добавить факт
-                message = (
-                    "📝 Добавление факта:\n\n"
-                    "Используйте команду: `/add тема \"Текст факта\"`\n\n"
-                    "Пример:\n"
-                    "`/add животные \"Ваш интересный факт\"`\n\n"
-                    "Или вернитесь назад:"
+        key = ' '.join(FactPrefixIndex.normalize(inline_query.query))
+        results = self.inline_cache.get(key)
+        if results is None:
+            if key:
+                matches = self.data_manager.prefix_search(key)
+            else:
+                # Пустой запрос — несколько случайных фактов, их не кэшируем
+                matches = [(index, "случайные", fact) for index, fact in enumerate(
+                    {self.data_manager.get_random_fact() for _ in range(10)})]
+            # Объекты результатов неизменяемы, поэтому один кортеж можно отдавать многим запросам
+            results = tuple(
+                InlineQueryResultArticle(
+                    id=str(doc_id),
+                    title=fact if len(fact) <= 64 else fact[:63] + "…",
+                    description=topic.capitalize(),
+                    input_message_content=InputTextMessageContent(f"📖 {fact}"),
                 )
-                reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]])
-
-            elif data == "stats":
-                # Статистика
-                stats = self.user_prefs.get_user_stats(user_id)
-                favorite_topic = stats.get("favorite_topic")
+                for doc_id, topic, fact in matches
+            )
+            if key:
+                self.inline_cache.put(key, results)
 
-                message = (
-                    f"📊 Ваша статистика:\n\n"
-                    f"👤 Пользователь: {update.effective_user.first_name}\n"
-                    f"📖 Фактов просмотрено: {stats.get('total_facts', 0)}\n"
-                )
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TTL if key else 0)
 
-                if favorite_topic:
-                    message += f"⭐ Любимая тема: {favorite_topic.capitalize()}\n"
-                else:
-                    message += "⭐ Любимая тема: не установлена\n"
+    async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик нажатий на инлайн-кнопки"""
+        if not update.callback_query:
+            return
 
-                if stats.get("last_active"):
-                    try:
-                        last_active = datetime.fromisoformat(stats["last_active"]).strftime("%d.%m.%Y %H:%M")
-                        message += f"🕐 Последняя активность: {last_active}\n"
-                    except Exception:
-                        message += f"🕐 Последняя активность: {stats.get('last_active')}\n"
-
-                keyboard = [[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-            elif data == "main_menu":
-                # Главное меню
-                message = (
-                    f"Главное меню, {update.effective_user.first_name}! 👋\n\n"
-                    "Выберите действие:"
-                )
+        query = update.callback_query
+        await query.answer()
 
-                # Сначала редактируем текст, а затем удаляем inline-клавиатуру (если нужно)
-                await query.edit_message_text(message, parse_mode='Markdown')
-                try:
-                    await query.edit_message_reply_markup(reply_markup=self._create_fact_keyboard())
-                except Exception:
-                    # если не получилось убирать reply_markup — просто игнорируем
-                    pass
+        try:
+            result = await self.callback_router.dispatch(query.data or "", update, context)
+            if result is None:
+                # Действие уже само ответило пользователю
                 return
 
-
-            else:
-                # Неизвестная команда
-                message = "⚠️ Неизвестная команда."
-                reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]])
-
+            message, reply_markup = result
             # Редактируем сообщение с новым текстом и кнопками (безопасно)
             await self._safe_edit_message(query=query, text=message, reply_markup=reply_markup, parse_mode='Markdown')
 
@@ -914,51 +4553,168 @@ class FactsBot:
                 except Exception:
                     logger.exception("Не удалось уведомить пользователя об ошибке.")
 
+    async def _on_random(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Случайный факт"""
+        user_id = update.effective_user.id
+        fact = self._next_random_fact(user_id)
+        self.user_prefs.update_stats(user_id)
+        return f"🎲 Случайный факт:\n\n{fact}", self._create_fact_keyboard()
+
+    async def _on_topics(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Показать все темы"""
+        topics = self.data_manager.get_topics()
+        topics_list = "\n".join([f"• {topic.capitalize()}" for topic in topics])
+        return f"📚 Доступные темы:\n\n{topics_list}\n\nВыберите тему:", self._create_topic_keyboard()
+
+    async def _on_topic(self, update: Update, context: ContextTypes.DEFAULT_TYPE, topic: str):
+        """Факт по теме"""
+        user_id = update.effective_user.id
+        fact = self._next_topic_fact(user_id, topic)
+
+        if fact:
+            self.user_prefs.update_stats(user_id)
+            return f"📖 Факт о {topic.capitalize()}:\n\n{fact}", self._create_fact_keyboard(topic)
+        return f"⚠️ Не удалось найти факты по теме '{topic}'.", self._create_topic_keyboard()
+
+    async def _on_fav(self, update: Update, context: ContextTypes.DEFAULT_TYPE, topic: str):
+        """Добавить в избранное"""
+        self.user_prefs.set_favorite_topic(update.effective_user.id, topic)
+
+        fact = self.data_manager.get_fact_by_topic(topic)
+        if not fact:
+            return f"⚠️ Не удалось найти факты по теме '{topic}'.", self._create_topic_keyboard()
+        return f"⭐ Тема '{topic.capitalize()}' добавлена в избранное!", self._create_fact_keyboard()
+
+    async def _on_set_favorite(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Установить любимую тему"""
+        return "⭐ Выберите любимую тему:", self._create_favorite_keyboard()
+
+    async def _on_setfav(self, update: Update, context: ContextTypes.DEFAULT_TYPE, topic: str):
+        """Установить выбранную тему как любимую"""
+        self.user_prefs.set_favorite_topic(update.effective_user.id, topic)
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("📖 Факт по теме", callback_data=f"topic_{topic}"),
+            InlineKeyboardButton("⚙️ Настройки", callback_data="settings")
+        ]])
+        return f"✅ Любимая тема установлена: {topic.capitalize()}", reply_markup
+
+    async def _on_clear_favorite(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Очистить избранное"""
+        self.user_prefs.set_favorite_topic(update.effective_user.id, None)
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("⚙️ Настройки", callback_data="settings"),
+            InlineKeyboardButton("🔙 Главная", callback_data="main_menu")
+        ]])
+        return "✅ Любимая тема удалена.", reply_markup
+
+    async def _on_settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Настройки"""
+        favorite_topic = self.user_prefs.get_favorite_topic(update.effective_user.id)
+
+        keyboard = [
+            [InlineKeyboardButton("📚 Выбрать любимую тему", callback_data="set_favorite")],
+            [InlineKeyboardButton("🗑️ Очистить избранное", callback_data="clear_favorite")],
+            [InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]
+        ]
+
+        if favorite_topic:
+            message = f"⚙️ Настройки:\n\n⭐ Любимая тема: {favorite_topic.capitalize()}"
+        else:
+            message = "⚙️ Настройки:\n\n⭐ Любимая тема: не установлена"
+        return message, InlineKeyboardMarkup(keyboard)
+
+    async def _on_add_fact(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Добавить факт"""
+        message = (
+            "📝 Добавление факта:\n\n"
+            "Используйте команду: `/add тема \"Текст факта\"`\n\n"
+            "Пример:\n"
+            "`/add животные \"Ваш интересный факт\"`\n\n"
+            "Или вернитесь назад:"
+        )
+        return message, InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]])
+
+    async def _on_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Статистика"""
+        stats = self.user_prefs.get_user_stats(update.effective_user.id)
+        favorite_topic = stats.get("favorite_topic")
+
+        message = (
+            f"📊 Ваша статистика:\n\n"
+            f"👤 Пользователь: {update.effective_user.first_name}\n"
+            f"📖 Фактов просмотрено: {stats.get('total_facts', 0)}\n"
+        )
+
+        if favorite_topic:
+            message += f"⭐ Любимая тема: {favorite_topic.capitalize()}\n"
+        else:
+            message += "⭐ Любимая тема: не установлена\n"
+
+        if stats.get("last_active"):
+            message += f"🕐 Последняя активность: {self._format_last_active(stats['last_active'])}\n"
+
+        keyboard = [[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]]
+        return message, InlineKeyboardMarkup(keyboard)
+
+    async def _on_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, argument: str):
+        """Главное меню"""
+        query = update.callback_query
+        message = (
+            f"Главное меню, {update.effective_user.first_name}! 👋\n\n"
+            "Выберите действие:"
+        )
+
+        # Сначала редактируем текст, а затем удаляем inline-клавиатуру (если нужно)
+        await query.edit_message_text(message, parse_mode='Markdown')
+        try:
+            await query.edit_message_reply_markup(reply_markup=self._create_fact_keyboard())
+        except Exception:
+            # если не получилось убирать reply_markup — просто игнорируем
+            pass
+        return None
+
+    async def _on_unknown_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+        """Неизвестная команда"""
+        return "⚠️ Неизвестная команда.", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]])
+
     async def handle_keyboard_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений для кнопок клавиатуры"""
-        text = update.message.text
-
-        if text == "🎲 Случайный факт":
-            await self.random_fact_command(update, context)
-        elif text == "📚 Выбрать тему":
-            await self.topics_command(update, context)
-        elif text == "📖 Все темы":
-            await self.topics_command(update, context)
-        elif text == "⭐ Мой факт":
-            await self.myfact_command(update, context)
-        elif text == "⚙️ Настройки":
-            await self.settings_command(update, context)
-        elif text == "📊 Статистика":
-            await self.stats_command(update, context)
-        elif text == "📝 Добавить факт":
-            await self.add_fact_command(update, context)
-        elif text == "❓ Помощь":
-            await self.help_command(update, context)
-        else:
-            # Пытаемся найти факт по теме
-            fact = self.data_manager.get_fact_by_topic(text.lower())
-            if fact:
-                user_id = update.effective_user.id
-                self.user_prefs.update_stats(user_id)
+        await self.keyboard_router.dispatch(update.message.text, update, context)
 
-                message = f"📖 Факт о {text.capitalize()}:\n\n{fact}"
-                reply_markup = self._create_fact_keyboard(text.lower())
+    async def _on_free_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Пытается найти факт по теме, названной в сообщении"""
+        user_id = update.effective_user.id
+        fact = self._next_topic_fact(user_id, text.lower())
+        if fact:
+            self.user_prefs.update_stats(user_id)
 
-                await update.message.reply_text(
-                    message,
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            else:
-                await update.message.reply_text(
-                    f"🤔 Не понял ваше сообщение.\n\n"
-                    f"Попробуйте:\n"
-                    f"• Нажать на кнопку ниже\n"
-                    f"• Использовать команду /help\n"
-                    f"• Написать название темы (например, 'животные')", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(
-                        [[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]])
-                )
+            message = f"📖 Факт о {text.capitalize()}:\n\n{fact}"
+            reply_markup = self._create_fact_keyboard(text.lower())
 
+            await update.message.reply_text(
+                message,
+                reply_markup=reply_markup,
+                parse_mode='Markdown'
+            )
+            return
+
+        # Тема не найдена — ищем факты по словам сообщения
+        results = self.data_manager.search_facts(text)
+        if results:
+            self.user_prefs.update_stats(user_id)
+            await update.message.reply_text(
+                self._format_search_results(text, results),
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]])
+            )
+        else:
+            await update.message.reply_text(
+                f"🤔 Не понял ваше сообщение.\n\n"
+                f"Попробуйте:\n"
+                f"• Нажать на кнопку ниже\n"
+                f"• Использовать команду /help\n"
+                f"• Написать название темы (например, 'животные')", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(
+                    [[InlineKeyboardButton("🔙 Главная", callback_data="main_menu")]])
+            )
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ошибок бота"""
@@ -977,8 +4733,159 @@ class FactsBot:
     def run(self):
         """Запускает бота"""
         logger.info("Бот запущен...")
-        # используем простой run_polling()
-        self.application.run_polling()
+        if BOT_MODE == "webhook":
+            asyncio.run(self._run_webhook())
+        else:
+            # используем простой run_polling()
+            self.application.run_polling()
+
+    async def _run_webhook(self):
+        """Запускает бота в режиме вебхука и работает до сигнала остановки"""
+        stop_event = _stop_event_on_signals()
+        server = WebhookServer(self.application)
+
+        async def set_webhook():
+            if WEBHOOK_URL:
+                await self.application.bot.set_webhook(
+                    WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                )
+            await stop_event.wait()
+
+        await self._serve([server], set_webhook())
+
+    async def _serve(self, sources: List, until):
+        """Запускает приложение и источники обновлений, работает до завершения until"""
+        await self.application.initialize()
+        await self._post_init(self.application)
+        await self.application.start()
+        try:
+            for source in sources:
+                await source.start()
+            await until
+        finally:
+            for source in sources:
+                await source.stop()
+            await self.application.stop()
+            await self.application.shutdown()
+            await self._post_shutdown(self.application)
+
+    async def _enqueue_update(self, data: Dict):
+        """Ставит в очередь приложения обновление, полученное от фронтенда"""
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def _accept_forwarded_fact(self, item: Tuple[str, str]):
+        """Сохраняет факт, добавленный в другом рабочем процессе (только у владельца фактов)"""
+        topic, fact = item
+        if self.data_manager.add_fact(topic, fact):
+            await self.data_manager.save_async()
+
+
+def _stop_event_on_signals() -> asyncio.Event:
+    """Возвращает событие, которое выставляется по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows не поддерживает обработчики сигналов в цикле событий
+            pass
+    return stop_event
+
+
+def _run_worker(token: str, index: int, workers: int, updates, fact_queue):
+    """
+    Точка входа рабочего процесса. Процесс 0 владеет файлом фактов и принимает
+    факты от остальных; остальные перечитывают файл, когда он меняется.
+    """
+    # Остановкой рабочих процессов управляет фронтенд
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Просмотры фактов (популярность) каждый процесс считает и хранит отдельно
+    base, extension = os.path.splitext(FACT_VIEWS_FILE)
+    selector = WeightedFactSelector(f"{base}.{index}{extension}") if FACT_SELECTOR == "weighted" else None
+    if index == 0:
+        data_manager = FactsDataManager(selector=selector)
+    else:
+        data_manager = FactsDataManager(storage=ForwardingFactsStorage(_file_facts_storage(), fact_queue),
+                                        selector=selector)
+        data_manager.write_snapshot = False
+    user_prefs = UserPreferences(storage=ShardedPreferencesStorage(PREFERENCES_DIR))
+    # Общий лимит Telegram на исходящие сообщения делится между процессами
+    rate_limiter = OutboundRateLimiter(global_rate=OUTBOUND_GLOBAL_RATE / workers)
+    bot = FactsBot(token, data_manager=data_manager, user_prefs=user_prefs, rate_limiter=rate_limiter)
+    # Рассылку каждый процесс ведет только по своим шардам и со своей контрольной точкой
+    shards = user_prefs.storage.shards
+    bot.broadcast.shard_indices = [shard for shard in range(shards) if shard % workers == index]
+    base, extension = os.path.splitext(BROADCAST_CHECKPOINT)
+    bot.broadcast.checkpoint_file = f"{base}.{index}{extension}"
+    # У каждого рабочего процесса свой эндпоинт метрик: METRICS_PORT + номер процесса
+    if METRICS_PORT:
+        bot.metrics_port = METRICS_PORT + index
+    if index:
+        bot.flusher.register(data_manager.reload_if_changed_async)
+
+    readers = [ProcessQueueReader(updates, bot._enqueue_update)]
+    if index == 0:
+        readers.append(ProcessQueueReader(fact_queue, bot._accept_forwarded_fact))
+
+    async def until_finished():
+        await asyncio.gather(*(reader.finished.wait() for reader in readers))
+
+    logger.info(f"Рабочий процесс {index} запущен")
+    asyncio.run(bot._serve(readers, until_finished()))
+
+
+async def _run_front_end(token: str, queues: List, shards: int):
+    """Принимает вебхук и раздает обновления рабочим процессам до сигнала остановки"""
+    stop_event = _stop_event_on_signals()
+    server = PartitionedWebhookServer(queues, shards)
+    await server.start()
+    try:
+        if WEBHOOK_URL:
+            base_url = f"{TELEGRAM_API_URL.rstrip('/')}/bot" if TELEGRAM_API_URL else "https://api.telegram.org/bot"
+            async with Bot(token, base_url=base_url) as bot:
+                await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        logger.info(f"Обновлений передано рабочим процессам: {server.delivered}")
+
+
+def run_workers(token: str, workers: int = BOT_WORKERS):
+    """
+    Многопроцессный режим: фронтенд вебхука и workers рабочих процессов.
+    Настройки пользователей хранятся в шардах (PREFERENCES_DIR), каждый процесс
+    загружает только свои шарды; факты записывает процесс 0.
+    """
+    # Манифест шардов создается до запуска процессов, чтобы все видели одно число шардов
+    shards = ShardedPreferencesStorage(PREFERENCES_DIR).shards
+    if shards < workers:
+        logger.warning(f"Шардов настроек ({shards}) меньше, чем процессов ({workers}): часть процессов будет простаивать")
+
+    context = multiprocessing.get_context("spawn")
+    update_queues = [context.Queue() for _ in range(workers)]
+    fact_queue = context.Queue()
+    processes = [
+        context.Process(target=_run_worker, args=(token, index, workers, update_queues[index], fact_queue),
+                        name=f"factsbot-worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        asyncio.run(_run_front_end(token, update_queues, shards))
+    finally:
+        for queue in update_queues:
+            queue.put(None)
+        # Владелец фактов останавливается последним: остальные при остановке отправляют ему свои факты
+        for process in processes[1:]:
+            process.join()
+        fact_queue.put(None)
+        processes[0].join()
 
 
 def main():
@@ -988,6 +4895,10 @@ def main():
     TOKEN = "7533370824:AAFsrYHcHVhxwQCzl9_CzkX_3n2wFGLLLhQ"
 
     try:
+        if BOT_MODE == "webhook" and BOT_WORKERS > 1:
+            run_workers(TOKEN)
+            return
+
         # Создаем и запускаем бота
         bot = FactsBot(TOKEN)
         bot.run()
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import os
+
+from bot import CoalescingSaver, JournalPreferencesStorage, UserPreferences, WriteBehindFlusher
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_replay_after_crash_mid_compaction(tmp_path):
+    snapshot = str(tmp_path / "prefs.json")
+    storage = JournalPreferencesStorage(snapshot)
+    storage.load()
+    storage.append("1", "favorite_topic", "космос")
+    storage.append("2", "subscribed", True)
+
+    # Журнал отложен для сжатия, но снимок так и не записан
+    write = storage.prepare_compaction()
+    assert write is not None
+    assert os.path.exists(storage.compacting_file)
+    storage.append("1", "favorite_topic", "история")
+    storage.append("3", "subscribed", False)
+
+    reloaded = JournalPreferencesStorage(snapshot)
+    expected = {"1": {"favorite_topic": "история"}, "2": {"subscribed": True}, "3": {"subscribed": False}}
+    assert reloaded.load() == expected
+    # Загрузка довела сжатие до конца
+    assert read_json(snapshot) == expected
+    assert not os.path.exists(reloaded.compacting_file)
+
+
+def test_failed_compaction_is_retried_in_order(tmp_path):
+    prefs = UserPreferences(str(tmp_path / "prefs.json"))
+    storage = prefs.storage
+    prefs.set_favorite_topic(1, "космос")
+    storage.prepare_compaction()
+    # Следующее сжатие дописывает новый журнал после записей неудавшегося
+    prefs.set_favorite_topic(1, "наука")
+    write = storage.prepare_compaction()
+    write()
+
+    assert read_json(storage.snapshot_file) == {"1": {"favorite_topic": "наука"}}
+    assert not os.path.exists(storage.compacting_file)
+    assert JournalPreferencesStorage(storage.snapshot_file).load() == {"1": {"favorite_topic": "наука"}}
+
+
+def test_coalescing_saver_never_drops_last_write():
+    state = {"value": 0}
+    saved = []
+
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def save():
+            snapshot = state["value"]
+            started.set()
+            await release.wait()
+            saved.append(snapshot)
+
+        saver = CoalescingSaver("test", save)
+        state["value"] = 1
+        tasks = [asyncio.ensure_future(saver.run())]
+        await started.wait()
+        assert saver.busy
+        # Изменения, пришедшие во время записи, должна сохранить следующая запись
+        for i in range(2, 21):
+            state["value"] = i
+            tasks.append(asyncio.ensure_future(saver.run()))
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(scenario())
+
+    assert saved == [1, 20]
+    assert results.count(True) == 2
+
+
+def test_coalescing_saver_survives_cancelled_caller():
+    saved = []
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def save():
+            started.set()
+            await asyncio.sleep(0.01)
+            saved.append(len(saved))
+
+        saver = CoalescingSaver("test", save)
+        first = asyncio.ensure_future(saver.run())
+        await started.wait()
+        first.cancel()
+        await saver.run()
+
+    asyncio.run(scenario())
+    # Начатая запись не прервана, а следующий вызов дождался своей
+    assert saved == [0, 1]
+
+
+def test_flusher_writes_everything_on_stop():
+    flushed = []
+
+    async def flush_async():
+        await asyncio.sleep(0)
+        flushed.append("async")
+
+    def failing():
+        raise IOError("диск заполнен")
+
+    async def scenario():
+        flusher = WriteBehindFlusher(interval=3600)
+        flusher.register(lambda: flushed.append("sync"))
+        flusher.register(failing)
+        flusher.register(flush_async)
+        flusher.start()
+        await asyncio.sleep(0)
+        await flusher.stop()
+
+    asyncio.run(scenario())
+
+    # Ошибка одного хранилища не мешает сбросить остальные
+    assert flushed == ["sync", "async"]
+
+
+def test_flusher_stop_persists_preferences(tmp_path):
+    preferences_file = str(tmp_path / "prefs.json")
+    prefs = UserPreferences(preferences_file)
+    prefs.storage.deferred_compaction = True
+    prefs.storage.compact_threshold = 2
+
+    async def scenario():
+        flusher = WriteBehindFlusher(interval=3600)
+        flusher.register(prefs.flush_stats)
+        flusher.register(prefs.flush_async)
+        flusher.start()
+        prefs.set_favorite_topic(1, "космос")
+        prefs.update_stats(1)
+        await flusher.stop()
+
+    asyncio.run(scenario())
+
+    # Журнал дорос до порога и сжат в снимок фоновым сбросом
+    user_prefs = read_json(preferences_file)["1"]
+    assert user_prefs["favorite_topic"] == "космос"
+    assert user_prefs["stats"]["total_facts"] == 1
+    assert not os.path.exists(prefs.storage.compacting_file)
@@ -0,0 +1,92 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+from bot import DailyBroadcast, ShardedPreferencesStorage, SQLitePreferencesStorage, UserPreferences
+
+SUBSCRIBERS = [str(user_id) for user_id in range(100, 130) if user_id % 5]
+
+
+class StubSender:
+    def __init__(self):
+        self.sent = Counter()
+
+    async def send_message(self, chat_id, text):
+        self.sent[str(chat_id)] += 1
+
+
+class StubFacts:
+    def get_fact_by_topic(self, topic):
+        return f"Факт о теме {topic}"
+
+    def get_random_fact(self):
+        return "Случайный факт"
+
+
+class CrashingBroadcast(DailyBroadcast):
+    """Рассылка, процесс которой падает перед отправкой порции crash_at"""
+
+    def __init__(self, bot, crash_at, **kwargs):
+        super().__init__(bot, **kwargs)
+        self.crash_at = crash_at
+        self.delivered = 0
+
+    async def _deliver(self, chunk, checkpoint, queue):
+        self.delivered += 1
+        if self.delivered == self.crash_at:
+            raise RuntimeError("сбой процесса")
+        await super()._deliver(chunk, checkpoint, queue)
+
+
+@pytest.fixture(params=["journal", "sqlite", "sharded"])
+def prefs(request, tmp_path):
+    if request.param == "journal":
+        prefs = UserPreferences(str(tmp_path / "prefs.json"))
+    elif request.param == "sqlite":
+        prefs = UserPreferences(storage=SQLitePreferencesStorage(str(tmp_path / "prefs.db")))
+    else:
+        prefs = UserPreferences(storage=ShardedPreferencesStorage(str(tmp_path / "shards"), shards=4))
+    for user_id in range(100, 130):
+        prefs.set_subscribed(user_id, str(user_id) in SUBSCRIBERS)
+    yield prefs
+    prefs.close()
+
+
+def make_bot(prefs):
+    sender = StubSender()
+    return SimpleNamespace(user_prefs=prefs, data_manager=StubFacts(), application=SimpleNamespace(bot=sender)), sender
+
+
+def test_every_subscriber_gets_one_message(prefs, tmp_path):
+    bot, sender = make_bot(prefs)
+    broadcast = DailyBroadcast(bot, str(tmp_path / "checkpoint.json"), workers=3, chunk_size=4)
+
+    checkpoint = asyncio.run(broadcast.run())
+
+    assert checkpoint["finished"]
+    assert checkpoint["sent"] == len(SUBSCRIBERS)
+    assert sender.sent == Counter(SUBSCRIBERS)
+    # Повторный запуск в тот же день ничего не отправляет
+    asyncio.run(broadcast.run())
+    assert sender.sent == Counter(SUBSCRIBERS)
+
+
+def test_resume_after_crash_with_new_users(prefs, tmp_path):
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    bot, sender = make_bot(prefs)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(CrashingBroadcast(bot, 3, checkpoint_file=checkpoint_file, workers=3, chunk_size=4).run())
+    assert 0 < sum(sender.sent.values()) < len(SUBSCRIBERS)
+
+    # Пока процесс перезапускался, подписались новые пользователи: один раньше
+    # контрольной точки в порядке user_id, другой после нее
+    prefs.set_subscribed(1, True)
+    prefs.set_subscribed(999, True)
+    checkpoint = asyncio.run(DailyBroadcast(bot, checkpoint_file, workers=3, chunk_size=4).run())
+
+    assert checkpoint["finished"]
+    assert max(sender.sent.values()) == 1
+    assert all(sender.sent[user_id_str] == 1 for user_id_str in SUBSCRIBERS + ["999"])
@@ -0,0 +1,93 @@
+import argparse
+import os
+import shutil
+
+import pytest
+
+from bot import FactDeduplicator, FactsDataManager, JsonFactsStorage
+from tools import dedup
+
+FACTS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "russian_facts.json")
+
+
+def make_index(*texts):
+    stored = []
+    index = FactDeduplicator(stored.__getitem__)
+    for text in texts:
+        stored.append(text)
+        index.add(text)
+    return index
+
+
+@pytest.mark.parametrize("stored, submitted", [
+    ("Самое крупное млекопитающие - это синий кит", "Самое крупное млекопитающие - это синий кит"),
+    ("У осьминога три сердца.", "у осьминога ТРИ сердца!"),
+    ("Ёж может съесть за ночь до 200 граммов насекомых.", "Еж может съесть за ночь до 200 граммов насекомых"),
+    # Переформулировки, которые только добавляют или убирают служебные слова
+    ("Кошки проводят около 70% своей жизни во сне.", "Кошки проводят 70% жизни во сне."),
+])
+def test_duplicates_are_found(stored, submitted):
+    match = make_index(stored).find(submitted)
+
+    assert match is not None
+    assert match[0] == 0
+
+
+@pytest.mark.parametrize("stored, submitted", [
+    # Разные факты с общими служебными словами: при сравнении множеств слов
+    # с порогом 0.5 они отклонялись (0.62 и 0.75)
+    ("В Японии больше всего в мире торговых автоматов.", "В Японии больше всего в мире вулканов."),
+    ("Баскетбол был изобретен в 1891 году в США.", "Баскетбол был изобретен в 1891 году в Канаде."),
+    ("Баскетбол был изобретен в 1891 году в США.", "Волейбол был изобретен в 1895 году."),
+])
+def test_distinct_facts_are_not_flagged(stored, submitted):
+    assert make_index(stored).find(submitted) is None
+
+
+def test_state_roundtrip():
+    index = make_index("У осьминога три сердца.", "Сердце креветки находится в ее голове.")
+    restored = FactDeduplicator(["У осьминога три сердца.", "Сердце креветки находится в ее голове."].__getitem__)
+    restored.restore(index.state())
+
+    assert restored.find("Сердце креветки находится в её голове!")[0] == 1
+
+
+@pytest.fixture
+def facts_copy(tmp_path, monkeypatch):
+    # Снимок фактов пишется в текущий каталог
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "facts.json")
+    shutil.copyfile(FACTS_FILE, path)
+    return path
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_deduplicate_is_idempotent(facts_copy):
+    manager = FactsDataManager(storage=JsonFactsStorage(facts_copy), snapshot_file=None)
+    total = len(manager._fact_index)
+    removed = manager.deduplicate()
+
+    assert removed
+    assert len(manager._fact_index) == total - len(removed)
+    content = read_bytes(facts_copy)
+
+    again = FactsDataManager(storage=JsonFactsStorage(facts_copy), snapshot_file=None)
+    assert again.deduplicate() == []
+    assert read_bytes(facts_copy) == content
+
+
+def test_dedup_tool(facts_copy):
+    original = read_bytes(facts_copy)
+    dedup(argparse.Namespace(db=None, facts=facts_copy, dry_run=True))
+    assert read_bytes(facts_copy) == original
+
+    dedup(argparse.Namespace(db=None, facts=facts_copy, dry_run=False))
+    deduplicated = read_bytes(facts_copy)
+    assert deduplicated != original
+
+    dedup(argparse.Namespace(db=None, facts=facts_copy, dry_run=False))
+    assert read_bytes(facts_copy) == deduplicated
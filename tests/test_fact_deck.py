@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from bot import FactDeck, UserPreferences
+
+
+def deal(deck, size, count):
+    cards = []
+    for _ in range(count):
+        card, deck = FactDeck.draw(deck, size)
+        cards.append(card)
+    return cards, deck
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 1000])
+def test_deck_is_full_permutation(size):
+    cards, _ = deal(None, size, size)
+
+    assert sorted(cards) == list(range(size))
+
+
+def test_next_deck_is_reshuffled():
+    first, deck = deal(None, 50, 50)
+    second, _ = deal(deck, 50, 50)
+
+    assert sorted(second) == list(range(50))
+    assert first != second
+
+
+def test_grown_set_is_dealt_after_current_deck():
+    before, deck = deal(None, 10, 4)
+    # Набор вырос посреди колоды: оставшиеся и добавленные карты раздаются без повторов
+    after, deck = deal(deck, 15, 11)
+
+    assert sorted(before + after) == list(range(15))
+    assert set(after[6:]) == set(range(10, 15))
+    # Только затем колода перетасовывается по всему набору
+    again, _ = deal(deck, 15, 15)
+    assert sorted(again) == list(range(15))
+
+
+def test_shrunk_set_starts_new_deck():
+    _, deck = deal(None, 10, 3)
+    cards, _ = deal(deck, 5, 5)
+
+    assert sorted(cards) == list(range(5))
+
+
+def test_legacy_deck_is_resumed():
+    seed = 12345
+    dealt = [FactDeck._permute(position, 10, seed) for position in range(3)]
+    # Прежний формат [size, seed, cursor]
+    rest, _ = deal([10, seed, 3], 10, 7)
+
+    assert rest == [FactDeck._permute(position, 10, seed) for position in range(3, 10)]
+    assert sorted(dealt + rest) == list(range(10))
+
+
+def test_deck_survives_restart(tmp_path):
+    preferences_file = str(tmp_path / "prefs.json")
+    prefs = UserPreferences(preferences_file)
+    cards = []
+    for _ in range(5):
+        card, deck = FactDeck.draw(prefs.get_fact_deck(1, "random"), 12)
+        prefs.set_fact_deck(1, "random", deck)
+        cards.append(card)
+    # Колода сдвигается в памяти и не пишется в журнал на каждый просмотр
+    assert not os.path.exists(prefs.storage.journal_file) or os.path.getsize(prefs.storage.journal_file) == 0
+    prefs.close()
+
+    reloaded = UserPreferences(preferences_file)
+    for _ in range(7):
+        card, deck = FactDeck.draw(reloaded.get_fact_deck(1, "random"), 12)
+        reloaded.set_fact_deck(1, "random", deck)
+        cards.append(card)
+
+    assert sorted(cards) == list(range(12))
+
+
+def test_decks_are_flushed_once_per_user(tmp_path):
+    prefs = UserPreferences(str(tmp_path / "prefs.json"))
+    for _ in range(10):
+        _, deck = FactDeck.draw(prefs.get_fact_deck(1, "topic_космос"), 20)
+        prefs.set_fact_deck(1, "topic_космос", deck)
+    _, deck = FactDeck.draw(None, 5)
+    prefs.set_fact_deck(1, "random", deck)
+
+    assert prefs.flush_stats() == 1
+    with open(prefs.storage.journal_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    assert len(lines) == 1
+    assert prefs.get_fact_deck(1, "topic_космос")[3] == 10
+    assert prefs.get_fact_deck(1, "random") == deck
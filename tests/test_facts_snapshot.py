@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from bot import FactsDataManager, FactsSnapshot, JsonFactsStorage
+
+FACTS = {
+    "космос": ["Венера вращается в обратную сторону.", "На Марсе самый высокий вулкан Солнечной системы."],
+    "животные": ["У осьминога три сердца.", "Ёжики видят плохо, но отлично слышат 🦔"],
+}
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / "facts.snapshot")
+    fact_index = [("космос", 0), ("космос", 1), ("животные", 0), ("животные", 1)]
+    index_state = ({"слово": {0: 1}}, [1, 2, 3], ("префикс",))
+    FactsSnapshot(path).save(42, FACTS, fact_index, index_state)
+
+    snapshot = FactsSnapshot(path)
+    assert snapshot.open(42)
+    assert snapshot.facts_data == FACTS
+    assert snapshot.fact_index == fact_index
+    assert snapshot.load_indexes() == index_state
+
+
+def test_other_source_version_is_ignored(tmp_path):
+    path = str(tmp_path / "facts.snapshot")
+    FactsSnapshot(path).save(42, FACTS, [], None)
+
+    snapshot = FactsSnapshot(path)
+    assert not snapshot.open(43)
+    assert not snapshot.open(None)
+    assert snapshot.facts_data is None
+    assert snapshot.load_indexes() is None
+
+
+def test_other_format_is_ignored(tmp_path, monkeypatch):
+    path = str(tmp_path / "facts.snapshot")
+    FactsSnapshot(path).save(42, FACTS, [], None)
+
+    monkeypatch.setattr(FactsSnapshot, "FORMAT", FactsSnapshot.FORMAT[:1] + (FactsSnapshot.FORMAT[1] + 1,)
+                        + FactsSnapshot.FORMAT[2:])
+    assert not FactsSnapshot(path).open(42)
+
+
+def test_damaged_snapshot_is_ignored(tmp_path):
+    path = tmp_path / "facts.snapshot"
+    path.write_bytes(b"not a snapshot")
+
+    assert not FactsSnapshot(str(path)).open(42)
+
+
+def write_source(path, data, mtime):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def open_manager(tmp_path):
+    return FactsDataManager(storage=JsonFactsStorage(str(tmp_path / "facts.json")),
+                            snapshot_file=str(tmp_path / "facts.snapshot"))
+
+
+@pytest.fixture
+def snapshotted(tmp_path):
+    """Источник фактов и снимок, записанный при закрытии менеджера с построенными индексами"""
+    write_source(str(tmp_path / "facts.json"), FACTS, 1_000_000_000_000_000_000)
+    manager = open_manager(tmp_path)
+    assert manager.search_facts("осьминога")
+    manager.close()
+    return tmp_path
+
+
+def test_manager_starts_from_snapshot(snapshotted, monkeypatch):
+    def fail(*args):
+        raise AssertionError("индексы должны читаться из снимка")
+
+    manager = open_manager(snapshotted)
+    monkeypatch.setattr(manager, "_build_text_indexes", fail)
+
+    assert manager.snapshot.version == 1_000_000_000_000_000_000
+    assert manager.facts_data == FACTS
+    assert manager.search_facts("осьминога") == [("животные", "У осьминога три сердца.")]
+    manager.close()
+
+
+def test_snapshot_is_ignored_when_source_changes(snapshotted):
+    changed = dict(FACTS, история=["Первый полет человека в космос — 1961 год."])
+    write_source(str(snapshotted / "facts.json"), changed, 1_000_000_001_000_000_000)
+
+    manager = open_manager(snapshotted)
+    assert manager.facts_data == changed
+    assert manager.search_facts("полет") == [("история", "Первый полет человека в космос — 1961 год.")]
+    manager.close()
+
+    # При закрытии снимок обновлен под новую версию источника
+    snapshot = FactsSnapshot(str(snapshotted / "facts.snapshot"))
+    assert snapshot.open(1_000_000_001_000_000_000)
+    assert snapshot.facts_data == changed
+
+
+def test_facts_added_during_warm_up_are_indexed(snapshotted):
+    manager = open_manager(snapshotted)
+    fact = "Кит-убийца на самом деле дельфин."
+
+    async def scenario():
+        warm_up = asyncio.create_task(manager.warm_up())
+        # Индексы читаются из снимка в пуле потоков, а обработчик тем временем добавляет факт
+        await asyncio.sleep(0)
+        assert manager._text_indexes is None
+        manager.add_fact("животные", fact, check_duplicates=False)
+        await warm_up
+
+    asyncio.run(scenario())
+
+    assert len(manager.search_index) == 5
+    assert manager.search_facts("дельфин") == [("животные", fact)]
+    assert [found for _, _, found in manager.prefix_search("дельф")] == [fact]
+    assert manager.find_duplicate("Кит-убийца на самом деле — дельфин!")[1] == fact
+    manager.close()
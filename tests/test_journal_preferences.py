@@ -0,0 +1,82 @@
+import json
+import os
+
+from bot import JournalPreferencesStorage, UserPreferences
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def journal_lines(storage):
+    with open(storage.journal_file, 'r', encoding='utf-8') as f:
+        return [line for line in f if line.strip()]
+
+
+def test_append_writes_journal_line(tmp_path):
+    storage = JournalPreferencesStorage(str(tmp_path / "prefs.json"))
+    storage.load()
+    storage.append("1", "favorite_topic", "космос")
+
+    assert [json.loads(line) for line in journal_lines(storage)] == [["1", "favorite_topic", "космос"]]
+    assert not os.path.exists(storage.snapshot_file)
+
+
+def test_load_replays_journal_over_snapshot(tmp_path):
+    snapshot = tmp_path / "prefs.json"
+    snapshot.write_text(json.dumps({"1": {"favorite_topic": "история", "subscribed": True}}), encoding='utf-8')
+    (tmp_path / "prefs.json.journal").write_text(
+        '["1","favorite_topic","космос"]\n["2","stats",{"total_facts":3}]\n', encoding='utf-8'
+    )
+
+    storage = JournalPreferencesStorage(str(snapshot))
+    data = storage.load()
+
+    expected = {"1": {"favorite_topic": "космос", "subscribed": True}, "2": {"stats": {"total_facts": 3}}}
+    assert data == expected
+    # Проигранный журнал сразу сжимается в снимок
+    assert read_json(snapshot) == expected
+    assert journal_lines(storage) == []
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    snapshot = tmp_path / "prefs.json"
+    (tmp_path / "prefs.json.journal").write_text(
+        '["1","favorite_topic","космос"]\n["1","subscri', encoding='utf-8'
+    )
+
+    data = JournalPreferencesStorage(str(snapshot)).load()
+
+    assert data == {"1": {"favorite_topic": "космос"}}
+
+
+def test_compaction_at_threshold(tmp_path):
+    preferences_file = str(tmp_path / "prefs.json")
+    prefs = UserPreferences(preferences_file)
+    prefs.storage.compact_threshold = 3
+    for i in range(3):
+        prefs.set_favorite_topic(i, "космос")
+
+    assert read_json(preferences_file) == {str(i): {"favorite_topic": "космос"} for i in range(3)}
+    assert journal_lines(prefs.storage) == []
+
+    prefs.set_favorite_topic(0, "наука")
+    prefs.close()
+
+    reloaded = JournalPreferencesStorage(preferences_file).load()
+    assert reloaded["0"] == {"favorite_topic": "наука"}
+    assert len(reloaded) == 3
+
+
+def test_user_preferences_survive_restart(tmp_path):
+    preferences_file = str(tmp_path / "prefs.json")
+    prefs = UserPreferences(preferences_file)
+    prefs.set_favorite_topic(42, "животные")
+    prefs.update_stats(42)
+    prefs.update_stats(42)
+    prefs.close()
+
+    reloaded = UserPreferences(preferences_file)
+    assert reloaded.get_favorite_topic(42) == "животные"
+    assert reloaded.get_user_stats(42)["total_facts"] == 2
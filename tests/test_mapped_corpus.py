@@ -0,0 +1,127 @@
+import json
+import os
+
+import pytest
+
+from bot import FactsDataManager, JsonFactsStorage, MappedCorpus, MappedFactsStorage, MappedTopicFacts, build_corpus
+
+FACTS = {
+    "животные": [
+        "Кит",
+        "Синий кит — самое крупное животное на Земле.",
+        "Ёжики видят плохо, но отлично слышат 🦔",
+    ],
+    "космос": ["Венера вращается в обратную сторону.", "ab", "cd"],
+    "пустая": [],
+}
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = str(tmp_path / "facts.corpus")
+    build_corpus(path, FACTS, source_version=42)
+    corpus = MappedCorpus(path)
+    yield corpus
+    corpus.close()
+
+
+def topic_facts(corpus, topic):
+    return MappedTopicFacts(corpus, *corpus.topics[topic])
+
+
+def test_roundtrip(corpus):
+    assert corpus.source_version == 42
+    assert list(corpus.topics) == list(FACTS)
+    assert {topic: list(topic_facts(corpus, topic)) for topic in corpus.topics} == FACTS
+    assert corpus.fact(2) == "Ёжики видят плохо, но отлично слышат 🦔"
+
+
+def test_membership_respects_fact_boundaries(corpus):
+    animals = topic_facts(corpus, "животные")
+    space = topic_facts(corpus, "космос")
+
+    assert "Кит" in animals
+    assert "Синий кит — самое крупное животное на Земле." in animals
+    # Подстроки других фактов и склейки соседних фактов фактами не являются
+    assert "кит" not in animals
+    assert "Синий кит" not in animals
+    assert "bc" not in space
+    assert "abcd" not in space
+    assert "ab" in space
+    # Факты других тем не учитываются
+    assert "ab" not in animals
+    assert "Кит" not in space
+    assert "Кит" not in topic_facts(corpus, "пустая")
+
+
+def test_added_facts(corpus):
+    animals = topic_facts(corpus, "животные")
+    animals.append("Кит-убийца — это дельфин.")
+    snapshot = animals.copy()
+    animals.append("Коала спит до 22 часов в сутки.")
+
+    assert len(animals) == 5
+    assert animals[3] == "Кит-убийца — это дельфин."
+    assert animals[-1] == "Коала спит до 22 часов в сутки."
+    assert animals[-5] == "Кит"
+    assert animals[1:4] == FACTS["животные"][1:] + ["Кит-убийца — это дельфин."]
+    assert list(animals) == FACTS["животные"] + ["Кит-убийца — это дельфин.", "Коала спит до 22 часов в сутки."]
+    assert "Коала спит до 22 часов в сутки." in animals
+    # Копия не видит фактов, добавленных после нее
+    assert len(snapshot) == 4
+    assert "Коала спит до 22 часов в сутки." not in snapshot
+    with pytest.raises(IndexError):
+        animals[5]
+
+
+def write_source(path, data, mtime):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def load(storage):
+    return {topic: list(facts) for topic, facts in storage.load().items()}
+
+
+def test_rebuild_on_changed_source(tmp_path):
+    source = str(tmp_path / "facts.json")
+    corpus_file = str(tmp_path / "facts.corpus")
+    write_source(source, FACTS, 1_000_000_000_000_000_000)
+
+    assert load(MappedFactsStorage(corpus_file, JsonFactsStorage(source))) == FACTS
+    built = os.stat(corpus_file).st_ino
+
+    # Источник не менялся: корпус используется повторно
+    assert load(MappedFactsStorage(corpus_file, JsonFactsStorage(source))) == FACTS
+    assert os.stat(corpus_file).st_ino == built
+
+    changed = dict(FACTS, история=["Первый полет человека в космос — 1961 год."])
+    write_source(source, changed, 1_000_000_001_000_000_000)
+    assert load(MappedFactsStorage(corpus_file, JsonFactsStorage(source))) == changed
+    assert MappedCorpus(corpus_file).source_version == 1_000_000_001_000_000_000
+
+
+def test_damaged_corpus_is_rebuilt(tmp_path):
+    source = str(tmp_path / "facts.json")
+    corpus_file = tmp_path / "facts.corpus"
+    write_source(source, FACTS, 1_000_000_000_000_000_000)
+    corpus_file.write_bytes(b"not a corpus")
+
+    assert load(MappedFactsStorage(str(corpus_file), JsonFactsStorage(source))) == FACTS
+
+
+def test_manager_over_corpus(tmp_path):
+    source = str(tmp_path / "facts.json")
+    corpus_file = str(tmp_path / "facts.corpus")
+    write_source(source, FACTS, 1_000_000_000_000_000_000)
+
+    manager = FactsDataManager(storage=MappedFactsStorage(corpus_file, JsonFactsStorage(source)), snapshot_file=None)
+    assert manager.add_fact("космос", "На Марсе есть самый высокий вулкан Солнечной системы.")
+    manager.close()
+
+    reloaded = FactsDataManager(storage=MappedFactsStorage(corpus_file, JsonFactsStorage(source)), snapshot_file=None)
+    assert list(reloaded.facts_data["космос"]) == FACTS["космос"] + [
+        "На Марсе есть самый высокий вулкан Солнечной системы."
+    ]
+    assert isinstance(reloaded.facts_data["космос"], MappedTopicFacts)
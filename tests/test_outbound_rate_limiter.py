@@ -0,0 +1,200 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+from bot import OutboundRateLimiter, TokenBucket
+
+# RetryAfter с числом секунд сообщает о будущем переходе на timedelta
+pytestmark = pytest.mark.filterwarnings("ignore::telegram.warnings.PTBDeprecationWarning")
+
+
+class FakeClock:
+    """Часы, которые идут только во время ожидания в планировщике"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        deadline = self.now + seconds
+        # Даем остальным задачам встать в очередь, пока вызов ждет
+        await asyncio.sleep(0)
+        self.now = max(self.now, deadline)
+
+
+class StubBot:
+    """Вызов Bot API, который записывает запросы и выполняет заготовленные ответы"""
+
+    def __init__(self, clock, *outcomes):
+        self.clock = clock
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    async def __call__(self, endpoint, data, **kwargs):
+        self.calls.append((self.clock.now, endpoint, dict(data)))
+        outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+def make_limiter(clock, **kwargs):
+    kwargs.setdefault("global_rate", 30)
+    return OutboundRateLimiter(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def request(limiter, callback, endpoint, **data):
+    return limiter.process_request(callback, (), {}, endpoint, data, None)
+
+
+def test_bucket_reservations_queue_up():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+    # Запас расходуется сразу, следующие резервы встают в очередь друг за другом
+    assert [bucket.reserve() for _ in range(5)] == [0.0, 0.0, 0.5, 1.0, 1.5]
+    assert not bucket.idle()
+
+    clock.now = 10.0
+    assert bucket.idle()
+    assert bucket.reserve() == 0.0
+
+
+def test_bucket_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=5, clock=clock)
+
+    bucket.pause(3)
+    assert bucket.reserve() == 3.0
+    assert bucket.reserve() == 4.0
+
+    # Пауза короче уже накопленного ожидания его не сокращает
+    bucket.pause(1)
+    assert bucket.reserve() == 5.0
+
+
+def test_private_chat_messages_are_sent_in_order():
+    clock = FakeClock()
+    limiter = make_limiter(clock, chat_rate=1)
+    bot = StubBot(clock)
+
+    async def scenario():
+        await asyncio.gather(*(request(limiter, bot, "sendMessage", chat_id=1, text=str(i)) for i in range(4)))
+
+    asyncio.run(scenario())
+
+    assert clock.sleeps == [1.0, 2.0, 3.0]
+    assert [(at, data["text"]) for at, _, data in bot.calls] == [(0.0, "0"), (1.0, "1"), (2.0, "2"), (3.0, "3")]
+
+
+def test_chats_do_not_wait_for_each_other():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=100, chat_rate=1, group_per_minute=20)
+    bot = StubBot(clock)
+
+    async def scenario():
+        await asyncio.gather(
+            *(request(limiter, bot, "sendMessage", chat_id=chat_id, text="факт") for chat_id in range(1, 11)),
+            *(request(limiter, bot, "sendMessage", chat_id=-100, text=str(i)) for i in range(21)),
+        )
+
+    asyncio.run(scenario())
+
+    # Лимит группы — 20 сообщений в минуту: только 21-е ждет свои 3 секунды
+    assert clock.sleeps == [3.0]
+    assert len(bot.calls) == 31
+
+
+def test_unlimited_methods_skip_buckets():
+    clock = FakeClock()
+    limiter = make_limiter(clock, chat_rate=1)
+    bot = StubBot(clock)
+
+    async def scenario():
+        for _ in range(3):
+            await request(limiter, bot, "sendChatAction", chat_id=1, action="typing")
+            await request(limiter, bot, "getMe")
+
+    asyncio.run(scenario())
+
+    assert clock.sleeps == []
+    assert len(bot.calls) == 6
+
+
+@pytest.mark.parametrize("retry_after", [3, timedelta(seconds=3)])
+def test_retry_after_pauses_chat_and_retries(retry_after):
+    clock = FakeClock()
+    limiter = make_limiter(clock, chat_rate=1)
+    bot = StubBot(clock, RetryAfter(retry_after), "sent")
+
+    async def scenario():
+        first = await request(limiter, bot, "sendMessage", chat_id=1, text="факт")
+        # Следующее сообщение в этот чат ждет своей очереди после паузы
+        second = await request(limiter, bot, "sendMessage", chat_id=1, text="еще факт")
+        return first, second
+
+    assert asyncio.run(scenario()) == ("sent", "ok")
+    assert [at for at, _, _ in bot.calls] == [0.0, 3.0, 4.0]
+    assert clock.sleeps == [3.0, 1.0]
+
+
+def test_retry_after_gives_up_after_max_retries():
+    clock = FakeClock()
+    limiter = make_limiter(clock, chat_rate=1, max_retries=2)
+    bot = StubBot(clock, RetryAfter(1), RetryAfter(1), RetryAfter(1), "sent")
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(request(limiter, bot, "sendMessage", chat_id=1, text="факт"))
+    assert len(bot.calls) == 3
+
+
+def test_pending_edits_are_merged():
+    clock = FakeClock()
+    limiter = make_limiter(clock, chat_rate=1)
+    bot = StubBot(clock, "message", "edited")
+
+    async def scenario():
+        return await asyncio.gather(
+            request(limiter, bot, "sendMessage", chat_id=1, text="факт"),
+            *(request(limiter, bot, "editMessageText", chat_id=1, message_id=7, text=f"версия {i}") for i in range(3)),
+            request(limiter, bot, "editMessageText", chat_id=1, message_id=8, text="другое сообщение"),
+        )
+
+    results = asyncio.run(scenario())
+
+    # Ожидающая правка заменяется новой; все, кто правил это сообщение, получают один результат
+    assert results == ["message", "edited", "edited", "edited", "ok"]
+    assert [(endpoint, data["text"]) for _, endpoint, data in bot.calls] == [
+        ("sendMessage", "факт"),
+        ("editMessageText", "версия 2"),
+        ("editMessageText", "другое сообщение"),
+    ]
+    assert limiter._pending_edits == {}
+
+
+def test_merged_edit_failure_reaches_every_caller():
+    clock = FakeClock()
+    limiter = make_limiter(clock, chat_rate=1)
+    bot = StubBot(clock, "message", BadRequest("Message is not modified"))
+
+    async def scenario():
+        return await asyncio.gather(
+            request(limiter, bot, "sendMessage", chat_id=1, text="факт"),
+            request(limiter, bot, "editMessageText", chat_id=1, message_id=7, text="версия 0"),
+            request(limiter, bot, "editMessageText", chat_id=1, message_id=7, text="версия 1"),
+            return_exceptions=True,
+        )
+
+    sent, first, second = asyncio.run(scenario())
+
+    assert sent == "message"
+    assert isinstance(first, BadRequest)
+    assert second is first
+    assert len(bot.calls) == 2
+    assert limiter._pending_edits == {}
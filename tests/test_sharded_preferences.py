@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+
+from bot import ShardedPreferencesStorage, UserPreferences
+from tools import reshard
+
+
+def make_preferences(count):
+    return {str(1000 + i): {"favorite_topic": "космос", "stats": {"total_facts": i}} for i in range(count)}
+
+
+def read_shards(directory):
+    return dict(ShardedPreferencesStorage(directory).load().items())
+
+
+def test_users_stay_in_their_shard(tmp_path):
+    directory = str(tmp_path / "shards")
+    prefs = UserPreferences(storage=ShardedPreferencesStorage(directory, shards=4))
+    for user_id in (1, 2, 3, 42):
+        prefs.set_favorite_topic(user_id, "наука")
+    prefs.close()
+
+    for user_id_str in ("1", "2", "3", "42"):
+        index = ShardedPreferencesStorage.shard_index(user_id_str, 4)
+        with open(os.path.join(directory, f"shard-{index:03d}.json"), 'r', encoding='utf-8') as f:
+            assert json.load(f)[user_id_str] == {"favorite_topic": "наука"}
+
+
+def test_manifest_fixes_shard_count(tmp_path):
+    directory = str(tmp_path / "shards")
+    prefs = UserPreferences(storage=ShardedPreferencesStorage(directory, shards=4))
+    prefs.set_favorite_topic(1, "наука")
+    prefs.close()
+
+    # Другое число шардов в настройках не должно потерять пользователей
+    reopened = ShardedPreferencesStorage(directory, shards=8)
+    assert reopened.shards == 4
+    assert reopened.load()["1"] == {"favorite_topic": "наука"}
+
+
+def test_released_shard_reloads_from_journal(tmp_path):
+    storage = ShardedPreferencesStorage(str(tmp_path / "shards"), shards=8, max_loaded=1)
+    preferences = make_preferences(50)
+    for user_id_str, user_prefs in preferences.items():
+        for key, value in user_prefs.items():
+            storage.append(user_id_str, key, value)
+        storage.release()
+
+    assert len(storage._loaded) == 1
+    assert storage.load_user("1010") == preferences["1010"]
+    assert dict(storage.iter_users()) == preferences
+
+
+def test_reshard_keeps_all_users(tmp_path):
+    source = str(tmp_path / "shards")
+    storage = ShardedPreferencesStorage(source, shards=4)
+    preferences = make_preferences(200)
+    storage.import_data(preferences)
+    # Изменение, которое есть только в журнале шарда (хранилище не закрыто, как при сбое)
+    UserPreferences(storage=storage).set_favorite_topic(1000, "наука")
+    preferences["1000"]["favorite_topic"] = "наука"
+
+    target = str(tmp_path / "resharded")
+    reshard(argparse.Namespace(source=source, target=target, shards=16))
+
+    assert ShardedPreferencesStorage(target).shards == 16
+    assert read_shards(target) == preferences
+
+
+def test_reshard_from_json_file(tmp_path):
+    preferences_file = tmp_path / "prefs.json"
+    preferences = make_preferences(30)
+    preferences_file.write_text(json.dumps(preferences), encoding='utf-8')
+
+    target = str(tmp_path / "shards")
+    reshard(argparse.Namespace(source=str(preferences_file), target=target, shards=3))
+    # Повторный решардинг сохраняет прежний каталог как резервную копию
+    reshard(argparse.Namespace(source=target, target=target, shards=5))
+
+    assert read_shards(target) == preferences
+    assert read_shards(target + ".bak") == preferences
+
+
+def test_user_preferences_on_shards(tmp_path):
+    directory = str(tmp_path / "shards")
+    prefs = UserPreferences(storage=ShardedPreferencesStorage(directory, shards=4))
+    prefs.set_favorite_topic(5, "история")
+    prefs.update_stats(5)
+    prefs.close()
+
+    reloaded = UserPreferences(storage=ShardedPreferencesStorage(directory))
+    assert reloaded.get_favorite_topic(5) == "история"
+    assert reloaded.get_user_stats(5)["total_facts"] == 1
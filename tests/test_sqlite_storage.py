@@ -0,0 +1,136 @@
+import argparse
+import json
+
+import pytest
+
+from bot import (FactsDataManager, FactsStorage, PreferencesStorage, SQLiteFactsStorage, SQLitePreferencesStorage,
+                 UserPreferences)
+from tools import migrate_sqlite
+
+FACTS = {
+    "космос": ["Венера вращается в обратную сторону.", "На Марсе есть самый высокий вулкан."],
+    "животные": ["Кошки проводят около 70% своей жизни во сне."],
+}
+
+
+@pytest.fixture
+def open_storage():
+    """Открывает хранилище и закрывает его соединение в конце теста"""
+    storages = []
+
+    def open_(storage_class, *args, **kwargs):
+        storage = storage_class(*args, **kwargs)
+        storages.append(storage)
+        return storage
+
+    yield open_
+    for storage in storages:
+        storage.close()
+
+
+def all_facts(facts_data):
+    return [(topic, fact) for topic, facts in facts_data.items() for fact in facts]
+
+
+def test_facts_roundtrip(tmp_path, open_storage):
+    db = str(tmp_path / "facts.db")
+    storage = open_storage(SQLiteFactsStorage, db)
+    assert storage.load() is None
+    storage.save(FACTS, all_facts(FACTS))
+    storage.close()
+
+    storage = open_storage(SQLiteFactsStorage, db)
+    assert storage.load() == FACTS
+    storage.save(FACTS, [("история", "Первый полет человека в космос — 1961 год.")])
+    assert storage.load()["история"] == ["Первый полет человека в космос — 1961 год."]
+
+    storage.rewrite({"космос": FACTS["космос"][:1]})
+    assert storage.load() == {"космос": FACTS["космос"][:1]}
+
+
+def test_manager_persists_new_fact(tmp_path, open_storage):
+    db = str(tmp_path / "facts.db")
+    storage = open_storage(SQLiteFactsStorage, db)
+    storage.save(FACTS, all_facts(FACTS))
+    manager = FactsDataManager(storage=storage)
+    assert manager.add_fact("Животные", "Пингвины-императоры ныряют глубже пятисот метров.")
+    manager.close()
+
+    animals = open_storage(SQLiteFactsStorage, db).load()["животные"]
+    assert animals[:len(FACTS["животные"])] == FACTS["животные"]
+    assert animals[-1] == "Пингвины-императоры ныряют глубже пятисот метров."
+
+
+def test_preferences_batch_commit(tmp_path, open_storage):
+    db = str(tmp_path / "prefs.db")
+    storage = open_storage(SQLitePreferencesStorage, db, batch_size=2)
+    storage.append("1", "favorite_topic", "космос")
+    # Первая запись еще не закоммичена и не видна другому соединению
+    assert open_storage(SQLitePreferencesStorage, db).load() == {}
+
+    storage.append("1", "stats", {"total_facts": 5})
+    assert open_storage(SQLitePreferencesStorage, db).load() == {
+        "1": {"favorite_topic": "космос", "stats": {"total_facts": 5}}
+    }
+
+    storage.append("2", "favorite_topic", "наука")
+    storage.close()
+    assert open_storage(SQLitePreferencesStorage, db).load()["2"] == {"favorite_topic": "наука"}
+
+
+def test_per_user_reads(tmp_path, open_storage):
+    storage = open_storage(SQLitePreferencesStorage, str(tmp_path / "prefs.db"))
+    preferences = {str(i): {"subscribed": i % 2 == 0, "favorite_topic": "наука"} for i in range(25)}
+    storage.import_data(preferences)
+
+    assert storage.load_user("7") == preferences["7"]
+    assert storage.load_user("100") is None
+    # Постраничный обход отдает каждого пользователя ровно один раз
+    assert list(storage.iter_users(batch_size=4)) == sorted(preferences.items())
+
+
+def test_user_preferences_on_sqlite(tmp_path, open_storage):
+    db = str(tmp_path / "prefs.db")
+    prefs = UserPreferences(storage=open_storage(SQLitePreferencesStorage, db))
+    prefs.set_favorite_topic(7, "история")
+    prefs.update_stats(7)
+    prefs.close()
+
+    reloaded = UserPreferences(storage=open_storage(SQLitePreferencesStorage, db))
+    assert reloaded.get_favorite_topic(7) == "история"
+    assert reloaded.get_user_stats(7)["total_facts"] == 1
+
+
+def test_migrate_from_json(tmp_path, open_storage):
+    facts_file = tmp_path / "facts.json"
+    facts_file.write_text(json.dumps(FACTS, ensure_ascii=False), encoding='utf-8')
+    prefs_file = tmp_path / "prefs.json"
+    prefs_file.write_text(json.dumps({"1": {"favorite_topic": "космос"}}), encoding='utf-8')
+    # Несжатая запись журнала тоже должна попасть в базу
+    (tmp_path / "prefs.json.journal").write_text('["2","favorite_topic","наука"]\n', encoding='utf-8')
+
+    db = str(tmp_path / "bot.db")
+    migrate_sqlite(argparse.Namespace(db=db, facts=str(facts_file), preferences=str(prefs_file)))
+
+    assert open_storage(SQLiteFactsStorage, db).load() == FACTS
+    assert open_storage(SQLitePreferencesStorage, db).load() == {
+        "1": {"favorite_topic": "космос"}, "2": {"favorite_topic": "наука"}
+    }
+
+
+def test_incomplete_backend_fails_on_creation():
+    class WriteOnlyFacts(FactsStorage):
+        def save(self, facts_data, new_facts):
+            pass
+
+    class NoPerUserReads(PreferencesStorage):
+        def load(self):
+            return {}
+
+        def append(self, user_id_str, key, value):
+            pass
+
+    with pytest.raises(TypeError):
+        WriteOnlyFacts()
+    with pytest.raises(TypeError):
+        NoPerUserReads()
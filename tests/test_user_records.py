@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from bot import FactDeck, ShardedPreferencesStorage, SQLitePreferencesStorage, UserPreferences
+
+
+def serve(prefs, user_id):
+    """То, что обработчик делает на каждый показ факта"""
+    prefs.get_favorite_topic(user_id)
+    _, deck = FactDeck.draw(prefs.get_fact_deck(user_id, "random"), 30)
+    prefs.set_fact_deck(user_id, "random", deck)
+    prefs.add_seen_fact(user_id, user_id)
+    prefs.update_stats(user_id)
+
+
+def run_lifetime(prefs, users, step):
+    """Проходит по пользователям волнами, сбрасывая буферы и выгружая данные после каждой"""
+    resident = []
+    for start in range(0, users, step):
+        for user_id in range(start, start + step):
+            if user_id % 3 == 0:
+                prefs.set_favorite_topic(user_id, "космос")
+            serve(prefs, user_id)
+        prefs.flush_stats()
+        asyncio.run(prefs.flush_async())
+        resident.append(len(prefs.records))
+    return resident
+
+
+@pytest.mark.parametrize("make_storage", [
+    lambda tmp_path: SQLitePreferencesStorage(str(tmp_path / "prefs.db")),
+    lambda tmp_path: ShardedPreferencesStorage(str(tmp_path / "shards"), shards=16, max_loaded=2),
+], ids=["sqlite", "sharded"])
+def test_resident_users_stay_bounded(tmp_path, make_storage):
+    prefs = UserPreferences(storage=make_storage(tmp_path), cache_size=50)
+    resident = run_lifetime(prefs, 2000, 200)
+
+    # Пользователей за время работы все больше, а в памяти — не больше размера кэша
+    assert max(resident) <= 50
+    assert prefs._preferences is None
+    if isinstance(prefs.storage, ShardedPreferencesStorage):
+        assert len(prefs.storage._loaded) <= 2
+    # Вытесненные и сброшенные записи читаются обратно из хранилища
+    assert prefs.get_favorite_topic(3) == "космос"
+    assert prefs.get_user_stats(3)["total_facts"] == 1
+    assert prefs.get_seen_facts(3) == {3}
+    assert prefs.get_fact_deck(3, "random")[3] == 1
+    prefs.close()
+
+
+def test_loaded_storage_is_not_duplicated_in_cache(tmp_path):
+    preferences_file = str(tmp_path / "prefs.json")
+    prefs = UserPreferences(preferences_file, cache_size=50)
+    run_lifetime(prefs, 600, 200)
+
+    # Журнальное хранилище держит всех пользователей само, кэш записей ему не нужен
+    assert len(prefs.records) == 0
+    assert prefs.preferences is prefs.storage.data
+    assert prefs.get_favorite_topic(3) == "космос"
+    prefs.close()
+
+    reloaded = UserPreferences(preferences_file)
+    assert reloaded.get_user_stats(599)["total_facts"] == 1
+    assert reloaded.get_seen_facts(599) == {599}
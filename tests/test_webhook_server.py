@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+from bot import WebhookServer
+
+
+class RecordingWebhookServer(WebhookServer):
+    """Вебхук, который складывает обновления в список вместо очереди приложения"""
+
+    def __init__(self, **kwargs):
+        super().__init__(None, listen="127.0.0.1", port=0, url_path="/telegram", secret_token="секрет", **kwargs)
+        self.delivered = []
+
+    async def _deliver(self, data):
+        self.delivered.append(data)
+
+
+async def start(server):
+    await server.start()
+    return server._server.sockets[0].getsockname()[1]
+
+
+def request(body=b"{}", secret="секрет".encode('utf-8'), connection="keep-alive"):
+    return (
+        b"POST /telegram HTTP/1.1\r\n"
+        b"X-Telegram-Bot-Api-Secret-Token: " + secret + b"\r\n"
+        b"Connection: " + connection.encode() + b"\r\n"
+        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+    )
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    return head.split(b"\r\n", 1)[0].decode()
+
+
+def test_update_is_delivered():
+    async def scenario():
+        server = RecordingWebhookServer()
+        port = await start(server)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request(json.dumps({"update_id": 1}).encode()))
+        first = await read_response(reader)
+        # Соединение остается открытым для следующего запроса
+        writer.write(request(json.dumps({"update_id": 2}).encode(), connection="close"))
+        second = await read_response(reader)
+        writer.close()
+        await server.stop()
+        return first, second, server.delivered
+
+    first, second, delivered = asyncio.run(scenario())
+
+    assert first == "HTTP/1.1 200 OK"
+    assert second == "HTTP/1.1 200 OK"
+    assert delivered == [{"update_id": 1}, {"update_id": 2}]
+
+
+def test_wrong_secret_is_rejected():
+    async def scenario():
+        server = RecordingWebhookServer()
+        port = await start(server)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        # Байты вне ASCII в заголовке не должны ронять обработчик соединения
+        writer.write(request(secret=b"\xff\xfe"))
+        non_ascii = await read_response(reader)
+        writer.write(request(secret=b"wrong"))
+        wrong = await read_response(reader)
+        writer.close()
+        await server.stop()
+        return non_ascii, wrong, server.delivered
+
+    non_ascii, wrong, delivered = asyncio.run(scenario())
+
+    assert non_ascii == "HTTP/1.1 403 Forbidden"
+    assert wrong == "HTTP/1.1 403 Forbidden"
+    assert delivered == []
+
+
+def test_idle_connection_frees_its_slot():
+    async def scenario():
+        server = RecordingWebhookServer(max_connections=1, idle_timeout=0.2)
+        port = await start(server)
+        idle_reader, idle_writer = await asyncio.open_connection("127.0.0.1", port)
+        await asyncio.sleep(0.05)
+        # Единственное место занято молчащим клиентом; после таймаута его соединение закрывается
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request(json.dumps({"update_id": 1}).encode(), connection="close"))
+        status = await asyncio.wait_for(read_response(reader), 2)
+        closed = await asyncio.wait_for(idle_reader.read(), 2)
+        idle_writer.close()
+        writer.close()
+        await server.stop()
+        return status, closed
+
+    status, closed = asyncio.run(scenario())
+
+    assert status == "HTTP/1.1 200 OK"
+    assert closed == b""
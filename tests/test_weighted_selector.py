@@ -0,0 +1,155 @@
+import json
+import math
+import os
+import random
+from collections import Counter
+
+import pytest
+
+import bot
+from bot import TOPIC_FACTS, FactsDataManager, FenwickTree, JsonFactsStorage, UserPreferences, WeightedFactSelector
+
+
+def prefix_sums(weights):
+    sums, total = [], 0.0
+    for weight in weights:
+        total += weight
+        sums.append(total)
+    return sums
+
+
+def test_fenwick_find_follows_prefix_sums():
+    weights = [1.0, 2.0, 0.0, 3.0, 4.0]
+    tree = FenwickTree(weights)
+
+    assert tree.total == 10.0
+    assert [tree.find(value) for value in (0, 0.99, 1, 2.99, 3, 5.99, 6, 9.99)] == [0, 0, 1, 1, 3, 3, 4, 4]
+
+
+def test_fenwick_build_matches_appends_and_updates():
+    rng = random.Random(7)
+    weights = [rng.uniform(0, 5) for _ in range(37)]
+    built = FenwickTree(weights)
+    appended = FenwickTree()
+    for weight in weights:
+        appended.append(weight)
+
+    assert built._tree == pytest.approx(appended._tree)
+    for index in (0, 5, 36):
+        weights[index] = rng.uniform(0, 5)
+        built.update(index, weights[index])
+        appended.update(index, weights[index])
+    assert built.total == pytest.approx(sum(weights))
+    for index, bound in enumerate(prefix_sums(weights)):
+        # Чуть меньше накопленной суммы — еще этот индекс
+        assert built.find(bound - 1e-9) == index
+        assert appended.find(bound - 1e-9) == index
+
+
+def test_fenwick_sample_is_proportional():
+    random.seed(1)
+    tree = FenwickTree([1.0, 0.0, 3.0])
+    counts = Counter(tree.sample() for _ in range(8000))
+
+    assert counts[1] == 0
+    assert counts[2] / counts[0] == pytest.approx(3, rel=0.1)
+
+
+def make_selector(facts_data, **kwargs):
+    kwargs.setdefault("views_file", None)
+    return WeightedFactSelector(**kwargs).build(facts_data)
+
+
+def test_views_raise_weight():
+    selector = make_selector({"космос": ["а", "б"], "наука": ["в"]}, popularity_weight=1.0)
+    for _ in range(20):
+        selector.record_view("космос", 1)
+
+    assert selector._trees[0].weight(1) == pytest.approx(1 + math.log1p(20))
+    assert selector.total("космос") == pytest.approx(2 + math.log1p(20))
+    assert selector.total() == pytest.approx(3 + math.log1p(20))
+    random.seed(2)
+    counts = Counter(selector.draw("космос") for _ in range(4000))
+    assert counts[("космос", 1)] / counts[("космос", 0)] == pytest.approx(1 + math.log1p(20), rel=0.1)
+
+
+def test_recency_boost_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    selector = make_selector({"космос": ["а"]}, recency_boost=3.0, recency_window=60)
+    selector.add("космос", 1, recent=True)
+
+    assert selector.total("космос") == pytest.approx(4.0)
+    now[0] += 59
+    selector.draw()
+    assert selector.total("космос") == pytest.approx(4.0)
+    now[0] += 1
+    selector.draw()
+    assert selector.total("космос") == pytest.approx(2.0)
+    assert selector._recent == {}
+
+
+def test_unseen_facts_are_preferred():
+    selector = make_selector({"космос": [str(i) for i in range(10)]}, unseen_boost=10)
+    random.seed(3)
+    counts = Counter(selector.draw("космос", lambda topic, offset: offset != 0) for _ in range(4000))
+
+    # Непоказанный факт весит в unseen_boost раз больше: 10 / (10 + 9)
+    assert counts[("космос", 0)] / 4000 == pytest.approx(10 / 19, rel=0.1)
+
+
+def test_everything_seen_still_draws():
+    selector = make_selector({"космос": ["а", "б"]}, unseen_boost=5)
+
+    assert selector.draw("космос", lambda topic, offset: True) is not None
+    assert selector.draw("наука") is None
+
+
+@pytest.fixture
+def manager(tmp_path):
+    facts_file = tmp_path / "facts.json"
+    facts_file.write_text(json.dumps({"животные": ["Свой факт о животных."]}, ensure_ascii=False), encoding='utf-8')
+    manager = FactsDataManager(storage=JsonFactsStorage(str(facts_file)), snapshot_file=None,
+                               selector=WeightedFactSelector(views_file=None))
+    yield manager
+    manager.close()
+
+
+def test_weighted_topic_sees_the_catalog(manager):
+    # Факты каталога не переносятся в базу, пока их не выдали
+    assert not manager._dirty
+    random.seed(4)
+    served = {manager.get_fact_by_topic("животные") for _ in range(400)}
+
+    assert served == set(TOPIC_FACTS["животные"]) | {"Свой факт о животных."}
+    assert manager._missing_catalog()["животные"] == []
+    assert len(manager.facts_data["животные"]) == len(served)
+
+
+def test_weighted_random_sees_the_catalog(manager):
+    random.seed(5)
+    served = Counter(manager.get_random_fact() for _ in range(300))
+    catalog = {fact for facts in TOPIC_FACTS.values() for fact in facts}
+
+    assert sum(count for fact, count in served.items() if fact in catalog) > 250
+    # Выданный факт каталога хранится в базе ровно один раз
+    for facts in manager.facts_data.values():
+        assert len(facts) == len(set(facts))
+
+
+def test_seen_facts_are_buffered(tmp_path):
+    preferences_file = str(tmp_path / "prefs.json")
+    prefs = UserPreferences(preferences_file)
+    for fact_key in range(10):
+        prefs.add_seen_fact(1, fact_key, limit=6)
+
+    assert prefs.get_seen_facts(1) == set(range(4, 10))
+    assert not os.path.exists(prefs.storage.journal_file) or os.path.getsize(prefs.storage.journal_file) == 0
+    assert prefs.flush_stats() == 1
+    prefs.add_seen_fact(1, 42, limit=6)
+    assert prefs.get_seen_facts(1) == set(range(4, 10)) | {42}
+    prefs.close()
+
+    reloaded = UserPreferences(preferences_file)
+    # После сброса хранятся только limit последних
+    assert reloaded.get_seen_facts(1) == set(range(5, 10)) | {42}
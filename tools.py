@@ -0,0 +1,346 @@
+"""Вспомогательные инструменты для локальной разработки и обслуживания бота"""
+
+import os
+import json
+import time
+import shutil
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs
+
+from bot import (
+    TOPICS,
+    FactsDataManager,
+    MappedCorpus,
+    build_corpus,
+    JournalPreferencesStorage,
+    JsonFactsStorage,
+    ShardedPreferencesStorage,
+    SQLiteFactsStorage,
+    SQLitePreferencesStorage,
+)
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger("tools")
+
+FAKE_BOT_USER = {"id": 1, "is_bot": True, "first_name": "FactsBot", "username": "facts_bot"}
+
+# Доли разных видов синтетических обновлений (примерно как в реальном трафике)
+SYNTHETIC_MIX = (
+    ("random", 30),
+    ("fact", 15),
+    ("myfact", 8),
+    ("text_topic", 7),
+    ("callback_random", 12),
+    ("callback_topic", 15),
+    ("callback_fav", 3),
+    ("callback_setfav", 3),
+    ("callback_stats", 4),
+    ("stats", 3),
+    ("inline", 10),
+)
+
+
+def fake_api_result(method: str, params: Dict):
+    """Возвращает правдоподобный результат метода Bot API для подменного сервера"""
+    if method == "getMe":
+        return FAKE_BOT_USER
+    if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+        with FakeTelegramHandler.lock:
+            FakeTelegramHandler.message_counter += 1
+            message_id = FakeTelegramHandler.message_counter
+        return {
+            "message_id": int(params.get("message_id") or message_id),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 1), "type": "private"},
+            "from": FAKE_BOT_USER,
+            "text": params.get("text", ""),
+        }
+    return True
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Подменный Bot API: на любой метод отвечает успешным результатом"""
+
+    message_counter = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length) if length else b""
+        method = self.path.rsplit('/', 1)[-1]
+        result = fake_api_result(method, self._parse_params(body))
+
+        payload = json.dumps({"ok": True, "result": result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _parse_params(self, body: bytes) -> Dict:
+        content_type = self.headers.get("Content-Type", "")
+        if "json" in content_type:
+            try:
+                return json.loads(body or b"{}")
+            except ValueError:
+                return {}
+        return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_synthetic_update(update_id: int, user_id: int, rng: random.Random) -> Dict:
+    """Создает случайное обновление Telegram: команду, текст или нажатие кнопки"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    kinds, weights = zip(*SYNTHETIC_MIX)
+    kind = rng.choices(kinds, weights)[0]
+    topic = rng.choice(TOPICS)
+
+    if kind == "inline":
+        # Инлайн-запрос приходит на каждое нажатие клавиши, поэтому берется префикс темы
+        return {
+            "update_id": update_id,
+            "inline_query": {"id": str(update_id), "from": user, "query": topic[:rng.randint(1, len(topic))], "offset": ""},
+        }
+
+    if kind.startswith("callback_"):
+        data = {
+            "callback_random": "random",
+            "callback_topic": f"topic_{topic}",
+            "callback_fav": f"fav_{topic}",
+            "callback_setfav": f"setfav_{topic}",
+            "callback_stats": "stats",
+        }[kind]
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "text": "..."},
+            },
+        }
+
+    text = {
+        "random": "/random",
+        "fact": f"/fact {topic}",
+        "myfact": "/myfact",
+        "text_topic": topic,
+        "stats": "/stats",
+    }[kind]
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text}
+    if text.startswith('/'):
+        command_length = len(text.split(' ', 1)[0])
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return {"update_id": update_id, "message": message}
+
+
+def post_update(url: str, update: Dict, secret: str = None) -> int:
+    """Отправляет обновление на вебхук бота, возвращает HTTP-статус"""
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def fake_telegram(args):
+    """Запускает подменный Bot API и отправляет на вебхук синтетические обновления"""
+    server = ThreadingHTTPServer((args.host, args.port), FakeTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Подменный Bot API запущен на http://{args.host}:{args.port}")
+
+    if args.webhook:
+        rng = random.Random(args.seed)
+        updates = [
+            make_synthetic_update(i + 1, rng.randint(1, args.users), rng)
+            for i in range(args.updates)
+        ]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            statuses = list(pool.map(lambda u: post_update(args.webhook, u, args.secret), updates))
+        elapsed = time.perf_counter() - started
+        accepted = statuses.count(200)
+        logger.info(f"Отправлено {len(updates)} обновлений за {elapsed:.2f} с, принято: {accepted}")
+
+    if args.serve:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    server.shutdown()
+
+
+def migrate_sqlite(args):
+    """Переносит факты и настройки пользователей из JSON-файлов в базу SQLite"""
+    facts_storage = SQLiteFactsStorage(args.db)
+    try:
+        if facts_storage.load() is not None:
+            logger.error(f"В базе {args.db} уже есть факты, миграция отменена")
+            return
+
+        facts_data = JsonFactsStorage(args.facts).load() or {}
+        facts_storage.save(facts_data, [(topic, fact) for topic, facts in facts_data.items() for fact in facts])
+        logger.info(f"Перенесено фактов: {sum(len(facts) for facts in facts_data.values())}")
+    finally:
+        facts_storage.close()
+
+    # Журнал настроек проигрывается поверх снимка, поэтому переносятся и несжатые изменения
+    preferences = JournalPreferencesStorage(args.preferences).load()
+    prefs_storage = SQLitePreferencesStorage(args.db)
+    try:
+        prefs_storage.import_data(preferences)
+        logger.info(f"Перенесено пользователей: {len(preferences)}")
+    finally:
+        prefs_storage.close()
+
+
+def dedup(args):
+    """Удаляет из базы фактов точные и близкие дубликаты"""
+    storage = SQLiteFactsStorage(args.db) if args.db else JsonFactsStorage(args.facts)
+    manager = FactsDataManager(args.facts, storage=storage)
+    removed = manager.deduplicate(persist=not args.dry_run)
+    for topic, fact in removed:
+        logger.info(f"Дубликат [{topic}]: {fact}")
+    logger.info(f"Найдено дубликатов: {len(removed)}" + (" (хранилище не изменено)" if args.dry_run else ""))
+    storage.close()
+
+
+def reshard(args):
+    """Перераспределяет настройки пользователей по новому числу шардов"""
+    if os.path.isdir(args.source):
+        source = ShardedPreferencesStorage(args.source)
+    else:
+        source = JournalPreferencesStorage(args.source)
+    preferences = source.load()
+
+    # Новые шарды собираются во временном каталоге и подменяют целевой только целиком
+    target = os.path.abspath(args.target)
+    staging = tempfile.mkdtemp(prefix=".reshard-", dir=os.path.dirname(target))
+    storage = ShardedPreferencesStorage(staging, args.shards)
+    storage.import_data(preferences)
+    storage.close()
+    logger.info(f"Пользователей: {len(preferences)}, шардов: {args.shards}")
+    source.close()
+
+    if os.path.exists(target):
+        backup = target + ".bak"
+        shutil.rmtree(backup, ignore_errors=True)
+        os.replace(target, backup)
+        logger.info(f"Прежние шарды сохранены в {backup}")
+    os.replace(staging, target)
+    logger.info(f"Шарды записаны в {target} (запускайте бота с PREFERENCES_SHARDS={args.shards})")
+
+
+def build_corpus_command(args):
+    """Компилирует JSON-файл фактов в корпус для чтения через mmap"""
+    source = JsonFactsStorage(args.facts)
+    facts_data = source.load()
+    if facts_data is None:
+        logger.error(f"Файл {args.facts} не найден")
+        return
+    build_corpus(args.output, facts_data, source.version() or 0)
+
+    corpus = MappedCorpus(args.output)
+    logger.info(f"Корпус {args.output}: тем {len(corpus.topics)}, фактов {corpus.fact_count}, "
+                f"{os.path.getsize(args.output) / 1024:.1f} КиБ (запускайте бота с FACTS_CORPUS={args.output})")
+    corpus.close()
+
+
+def build_snapshot_command(args):
+    """Заранее строит снимок фактов и поисковых индексов, чтобы бот не строил их при запуске"""
+    if not os.path.exists(args.facts):
+        logger.error(f"Файл {args.facts} не найден")
+        return
+    manager = FactsDataManager(args.facts, snapshot_file=args.output)
+    # Индексы строятся синхронно, затем снимок записывается при закрытии
+    started = time.perf_counter()
+    facts_count = len(manager.search_index)
+    manager.close()
+    if manager.snapshot.version is None:
+        logger.error(f"Снимок {args.output} не записан")
+        return
+    logger.info(f"Снимок {args.output}: фактов {facts_count}, {time.perf_counter() - started:.1f} с, "
+                f"{os.path.getsize(args.output) / 1024:.1f} КиБ (запускайте бота с FACTS_SNAPSHOT={args.output})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fake = subparsers.add_parser(
+        "fake-telegram",
+        help="подменный Bot API и генератор обновлений для вебхука "
+             "(запускайте бота с TELEGRAM_API_URL=http://HOST:PORT и BOT_MODE=webhook, "
+             "для многопроцессного режима — еще и BOT_WORKERS=N)",
+    )
+    fake.add_argument("--host", default="127.0.0.1")
+    fake.add_argument("--port", type=int, default=8081)
+    fake.add_argument("--webhook", help="адрес вебхука бота, например http://127.0.0.1:8443/telegram")
+    fake.add_argument("--secret", help="секретный токен вебхука")
+    fake.add_argument("--users", type=int, default=10)
+    fake.add_argument("--updates", type=int, default=100)
+    fake.add_argument("--concurrency", type=int, default=8)
+    fake.add_argument("--seed", type=int, default=0)
+    fake.add_argument("--serve", action="store_true", help="не завершаться после отправки обновлений")
+    fake.set_defaults(func=fake_telegram)
+
+    migrate = subparsers.add_parser(
+        "migrate-sqlite",
+        help="перенос данных из JSON-файлов в SQLite (затем запускайте бота с STORAGE_BACKEND=sqlite)",
+    )
+    migrate.add_argument("--facts", default="russian_facts.json")
+    migrate.add_argument("--preferences", default="user_preferences.json")
+    migrate.add_argument("--db", default="facts.db")
+    migrate.set_defaults(func=migrate_sqlite)
+
+    dedup_parser = subparsers.add_parser("dedup", help="удаление дубликатов из базы фактов")
+    dedup_parser.add_argument("--facts", default="russian_facts.json")
+    dedup_parser.add_argument("--db", help="база SQLite вместо JSON-файла")
+    dedup_parser.add_argument("--dry-run", action="store_true", help="только показать дубликаты")
+    dedup_parser.set_defaults(func=dedup)
+
+    reshard_parser = subparsers.add_parser(
+        "reshard",
+        help="раскладка настроек пользователей по шардам (из user_preferences.json или каталога шардов)",
+    )
+    reshard_parser.add_argument("--source", default="user_preferences.json", help="файл настроек или каталог шардов")
+    reshard_parser.add_argument("--target", default="user_preferences.d", help="каталог шардов")
+    reshard_parser.add_argument("--shards", type=int, default=16)
+    reshard_parser.set_defaults(func=reshard)
+
+    corpus_parser = subparsers.add_parser("build-corpus", help="сборка корпуса фактов для чтения через mmap")
+    corpus_parser.add_argument("--facts", default="russian_facts.json")
+    corpus_parser.add_argument("--output", default="russian_facts.corpus")
+    corpus_parser.set_defaults(func=build_corpus_command)
+
+    snapshot_parser = subparsers.add_parser("build-snapshot", help="сборка снимка фактов и поисковых индексов")
+    snapshot_parser.add_argument("--facts", default="russian_facts.json")
+    snapshot_parser.add_argument("--output", default="russian_facts.snapshot")
+    snapshot_parser.set_defaults(func=build_snapshot_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()